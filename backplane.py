@@ -0,0 +1,199 @@
+"""server.py のワーカー間で配信を共有するバックプレーン
+
+    WS_BACKPLANE=""                              ... 1プロセスのみ（既定。今までと同じ）
+    WS_BACKPLANE=redis://127.0.0.1:6379/0         ... Redis 互換サーバーの pub/sub で全ワーカーへ流す
+    WS_BACKPLANE=unix:///run/redis/redis.sock     ... 同じマシンなら Unix ソケットでも可
+
+publish() したメッセージは（送った本人も含む）全ワーカーの handler(origin, topic, message) に届き、
+各ワーカーが自分につながっているソケットへ配る。Redis を使う時は redis パッケージが必要
+（pip install redis）。
+
+claim() / forget() / hit() は期限付きのキーで、ワーカーをまたいだ「先着1名」と「期間内の回数」を数える
+（コンシューマーグループの担当決め、送信の重複除去・レート制限に使う）。
+next_seq() はフォーム送信の (epoch, seq) を振る（1プロセスならプロセス内、Redis ならワーカー共通）。
+"""
+import asyncio
+import json
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, Tuple
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # 1プロセスで動かすだけなら不要
+    aioredis = None
+
+Handler = Callable[[str, str, dict], Awaitable[None]]
+
+
+class LocalBackplane:
+    """プロセス内でそのまま handler を呼ぶ"""
+
+    shared = False
+
+    def __init__(self, handler: Handler):
+        self.handler = handler
+        self.origin = uuid.uuid4().hex
+        # 連番はこのプロセスの中だけで振る（epoch は起動ごとに変わる）
+        self.epoch = uuid.uuid4().hex
+        self.seq = 0
+        self.published = 0
+        self.received = 0
+        self._keys: Dict[str, float] = {}  # key -> 期限
+        self._counts: Dict[str, Tuple[int, float]] = {}  # key -> (回数, 期限)
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def publish(self, topic: str, message: dict):
+        self.published += 1
+        self.received += 1
+        await self.handler(self.origin, topic, message)
+
+    def _prune(self, now: float):
+        if len(self._keys) + len(self._counts) < 1024:
+            return
+        self._keys = {k: t for k, t in self._keys.items() if t > now}
+        self._counts = {k: v for k, v in self._counts.items() if v[1] > now}
+
+    async def claim(self, key: str, ttl: float) -> bool:
+        now = time.monotonic()
+        self._prune(now)
+        if self._keys.get(key, 0) > now:
+            return False
+        self._keys[key] = now + ttl
+        return True
+
+    async def forget(self, key: str):
+        self._keys.pop(key, None)
+
+    async def hit(self, key: str, ttl: float) -> int:
+        """ttl 秒の窓の中で何回目か（窓は最初の1回から数える）"""
+        now = time.monotonic()
+        self._prune(now)
+        count, expires = self._counts.get(key, (0, 0.0))
+        if expires <= now:
+            count, expires = 0, now + ttl
+        self._counts[key] = (count + 1, expires)
+        return count + 1
+
+    async def next_seq(self) -> Tuple[str, int]:
+        self.seq += 1
+        return self.epoch, self.seq
+
+    def as_dict(self) -> dict:
+        return {"mode": "local", "origin": self.origin, "epoch": self.epoch, "seq": self.seq,
+                "published": self.published, "received": self.received}
+
+
+class RedisBackplane:
+    """Redis 互換サーバーの1チャンネルに全メッセージを流す（送り手ごとの順序は保たれる）
+
+    - claim(): SET NX で「この送信を担当するのは1ワーカーだけ」を決める（コンシューマーグループ用）
+    - next_seq(): フォーム送信の epoch / seq をワーカー共通で振る
+    """
+
+    shared = True
+
+    def __init__(self, url: str, handler: Handler, prefix: str = "karma"):
+        if aioredis is None:
+            raise RuntimeError("WS_BACKPLANE を使うには redis パッケージが必要です (pip install redis)")
+        self.url = url
+        self.handler = handler
+        self.prefix = prefix
+        self.channel = f"{prefix}:bus"
+        self.origin = uuid.uuid4().hex
+        self.client = aioredis.from_url(url, decode_responses=True)
+        self.published = 0
+        self.received = 0
+        self.reconnects = 0
+        self._task = None
+
+    async def start(self):
+        # 購読が始まってから返す（起動直後の publish を自分が取りこぼさないように）
+        pubsub = await self._subscribe()
+        self._task = asyncio.create_task(self._listen(pubsub))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+        await self.client.aclose()
+
+    async def _subscribe(self):
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        await pubsub.subscribe(self.channel)
+        return pubsub
+
+    async def _listen(self, pubsub):
+        while True:
+            try:
+                async for item in pubsub.listen():
+                    if item.get("type") != "message":
+                        continue
+                    envelope = json.loads(item["data"])
+                    self.received += 1
+                    try:
+                        await self.handler(envelope["o"], envelope["t"], envelope["m"])
+                    except Exception as e:
+                        print(f"⚠️ Backplane handler error: {e!r}")
+            except asyncio.CancelledError:
+                await pubsub.aclose()
+                raise
+            except Exception as e:
+                # 切れている間に流れたメッセージは届かない。再購読して続ける
+                print(f"⚠️ Backplane disconnected ({e!r}), resubscribing")
+                self.reconnects += 1
+                await pubsub.aclose()
+                while True:
+                    await asyncio.sleep(1)
+                    try:
+                        pubsub = await self._subscribe()
+                        break
+                    except Exception:
+                        continue
+
+    async def publish(self, topic: str, message: dict):
+        self.published += 1
+        await self.client.publish(self.channel, json.dumps({"o": self.origin, "t": topic, "m": message}))
+
+    async def claim(self, key: str, ttl: float) -> bool:
+        return bool(await self.client.set(f"{self.prefix}:claim:{key}", self.origin, nx=True, px=int(ttl * 1000)))
+
+    async def forget(self, key: str):
+        await self.client.delete(f"{self.prefix}:claim:{key}")
+
+    async def hit(self, key: str, ttl: float) -> int:
+        name = f"{self.prefix}:hits:{key}"
+        count = await self.client.incr(name)
+        if count == 1:
+            await self.client.pexpire(name, int(ttl * 1000))
+        return count
+
+    async def next_seq(self) -> Tuple[str, int]:
+        # epoch はサーバー（Redis）が続く限り同じ。Redis が空になったら新しい epoch で 1 から振り直す
+        epoch_key = f"{self.prefix}:epoch"
+        epoch = await self.client.get(epoch_key)
+        if epoch is None:
+            await self.client.set(epoch_key, uuid.uuid4().hex, nx=True)
+            epoch = await self.client.get(epoch_key)
+        return epoch, await self.client.incr(f"{self.prefix}:seq:{epoch}")
+
+    def as_dict(self) -> dict:
+        return {
+            "mode": "redis",
+            "origin": self.origin,
+            "published": self.published,
+            "received": self.received,
+            "reconnects": self.reconnects,
+        }
+
+
+def create_backplane(url: str, handler: Handler, prefix: str = "karma"):
+    if not url:
+        return LocalBackplane(handler)
+    if url.split("://", 1)[0] in ("redis", "rediss", "unix"):
+        return RedisBackplane(url, handler, prefix)
+    raise ValueError(f"unsupported backplane URL: {url}")
@@ -0,0 +1,452 @@
+"""エンドツーエンドの負荷試験: server.py + bridge.py + 代役プロバイダー
+
+    python bench/load.py --kiosks 8 --visitors 40 --rate 20 --out bench_result.json
+    python bench/load.py ... --baseline bench_result.json   # 前回より悪化していたら終了コード 1
+
+1. 代役プロバイダー（bench/mock_providers.py）をこのプロセス内で起動する
+2. server.py を uvicorn で、bridge.py を bench/run_bridge.py で子プロセスとして起動する
+3. キオスク N 台ぶんの WebSocket を /ws に張り、来場者ごとに
+   （一部は）/upload-satellite でスマホ写真相当の JPEG を送り、/submit でフォームを送る
+4. bridge.py の OSC 出力を UDP で受け、/submit から最初の動画が届くまでの時間を測る
+
+負荷（来場者の順番・写真の有無・プロバイダーの遅延）は --seed で固定され、
+結果はキー順を固定した JSON で出力する。
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import platform
+import random
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+import uvicorn
+import websockets
+from pythonosc.dispatcher import Dispatcher
+from pythonosc.osc_server import AsyncIOOSCUDPServer
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import mock_providers  # noqa: E402
+
+NICKNAME_RE = re.compile(r"bench\d{4}")
+
+
+def free_port(kind=socket.SOCK_STREAM) -> int:
+    with socket.socket(socket.AF_INET, kind) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def rss_mb(pid: int):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def summarize(values) -> dict:
+    """ミリ秒の分布（n / mean / p50 / p95 / p99 / max）"""
+    values = sorted(values)
+    if not values:
+        return {"n": 0}
+
+    def pct(q):
+        return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+    return {
+        "n": len(values),
+        "mean": round(statistics.mean(values), 1),
+        "p50": round(pct(0.50), 1),
+        "p95": round(pct(0.95), 1),
+        "p99": round(pct(0.99), 1),
+        "max": round(values[-1], 1),
+    }
+
+
+def parse_histogram(text: str, name: str, label: str) -> dict:
+    """Prometheus テキストからヒストグラムの {ラベル値: {count, mean_ms}} を取り出す"""
+    sums, counts = {}, {}
+    pattern = re.compile(rf'^{name}_(sum|count)\{{.*?{label}="([^"]*)".*?\}} (\S+)$')
+    for line in text.splitlines():
+        m = pattern.match(line)
+        if m:
+            (sums if m.group(1) == "sum" else counts)[m.group(2)] = float(m.group(3))
+    return {
+        key: {"count": int(counts[key]), "mean_ms": round(sums.get(key, 0.0) / counts[key] * 1000, 1)}
+        for key in sorted(counts) if counts[key]
+    }
+
+
+def make_photo(size) -> bytes:
+    # スマホ写真に近い重さにするため、ノイズ入りの大きな JPEG を作る
+    from PIL import Image
+
+    buf = io.BytesIO()
+    Image.effect_noise(size, 48).convert("RGB").save(buf, "JPEG", quality=90)
+    return buf.getvalue()
+
+
+class Kiosk:
+    def __init__(self, n: int, url: str):
+        self.n = n
+        self.url = url
+        self.ws = None
+        self.session_id = None
+        self.received = {}  # session_id -> (受信時刻, image_id)
+        self.task = None
+
+    async def connect(self):
+        self.ws = await websockets.connect(self.url, max_size=None)
+        self.task = asyncio.create_task(self._reader())
+
+    async def _reader(self):
+        try:
+            async for message in self.ws:
+                data = json.loads(message)
+                if data.get("type") == "satellite_image":
+                    self.received.setdefault(data.get("session_id"), (time.perf_counter(), data.get("image_id", "")))
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    async def new_visitor(self, session_id: str):
+        # 本物のキオスクは送信後にリロードし、新しいセッションで購読し直す
+        if self.session_id:
+            await self.ws.send(json.dumps({"type": "unsubscribe", "topics": [f"session:{self.session_id}"]}))
+        self.session_id = session_id
+        await self.ws.send(json.dumps({"type": "subscribe", "topics": [f"session:{session_id}"]}))
+
+    async def close(self):
+        await self.ws.close()
+        if self.task:
+            await self.task
+
+
+class OscCollector:
+    """bridge.py の /karma/... バンドルを受ける。ニックネームは渡された JSON ファイルから読む"""
+
+    def __init__(self):
+        self.first_variant = {}  # nickname -> 最初の /karma/variant/{idx} を受けた時刻
+        self.bundle = {}  # nickname -> /karma/set を受けた時刻
+        self.messages = 0
+        self.duplicates = 0
+        self._seen = set()
+        self._skip = False
+
+    def handle(self, address, *args):
+        self.messages += 1
+        now = time.perf_counter()
+        if address == "/karma/seq":
+            # 同じ (boot_id, seq) のバンドルは2回目以降を捨てる（KARMA_OSC_REPEAT の再送分）
+            key = (args[1], args[0])
+            self._skip = key in self._seen
+            self._seen.add(key)
+            self.duplicates += self._skip
+            return
+        if self._skip or not address.endswith("/json") or not args:
+            return
+        try:
+            with open(args[0], encoding="utf-8") as f:
+                text = f.read()
+        except OSError:
+            return
+        for nickname in set(NICKNAME_RE.findall(text)):
+            if address == "/karma/set/json":
+                self.bundle.setdefault(nickname, now)
+            elif address.startswith("/karma/variant/"):
+                self.first_variant.setdefault(nickname, now)
+
+
+async def wait_http(url: str, timeout: float, check=None):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as c:
+        while time.monotonic() < deadline:
+            try:
+                res = await c.get(url)
+                if res.status_code == 200 and (check is None or check(res)):
+                    return res
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.2)
+    raise TimeoutError(f"{url} did not become ready")
+
+
+def form_fields(nickname: str, rng: random.Random) -> dict:
+    fields = {"q1": nickname, "q2": str(rng.randint(10, 80)), "q3": rng.choice(["red", "blue", "white"])}
+    for name, top in (("q4_1", 3), ("q4_2", 4), ("q4_3", 3), ("q5", 4), ("q6_1", 4), ("q6_2", 4),
+                      ("q6_3", 4), ("q7", 4), ("q9", 2), ("q10", 4), ("q11", 4), ("q12", 4),
+                      ("q13", 4), ("q14", 1), ("q15", 4), ("q16", 2)):
+        fields[name] = str(rng.randint(0, top))
+    fields.update({"q8": "Kyoto", "q17": "letters", "q18": "sea", "q19": "noise"})
+    return fields
+
+
+async def run(args) -> dict:
+    rng = random.Random(args.seed)
+    workdir = tempfile.mkdtemp(prefix="karma_bench_")
+    print(f"logs: {workdir}", file=sys.stderr)
+    server_port, provider_port, metrics_port = free_port(), free_port(), free_port()
+    osc_port = free_port(socket.SOCK_DGRAM)
+    base_url = f"http://127.0.0.1:{server_port}"
+
+    # --- 代役プロバイダー（このプロセス内） ---
+    provider = uvicorn.Server(uvicorn.Config(
+        mock_providers.create_app(args.gpt_ms, args.dalle_ms, args.fal_ms, args.fal_slots,
+                                  args.jitter, args.video_kb, args.seed),
+        host="127.0.0.1", port=provider_port, log_level="warning",
+    ))
+    provider_task = asyncio.create_task(provider.serve())
+
+    # --- OSC 受信 ---
+    collector = OscCollector()
+    dispatcher = Dispatcher()
+    dispatcher.set_default_handler(collector.handle)
+    osc_transport, _ = await AsyncIOOSCUDPServer(
+        ("127.0.0.1", osc_port), dispatcher, asyncio.get_running_loop()
+    ).create_serve_endpoint()
+
+    # --- server.py / bridge.py ---
+    env = dict(os.environ, PYTHONUNBUFFERED="1")
+    server_log = open(os.path.join(workdir, "server.log"), "w")
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "server:app", "--host", "127.0.0.1", "--port", str(server_port),
+         "--log-level", "warning"],
+        cwd=ROOT_DIR, stdout=server_log, stderr=subprocess.STDOUT,
+        env=dict(env, BLOB_DIR=os.path.join(workdir, "blobs")),
+    )
+    bridge_log = open(os.path.join(workdir, "bridge.log"), "w")
+    bridge = None
+    rss = {"server": [], "bridge": []}
+    kiosks = []
+    try:
+        await wait_http(f"{base_url}/stats", 30)
+        bridge = subprocess.Popen(
+            [sys.executable, os.path.join(BENCH_DIR, "run_bridge.py")],
+            cwd=ROOT_DIR, stdout=bridge_log, stderr=subprocess.STDOUT,
+            env=dict(
+                env,
+                HOME=workdir,
+                KARMA_URL=f"ws://127.0.0.1:{server_port}/ws",
+                KARMA_BENCH_PROVIDER_URL=f"http://127.0.0.1:{provider_port}",
+                KARMA_OSC_PORT=str(osc_port),
+                KARMA_OSC_STREAMING="1",
+                # 計測するのは /karma/... の新形式だけ
+                KARMA_OSC_LEGACY="0",
+                KARMA_CACHE_MODE=args.cache_mode,
+                KARMA_WORKERS=str(args.workers),
+                KARMA_METRICS_PORT=str(metrics_port),
+            ),
+        )
+        # ブリッジが接続して form_submission を購読するまで待つ
+        await wait_http(f"{base_url}/stats", 60, check=lambda r: r.json()["connections"] >= 1)
+        await asyncio.sleep(0.5)
+
+        async def sample_rss():
+            while True:
+                for name, proc in (("server", server), ("bridge", bridge)):
+                    value = rss_mb(proc.pid)
+                    if value is not None:
+                        rss[name].append(value)
+                await asyncio.sleep(0.5)
+
+        rss_task = asyncio.create_task(sample_rss())
+
+        kiosks = [Kiosk(n, f"ws://127.0.0.1:{server_port}/ws") for n in range(args.kiosks)]
+        await asyncio.gather(*(k.connect() for k in kiosks))
+
+        photo = make_photo(tuple(int(x) for x in args.photo_px.split("x")))
+        # 来場者ごとの条件は先に決めておく（seed が同じなら毎回同じ負荷）
+        visitors = [
+            {"n": i, "kiosk": kiosks[i % len(kiosks)], "nickname": f"bench{i:04d}",
+             "photo": rng.random() < args.photo_ratio, "fields": form_fields(f"bench{i:04d}", rng)}
+            for i in range(args.visitors)
+        ]
+        interval = 60.0 / args.rate
+        upload_ms, push_ms, submit_ms = [], [], []
+        submitted = {}
+        errors = []
+        busy = {}  # 受付制御で断られた送信（reason -> 件数）
+        kiosk_busy = {id(k): asyncio.Lock() for k in kiosks}
+        started = time.perf_counter()
+
+        async def visit(v, http: httpx.AsyncClient):
+            await asyncio.sleep(v["n"] * interval)
+            kiosk = v["kiosk"]
+            async with kiosk_busy[id(kiosk)]:
+                session_id = f"bench-{v['n']:04d}"
+                await kiosk.new_visitor(session_id)
+                fields = dict(v["fields"], session_id=session_id)
+                try:
+                    if v["photo"]:
+                        t0 = time.perf_counter()
+                        res = await http.post(
+                            "/upload-satellite", data={"session_id": session_id},
+                            files={"image": ("photo.jpg", photo, "image/jpeg")},
+                        )
+                        res.raise_for_status()
+                        upload_ms.append((time.perf_counter() - t0) * 1000)
+                        deadline = time.perf_counter() + 10
+                        while session_id not in kiosk.received and time.perf_counter() < deadline:
+                            await asyncio.sleep(0.005)
+                        if session_id in kiosk.received:
+                            # キオスクは届いた image_id をフォームと一緒に送る
+                            pushed_at, fields["image_id"] = kiosk.received[session_id]
+                            push_ms.append((pushed_at - t0) * 1000)
+                    t0 = time.perf_counter()
+                    res = await http.post("/submit", data=fields)
+                    if res.status_code in (429, 503):
+                        reason = res.json().get("reason", str(res.status_code))
+                        busy[reason] = busy.get(reason, 0) + 1
+                        return
+                    res.raise_for_status()
+                    submitted[v["nickname"]] = t0
+                    submit_ms.append((time.perf_counter() - t0) * 1000)
+                except httpx.HTTPError as e:
+                    errors.append(f"{v['nickname']}: {e!r}")
+
+        async with httpx.AsyncClient(base_url=base_url, timeout=60) as http:
+            await asyncio.gather(*(visit(v, http) for v in visitors))
+
+        # 全員の動画が届くか、タイムアウトするまで待つ
+        deadline = time.perf_counter() + args.drain_timeout
+        while time.perf_counter() < deadline and len(collector.first_variant) < len(submitted):
+            await asyncio.sleep(0.2)
+        await asyncio.sleep(1.0)
+        finished = time.perf_counter()
+        rss_task.cancel()
+
+        ttfv = [(collector.first_variant[n] - t) * 1000 for n, t in submitted.items() if n in collector.first_variant]
+        ttav = [(collector.bundle[n] - t) * 1000 for n, t in submitted.items() if n in collector.bundle]
+        delivered = [collector.first_variant[n] for n in submitted if n in collector.first_variant]
+        span = (max(delivered) - started) if delivered else 0.0
+
+        async with httpx.AsyncClient() as c:
+            server_stats = (await c.get(f"{base_url}/stats")).json()
+            server_metrics = (await c.get(f"{base_url}/metrics")).text
+            try:
+                bridge_metrics = (await c.get(f"http://127.0.0.1:{metrics_port}/metrics")).text
+            except httpx.HTTPError:
+                bridge_metrics = ""
+            provider_counts = (await c.get(f"http://127.0.0.1:{provider_port}/counts")).json()
+
+        expected_pushes = sum(1 for v in visitors if v["photo"])
+        return {
+            "config": vars(args),
+            "environment": {
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpus": os.cpu_count(),
+            },
+            "results": {
+                "visitors": args.visitors,
+                "submitted": len(submitted),
+                "delivered": len(delivered),
+                "errors": errors,
+                "rejected_busy": busy,
+                "duration_sec": round(finished - started, 1),
+                "throughput_per_min": round(len(delivered) / span * 60, 2) if span else 0.0,
+                "time_to_first_video_ms": summarize(ttfv),
+                "time_to_all_variants_ms": summarize(ttav),
+                "submit_ms": summarize(submit_ms),
+                "upload_ms": summarize(upload_ms),
+                "upload_to_kiosk_push_ms": summarize(push_ms),
+                "kiosk_pushes": {
+                    "expected": expected_pushes,
+                    "received": len(push_ms),
+                    "lost": expected_pushes - len(push_ms),
+                },
+                "server_broadcast": server_stats.get("broadcast", {}),
+                "server_groups": server_stats.get("groups", {}),
+                "server_rss_mb": {
+                    "start": round(rss["server"][0], 1) if rss["server"] else None,
+                    "peak": round(max(rss["server"]), 1) if rss["server"] else None,
+                    "end": round(rss["server"][-1], 1) if rss["server"] else None,
+                },
+                "bridge_rss_mb": {"peak": round(max(rss["bridge"]), 1) if rss["bridge"] else None},
+                "server_stages": parse_histogram(server_metrics, "karma_server_stage_seconds", "stage"),
+                "bridge_stages": parse_histogram(bridge_metrics, "karma_stage_seconds", "stage"),
+                "provider_calls": provider_counts,
+                "osc_messages": collector.messages,
+                "osc_duplicates": collector.duplicates,
+            },
+        }
+    finally:
+        for k in kiosks:
+            try:
+                await k.close()
+            except Exception:
+                pass
+        for proc in (bridge, server):
+            if proc is not None and proc.poll() is None:
+                proc.terminate()
+                try:
+                    proc.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+        server_log.close()
+        bridge_log.close()
+        osc_transport.close()
+        provider.should_exit = True
+        await provider_task
+
+
+def compare(result: dict, baseline: dict, tolerance: float) -> list:
+    """スループットと最初の動画までの p95 が、前回より tolerance 以上悪くなっていないか"""
+    now, before = result["results"], baseline["results"]
+    regressions = []
+    if now["throughput_per_min"] < before["throughput_per_min"] * (1 - tolerance):
+        regressions.append(f"throughput_per_min {before['throughput_per_min']} -> {now['throughput_per_min']}")
+    for key in ("time_to_first_video_ms", "upload_to_kiosk_push_ms"):
+        a, b = before[key].get("p95"), now[key].get("p95")
+        if a and b and b > a * (1 + tolerance):
+            regressions.append(f"{key}.p95 {a} -> {b}")
+    if now["delivered"] < before["delivered"]:
+        regressions.append(f"delivered {before['delivered']} -> {now['delivered']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--kiosks", type=int, default=4)
+    parser.add_argument("--visitors", type=int, default=20)
+    parser.add_argument("--rate", type=float, default=20.0, help="1分あたりの来場者数")
+    parser.add_argument("--photo-ratio", type=float, default=0.5, help="スマホ写真を送る来場者の割合")
+    parser.add_argument("--photo-px", default="3024x4032")
+    parser.add_argument("--workers", type=int, default=2, help="bridge.py のワーカー数 (KARMA_WORKERS)")
+    parser.add_argument("--cache-mode", default="off", choices=("off", "seed", "exact"))
+    parser.add_argument("--drain-timeout", type=float, default=300.0)
+    parser.add_argument("--out")
+    parser.add_argument("--baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    mock_providers.add_arguments(parser)
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    if args.baseline:
+        with open(args.baseline) as f:
+            result["regressions"] = compare(result, json.load(f), args.tolerance)
+    text = json.dumps(result, indent=2, sort_keys=True, ensure_ascii=False)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+    print(text)
+    if result.get("regressions"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
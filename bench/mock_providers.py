@@ -0,0 +1,201 @@
+"""負荷試験用の OpenAI (GPT-4o / DALL-E 3) と fal.ai (fast-svd) の代役サーバー
+
+本物のAPIキーもネットワークも使わずに bridge.py を最後まで動かすためのもの。
+各エンドポイントは決まった遅延（+ 乱数のゆらぎ。seed 固定で再現できる）を入れて返す。
+fal は同時に生成できる数 (--fal-slots) を超えると待ち行列に並ぶ。
+
+    python bench/mock_providers.py --port 8901 --gpt-ms 1500 --dalle-ms 8000 --fal-ms 30000
+
+bench/load.py から起動する時は create_app() を直接使う。
+"""
+import argparse
+import asyncio
+import io
+import itertools
+import json
+import random
+import re
+import time
+import uuid
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+class Latency:
+    """平均 ms と、±jitter の割合で遅延を作る"""
+
+    def __init__(self, mean_ms: float, jitter: float, rng: random.Random):
+        self.mean_ms = mean_ms
+        self.jitter = jitter
+        self.rng = rng
+
+    def seconds(self) -> float:
+        spread = self.mean_ms * self.jitter
+        return max(0.0, self.rng.uniform(self.mean_ms - spread, self.mean_ms + spread)) / 1000
+
+
+def _sample_image(size=(1024, 1792)) -> bytes:
+    # DALL-E 3 の縦長出力と同じ大きさ。単色だと軽すぎるのでグラデーションにする
+    buf = io.BytesIO()
+    if Image is None:
+        return b"\xff\xd8\xff\xd9"
+    Image.linear_gradient("L").resize(size).convert("RGB").save(buf, "JPEG", quality=90)
+    return buf.getvalue()
+
+
+def create_app(gpt_ms=1500.0, dalle_ms=8000.0, fal_ms=30000.0, fal_slots=4,
+               jitter=0.2, video_kb=2048, seed=0) -> FastAPI:
+    rng = random.Random(seed)
+    gpt = Latency(gpt_ms, jitter, rng)
+    dalle = Latency(dalle_ms, jitter, rng)
+    fal = Latency(fal_ms, jitter, rng)
+    fal_semaphore = asyncio.Semaphore(fal_slots)
+    image_bytes = _sample_image()
+    video_bytes = bytes(rng.getrandbits(8) for _ in range(video_kb * 1024))
+    uploads = {}
+    requests = {}
+    counter = itertools.count(1)
+
+    app = FastAPI()
+    app.state.counts = {"chat": 0, "images": 0, "fal_uploads": 0, "fal_submits": 0, "fal_cancels": 0}
+
+    # --- OpenAI ---
+    @app.post("/v1/chat/completions")
+    async def chat(request: Request):
+        app.state.counts["chat"] += 1
+        body = await request.json()
+        text = ""
+        for message in body.get("messages", []):
+            content = message.get("content")
+            if isinstance(content, list):
+                content = " ".join(part.get("text", "") for part in content if part.get("type") == "text")
+            text += content or ""
+        # 負荷試験側が OSC の出力と突き合わせられるよう、ニックネームをメッセージに入れて返す
+        match = re.search(r"Name:(\S+?),", text)
+        nickname = match.group(1) if match else "anonymous"
+        await asyncio.sleep(gpt.seconds())
+        variants = [
+            {
+                "variant_id": vid,
+                "visual_impression": f"Vertical test scene {vid}, no text, no people",
+                "emotion_valance": 0.0,
+                "emotion_arousal": 0.5,
+                "karma_color": "#EAF2FF",
+                "poetic_message": f"{nickname} の光",
+                "location": f"Test Location {vid}",
+                "style_mode": style,
+            }
+            for vid, style in (("A", "Abstract generative"), ("B", "Hyper-realistic photography"))
+        ]
+        return {
+            "id": f"chatcmpl-{next(counter)}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "gpt-4o"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": json.dumps({"variants": variants}, ensure_ascii=False)},
+                "finish_reason": "stop",
+            }],
+        }
+
+    @app.post("/v1/images/generations")
+    async def images(request: Request):
+        app.state.counts["images"] += 1
+        await asyncio.sleep(dalle.seconds())
+        return {"created": int(time.time()), "data": [{"url": f"{request.base_url}files/image.jpg"}]}
+
+    # --- fal.ai ---
+    @app.post("/fal/upload")
+    async def fal_upload(request: Request):
+        app.state.counts["fal_uploads"] += 1
+        upload_id = uuid.uuid4().hex
+        uploads[upload_id] = await request.body()
+        return {"url": f"{request.base_url}files/upload/{upload_id}"}
+
+    async def _run(request_id: str):
+        state = requests[request_id]
+        async with fal_semaphore:
+            state["status"] = "IN_PROGRESS"
+            await asyncio.sleep(fal.seconds())
+        state["status"] = "COMPLETED"
+
+    @app.post("/fal/queue/{app_id:path}")
+    async def fal_submit(app_id: str, request: Request):
+        app.state.counts["fal_submits"] += 1
+        request_id = uuid.uuid4().hex
+        requests[request_id] = {"status": "IN_QUEUE", "submitted": time.time(), "arguments": await request.json()}
+        requests[request_id]["task"] = asyncio.create_task(_run(request_id))
+        return {"request_id": request_id}
+
+    @app.get("/fal/requests/{request_id}/status")
+    async def fal_status(request_id: str):
+        state = requests.get(request_id)
+        if state is None:
+            return JSONResponse({"detail": "not found"}, status_code=404)
+        queued = sum(1 for s in requests.values() if s["status"] == "IN_QUEUE" and s["submitted"] < state["submitted"])
+        return {"status": state["status"], "queue_position": queued}
+
+    @app.get("/fal/requests/{request_id}")
+    async def fal_result(request_id: str, request: Request):
+        state = requests.get(request_id)
+        if state is None or state["status"] != "COMPLETED":
+            return JSONResponse({"detail": "not ready"}, status_code=400)
+        return {"video": {"url": f"{request.base_url}files/video.mp4"}}
+
+    @app.put("/fal/requests/{request_id}/cancel")
+    async def fal_cancel(request_id: str):
+        state = requests.get(request_id)
+        if state is not None and state["status"] != "COMPLETED":
+            app.state.counts["fal_cancels"] += 1
+            state["task"].cancel()
+            state["status"] = "CANCELLED"
+        return {"status": "ok"}
+
+    # --- ダウンロード ---
+    @app.get("/files/image.jpg")
+    async def get_image():
+        return Response(image_bytes, media_type="image/jpeg")
+
+    @app.get("/files/video.mp4")
+    async def get_video():
+        return Response(video_bytes, media_type="video/mp4")
+
+    @app.get("/files/upload/{upload_id}")
+    async def get_upload(upload_id: str):
+        return Response(uploads.get(upload_id, b""), media_type="image/jpeg")
+
+    @app.get("/counts")
+    async def counts():
+        return app.state.counts
+
+    return app
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--gpt-ms", type=float, default=1500.0)
+    parser.add_argument("--dalle-ms", type=float, default=8000.0)
+    parser.add_argument("--fal-ms", type=float, default=30000.0)
+    parser.add_argument("--fal-slots", type=int, default=4)
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument("--video-kb", type=int, default=2048)
+    parser.add_argument("--seed", type=int, default=0)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8901)
+    add_arguments(parser)
+    args = parser.parse_args()
+    uvicorn.run(
+        create_app(args.gpt_ms, args.dalle_ms, args.fal_ms, args.fal_slots, args.jitter, args.video_kb, args.seed),
+        host="127.0.0.1", port=args.port, log_level="warning",
+    )
@@ -0,0 +1,117 @@
+"""静止判定しきい値 (KARMA_STATIC_THRESHOLD) の較正: 合成クリップの動き量スコアを測る
+
+    python bench/motion_threshold.py [--frames 25] [--fps 10]
+
+SVD の出力と同じ 576x1024 のクリップを H.264 で合成し、bridge.motion_score を当てる。
+「静止」側（静止画 + 粒状ノイズ・明るさのゆらぎ）は再生成すべきもの、
+「動き」側（ごく遅いズーム・パン・一部だけの動き）は再生成してはいけないもの。
+静止側の最大と動き側の最小の間にしきい値を置く。PyAV (pip install av) と secret.py が必要。
+結果は JSON で標準出力に出す。
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import av  # noqa: E402
+import numpy as np  # noqa: E402
+from PIL import Image  # noqa: E402
+
+import bridge  # noqa: E402
+
+WIDTH, HEIGHT = 576, 1024
+
+
+def make_base(rng) -> np.ndarray:
+    # DALL·E の絵に近い、なめらかな色の面と細かい模様が混ざった画像（余白付き。パン・ズーム用）
+    coarse = rng.integers(0, 255, (12, 8, 3), dtype=np.uint8)
+    im = np.asarray(Image.fromarray(coarse).resize((WIDTH + 128, HEIGHT + 128), Image.BICUBIC), dtype=np.float32)
+    fine = np.asarray(Image.fromarray(rng.integers(0, 255, (130, 80), dtype=np.uint8)).resize(
+        (WIDTH + 128, HEIGHT + 128), Image.BILINEAR), dtype=np.float32)
+    return np.clip(im * 0.8 + fine[..., None] * 0.2, 0, 255)
+
+
+def crop(base: np.ndarray, dx: float = 0.0, dy: float = 0.0, zoom: float = 1.0) -> np.ndarray:
+    h, w = HEIGHT / zoom, WIDTH / zoom
+    x0, y0 = 64 + dx + (WIDTH - w) / 2, 64 + dy + (HEIGHT - h) / 2
+    im = Image.fromarray(base.astype(np.uint8)).resize(
+        (WIDTH, HEIGHT), Image.BILINEAR, box=(x0, y0, x0 + w, y0 + h))
+    return np.asarray(im, dtype=np.float32)
+
+
+def scenarios(base: np.ndarray, frames: int, rng):
+    still = crop(base)
+
+    def grain(sigma):
+        return lambda i: still + rng.normal(0, sigma, still.shape)
+
+    def blob(i):
+        # 画面の一部（キャラクターの手や髪など）だけが動く
+        im = still.copy()
+        y, x = 400, 150 + i * 4
+        im[y:y + 90, x:x + 90] = im[y:y + 90, x:x + 90] * 0.4 + 150
+        return im
+
+    return {
+        "static": {
+            "still": lambda i: still,
+            "grain_sigma4": grain(4),
+            "grain_sigma8": grain(8),
+            "grain_sigma12": grain(12),
+            "flicker_2pct": lambda i: still * (1 + 0.02 * np.sin(i)),
+        },
+        "moving": {
+            "zoom_2pct_total": lambda i: crop(base, zoom=1 + 0.02 * i / (frames - 1)),
+            "zoom_5pct_total": lambda i: crop(base, zoom=1 + 0.05 * i / (frames - 1)),
+            "pan_0.5px": lambda i: crop(base, dx=0.5 * i),
+            "pan_2px": lambda i: crop(base, dx=2 * i),
+            "local_blob": blob,
+        },
+    }
+
+
+def encode(path: str, render, frames: int, fps: int):
+    with av.open(path, "w") as container:
+        stream = container.add_stream("h264", rate=fps)
+        stream.width, stream.height, stream.pix_fmt = WIDTH, HEIGHT, "yuv420p"
+        stream.options = {"crf": "23"}
+        for i in range(frames):
+            rgb = np.clip(render(i), 0, 255).astype(np.uint8)
+            for packet in stream.encode(av.VideoFrame.from_ndarray(rgb, format="rgb24")):
+                container.mux(packet)
+        for packet in stream.encode():
+            container.mux(packet)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--frames", type=int, default=25)
+    parser.add_argument("--fps", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    rng = np.random.default_rng(args.seed)
+    base = make_base(rng)
+    scores = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for kind, cases in scenarios(base, args.frames, rng).items():
+            scores[kind] = {}
+            for name, render in cases.items():
+                path = os.path.join(tmp, f"{name}.mp4")
+                encode(path, render, args.frames, args.fps)
+                scores[kind][name] = round(bridge.motion_score(path), 5)
+    static_max, moving_min = max(scores["static"].values()), min(scores["moving"].values())
+    print(json.dumps({
+        "config": vars(args),
+        "scores": scores,
+        "static_max": static_max,
+        "moving_min": moving_min,
+        "separable": static_max < moving_min,
+        "current_threshold": bridge.STATIC_THRESHOLD,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
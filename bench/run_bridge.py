@@ -0,0 +1,87 @@
+"""bridge.py を代役プロバイダー（bench/mock_providers.py）に向けて起動する
+
+    KARMA_BENCH_PROVIDER_URL=http://127.0.0.1:8901 python bench/run_bridge.py
+
+- secret.py の代わりにダミーのキーを使う（本物のキーを代役サーバーへ送らない）
+- OpenAI は OPENAI_BASE_URL で代役サーバーへ向ける
+- fal_client は接続先が https 固定なので、同じ形のメソッド (upload / submit / iter_events / get / cancel)
+  を持つ小さなクライアントに差し替え、代役サーバーの /fal/... を呼ぶ
+それ以外（キュー・キャッシュ・ダウンロード・OSC 送信）は bridge.py のまま動く。
+"""
+import asyncio
+import os
+import sys
+import types
+
+import fal_client
+import httpx
+
+PROVIDER_URL = os.environ.get("KARMA_BENCH_PROVIDER_URL", "http://127.0.0.1:8901").rstrip("/")
+os.environ["OPENAI_BASE_URL"] = PROVIDER_URL + "/v1"
+
+secret = types.ModuleType("secret")
+secret.OPENAI_KEY = "sk-bench"
+secret.FAL_KEY = "fal-bench"
+sys.modules["secret"] = secret
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bridge  # noqa: E402
+
+
+class BenchFalHandle:
+    def __init__(self, http: httpx.AsyncClient, request_id: str):
+        self.http = http
+        self.request_id = request_id
+
+    async def status(self):
+        res = await self.http.get(f"/fal/requests/{self.request_id}/status")
+        res.raise_for_status()
+        data = res.json()
+        if data["status"] == "IN_QUEUE":
+            return fal_client.Queued(position=data.get("queue_position", 0))
+        if data["status"] == "IN_PROGRESS":
+            return fal_client.InProgress(logs=None)
+        return fal_client.Completed(logs=None, metrics={})
+
+    async def iter_events(self, *, with_logs: bool = False, interval: float = 0.1):
+        while True:
+            status = await self.status()
+            yield status
+            if isinstance(status, fal_client.Completed):
+                break
+            await asyncio.sleep(interval)
+
+    async def get(self):
+        async for _ in self.iter_events():
+            pass
+        res = await self.http.get(f"/fal/requests/{self.request_id}")
+        res.raise_for_status()
+        return res.json()
+
+    async def cancel(self):
+        await self.http.put(f"/fal/requests/{self.request_id}/cancel")
+
+
+class BenchFalClient:
+    def __init__(self, base_url: str):
+        self.http = httpx.AsyncClient(base_url=base_url, timeout=30)
+
+    async def upload(self, data: bytes, content_type: str) -> str:
+        res = await self.http.post("/fal/upload", content=data, headers={"Content-Type": content_type})
+        res.raise_for_status()
+        return res.json()["url"]
+
+    async def submit(self, application: str, arguments: dict) -> BenchFalHandle:
+        res = await self.http.post(f"/fal/queue/{application}", json=arguments)
+        res.raise_for_status()
+        return BenchFalHandle(self.http, res.json()["request_id"])
+
+
+bridge.fal = BenchFalClient(PROVIDER_URL)
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(bridge.main())
+    except KeyboardInterrupt:
+        pass
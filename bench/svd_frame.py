@@ -0,0 +1,91 @@
+"""SVD入力フレーム作成の速度比較: Pillow（メモリ内, bridge.prepare_svd_frame）vs 旧 ffmpeg 経路
+
+    python bench/svd_frame.py [画像パス] [--runs 20]
+
+画像を省略すると DALL·E 3 の出力と同じ 1024x1792 のJPEGを合成して使う。
+bridge.py を import するので secret.py が必要。結果は JSON で標準出力に出す。
+"""
+import argparse
+import io
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bridge  # noqa: E402
+from PIL import Image, ImageDraw  # noqa: E402
+
+
+def make_sample(path: str):
+    # 単色だとJPEGが軽すぎるので、グラデーションと図形で情報量を持たせる
+    im = Image.linear_gradient("L").resize((1024, 1792)).convert("RGB")
+    draw = ImageDraw.Draw(im)
+    for i in range(0, 1024, 32):
+        draw.line((i, 0, 1024 - i, 1792), fill=(i % 255, 120, 255 - i % 255), width=3)
+    im.save(path, "JPEG", quality=95)
+
+
+def ffmpeg_frame(image_path: str) -> bytes:
+    # 旧実装: ffmpeg を起動してディスクに書き、読み戻す
+    fd, out_path = tempfile.mkstemp(suffix=".jpg")
+    os.close(fd)
+    try:
+        subprocess.run(
+            ["ffmpeg", "-y", "-i", image_path,
+             "-vf", "scale=576:1024:force_original_aspect_ratio=increase,crop=576:1024",
+             "-q:v", "2", out_path],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True,
+        )
+        with open(out_path, "rb") as f:
+            return f.read()
+    finally:
+        os.remove(out_path)
+
+
+def timeit(fn, image_path: str, runs: int):
+    times = []
+    out = b""
+    for _ in range(runs):
+        started = time.perf_counter()
+        out = fn(image_path)
+        times.append((time.perf_counter() - started) * 1000)
+    times.sort()
+    return {
+        "mean_ms": round(statistics.mean(times), 2),
+        "p50_ms": round(times[len(times) // 2], 2),
+        "p95_ms": round(times[min(len(times) - 1, int(len(times) * 0.95))], 2),
+        "bytes": len(out),
+        "size": list(Image.open(io.BytesIO(out)).size),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("image", nargs="?")
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        image_path = args.image
+        if not image_path:
+            image_path = os.path.join(tmp, "dalle_1024x1792.jpg")
+            make_sample(image_path)
+
+        result = {
+            "input": os.path.basename(image_path),
+            "input_size": list(Image.open(image_path).size),
+            "runs": args.runs,
+            "pillow": timeit(bridge.prepare_svd_frame, image_path, args.runs),
+            "ffmpeg": timeit(ffmpeg_frame, image_path, args.runs) if shutil.which("ffmpeg") else None,
+        }
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,34 @@
 import asyncio
+import contextvars
+import heapq
+import itertools
 import json
 import os
 import base64
+import hashlib
+import io
+import mimetypes
 import time
-import requests 
+import unicodedata
 import shutil
+import socket
 import subprocess
-from datetime import datetime
+import sqlite3
+from datetime import date, datetime, timedelta
 import traceback
 
+import httpx
 import websockets
-from pythonosc import udp_client
-from openai import OpenAI
+from pythonosc import slip
+from pythonosc.osc_bundle_builder import IMMEDIATELY, OscBundleBuilder
+from pythonosc.osc_message_builder import OscMessageBuilder
+from openai import AsyncOpenAI
 import fal_client
 
 # 秘密鍵の読み込み
 import secret
+from metrics import Counter, Gauge, Histogram
+import metrics
 
 # ==========================================
 # 設定エリア
@@ -23,20 +36,45 @@ import secret
 WEBSOCKET_URL = os.getenv("KARMA_URL", "wss://karmic-identity.onrender.com/ws")  # 本番
 # WEBSOCKET_URL = "ws://localhost:8765"                      # ★ローカル
 
+def _http_base_from_ws(url: str) -> str:
+    # wss://host/ws -> https://host
+    if url.startswith("wss://"):
+        url = "https://" + url[len("wss://"):]
+    elif url.startswith("ws://"):
+        url = "http://" + url[len("ws://"):]
+    if url.endswith("/ws"):
+        url = url[:-len("/ws")]
+    return url.rstrip("/")
+
+# 画像ブロブ (GET /blob/{id}) の取得先
+HTTP_BASE_URL = os.getenv("KARMA_HTTP_URL", _http_base_from_ws(WEBSOCKET_URL))
+
 # (フォルダがなければ自動生成されます)
 base_path = os.path.join(os.path.expanduser("~"), "Ryoshian", "System", "renderData")
 print(f"📌 base_path: {base_path}")
-IMAGE_DIR = os.path.join(base_path, "Karma_Images")
-VIDEO_DIR = os.path.join(base_path, "Karma_Videos")
-TEXT_DIR = os.path.join(base_path, "Karma_Texts")
-
-os.makedirs(IMAGE_DIR, exist_ok=True)
-os.makedirs(VIDEO_DIR, exist_ok=True)
-os.makedirs(TEXT_DIR, exist_ok=True)
+# 生成物は Karma_Assets/YYYYMMDD/job_000123/ にジョブ単位でまとめる（下の AssetStore）
+ASSET_DIR = os.path.join(base_path, "Karma_Assets")
+os.makedirs(ASSET_DIR, exist_ok=True)
 
 # TouchDesigner設定
-OSC_IP = "127.0.0.1"
-OSC_PORT = 9000
+OSC_IP = os.getenv("KARMA_OSC_HOST", "127.0.0.1")
+OSC_PORT = int(os.getenv("KARMA_OSC_PORT", "9000"))
+# 1 にすると、Variantが1本できた時点で /karma/variant/{idx} を先に送る（全部揃うのを待たない）
+OSC_STREAMING = os.getenv("KARMA_OSC_STREAMING", "0") == "1"
+# udp | tcp（tcp は OSC 1.1 の SLIP フレーム。TouchDesigner の OSC In DAT を TCP/SLIP にする）
+OSC_TRANSPORT = os.getenv("KARMA_OSC_TRANSPORT", "udp")
+OSC_TCP_TIMEOUT = float(os.getenv("KARMA_OSC_TCP_TIMEOUT", "3"))
+# UDP で同じバンドルを何回送るか（取りこぼし対策。TD側は /karma/seq で重複を捨てる）
+OSC_REPEAT = max(1, int(os.getenv("KARMA_OSC_REPEAT", "1")))
+# これ以下のバイト数なら poetic_message を OSC に直接載せる（長い時は JSON ファイルだけ）
+OSC_INLINE_TEXT = int(os.getenv("KARMA_OSC_INLINE_TEXT", "256"))
+# 旧形式（JSON 文字列の /karmic_data, /karmic_data/{idx}, /karmic_data_bundle）も送る。
+# 今の TouchDesigner パッチは旧形式を読んでいるので既定はオン。/karma/... へ移行し終えたら 0 にする
+OSC_LEGACY = os.getenv("KARMA_OSC_LEGACY", "1") == "1"
+
+# 生成の同時実行数（プロバイダーごと）
+IMAGE_CONCURRENCY = int(os.getenv("KARMA_IMAGE_CONCURRENCY", "2"))  # DALL-E 3
+VIDEO_CONCURRENCY = int(os.getenv("KARMA_VIDEO_CONCURRENCY", "2"))  # fal.ai SVD
 
 # ==========================================
 # システムプロンプト (美大指定仕様)
@@ -145,38 +183,984 @@ SYSTEM_PROMPT = """
 """
 
 print(f"Bridge System Starting (v9.0 - Ryoshian New Form Edition)...")
-print(f"📂 画像保存先: {IMAGE_DIR}")
-print(f"📂 動画保存先: {VIDEO_DIR}")
-print(f"📂 テキスト保存先: {TEXT_DIR}")
+print(f"📂 保存先: {ASSET_DIR}")
 
-# クライアント初期化
-client = OpenAI(api_key=secret.OPENAI_KEY)
+# 各プロバイダー呼び出しのタイムアウト（秒）
+CHAT_TIMEOUT = float(os.getenv("KARMA_CHAT_TIMEOUT", "120"))
+IMAGE_TIMEOUT = float(os.getenv("KARMA_IMAGE_TIMEOUT", "180"))
+VIDEO_TIMEOUT = float(os.getenv("KARMA_VIDEO_TIMEOUT", "600"))
+
+# クライアント初期化（すべて非同期クライアント。スレッドを使わずに多数のジョブを同時に待てる）
+client = AsyncOpenAI(api_key=secret.OPENAI_KEY)
 os.environ["FAL_KEY"] = secret.FAL_KEY
-osc_client = udp_client.SimpleUDPClient(OSC_IP, OSC_PORT)
+fal = fal_client.AsyncClient(key=secret.FAL_KEY)
+
+# ==========================================
+# 優先レーン（数字が小さいほど先）
+# 来場者の送信 → 再送で届いた送信（再接続・割り当て直し） → ウォームプールの補充。
+# ジョブキューの取り出し順と、DALL-E / SVD の同時実行枠の順番待ちの両方に使う
+# ==========================================
+LANE_LIVE, LANE_REPLAY, LANE_WARM = 0, 1, 2
+LANE_NAMES = {LANE_LIVE: "live", LANE_REPLAY: "replay", LANE_WARM: "warm"}
+# 今のタスクのレーン。ワーカーがジョブごとに設定し、そこから作ったタスクにも引き継がれる
+current_lane = contextvars.ContextVar("karma_lane", default=LANE_LIVE)
+
+class PrioritySemaphore:
+    """asyncio.Semaphore と同じ使い方で、空きを待つ順番を current_lane → 到着順にしたもの"""
+
+    def __init__(self, value: int):
+        self._value = value
+        self._waiters = []  # (レーン, 到着順, future) のヒープ
+        self._order = itertools.count()
+
+    async def acquire(self):
+        if self._value > 0 and not self._waiters:
+            self._value -= 1
+            return True
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (current_lane.get(), next(self._order), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # 枠を渡された直後にキャンセルされたら、次の人へ回す
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+        return True
+
+    def release(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(True)
+                return
+        self._value += 1
+
+    def waiting(self) -> int:
+        return sum(1 for _, _, f in self._waiters if not f.done())
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, *exc):
+        self.release()
+
+image_semaphore = PrioritySemaphore(IMAGE_CONCURRENCY)
+video_semaphore = PrioritySemaphore(VIDEO_CONCURRENCY)
+
+# ==========================================
+# メトリクス（http://KARMA_METRICS_HOST:KARMA_METRICS_PORT/metrics, Prometheus 形式。ポート0で無効）
+# GPT / DALL-E / fal の待ち行列 / ダウンロード / フレーム処理のどこで遅いかをステージ別に見る
+# ==========================================
+METRICS_HOST = os.getenv("KARMA_METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("KARMA_METRICS_PORT", "9464"))
+
+STAGE_SECONDS = Histogram("karma_stage_seconds", "生成パイプラインのステージごとの所要時間（秒）", ("stage",))
+JOB_SECONDS = Histogram("karma_job_seconds", "ジョブの処理時間（秒）", ("state",))
+JOB_WAIT_SECONDS = Histogram("karma_job_wait_seconds", "ジョブが処理開始までに待った時間（秒）", ("lane",))
+JOBS_TOTAL = Counter("karma_jobs_total", "終わったジョブの数", ("state",))
+STATIC_RETRIES = Counter("karma_static_video_retries_total", "静止画っぽい動画を作り直した回数")
+
+# ==========================================
+# ジョブキュー (SQLite)
+# 受信ループはジョブを積むだけにして、生成はワーカーが順に取り出して行う。
+# ブリッジが落ちても再起動時に途中のジョブから再開できる
+# ==========================================
+JOB_DB_PATH = os.getenv("KARMA_JOB_DB", os.path.join(base_path, "karma_jobs.sqlite3"))
+WORKER_COUNT = int(os.getenv("KARMA_WORKERS", "1"))
+JOB_MAX_ATTEMPTS = int(os.getenv("KARMA_JOB_MAX_ATTEMPTS", "3"))
+# ブリッジを複数台つなぐ時は同じグループに入り、サーバーに送信を1件ずつ振り分けてもらう（空で全件受信）。
+# worker_id は再起動しても変わらない値にする（切断中の担当分を、戻ってきた時に引き継ぐため）
+WORKER_GROUP = os.getenv("KARMA_GROUP", "bridges")
+WORKER_ID = os.getenv(
+    "KARMA_WORKER_ID",
+    f"{socket.gethostname()}-{hashlib.sha256(os.path.abspath(JOB_DB_PATH).encode()).hexdigest()[:8]}",
+)
+
+JOB_QUEUED = "queued"
+JOB_GENERATING_IMAGE = "generating_image"
+JOB_GENERATING_VIDEO = "generating_video"
+JOB_DELIVERED = "delivered"
+JOB_FAILED = "failed"
+
+class Job:
+    def __init__(self, row):
+        self.id = row["id"]
+        self.payload = json.loads(row["payload"])
+        self.analysis = json.loads(row["analysis"]) if row["analysis"] else None
+        self.outputs = json.loads(row["outputs"]) if row["outputs"] else []
+        self.attempts = row["attempts"]
+        self.priority = row["priority"]
+        self.created_at = row["created_at"]
+        # 投稿ログ用の所要時間（秒）
+        self.timings = {}
+
+class JobQueue:
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                state TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                analysis TEXT,
+                outputs TEXT,
+                error TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                priority INTEGER NOT NULL DEFAULT 0,
+                source_epoch TEXT,
+                source_seq INTEGER,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                updated_at REAL NOT NULL,
+                finished_at REAL
+            )
+        """)
+        # 旧スキーマのDBには列を足す
+        columns = {row["name"] for row in self.db.execute("PRAGMA table_info(jobs)")}
+        for name, decl in (("source_epoch", "TEXT"), ("source_seq", "INTEGER"),
+                           ("priority", "INTEGER NOT NULL DEFAULT 0")):
+            if name not in columns:
+                self.db.execute(f"ALTER TABLE jobs ADD COLUMN {name} {decl}")
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_lane ON jobs (state, priority, id)")
+        # サーバーの (epoch, seq) が同じ送信は1回しか積まない（再送・重複で二重生成しない）
+        self.db.execute("CREATE UNIQUE INDEX IF NOT EXISTS jobs_source ON jobs (source_epoch, source_seq)")
+        self._wakeup = asyncio.Event()
+
+    def recover(self) -> int:
+        # 生成途中で止まったジョブを待ち行列に戻す
+        now = time.time()
+        cur = self.db.execute(
+            "UPDATE jobs SET state = ?, updated_at = ? WHERE state IN (?, ?)",
+            (JOB_QUEUED, now, JOB_GENERATING_IMAGE, JOB_GENERATING_VIDEO),
+        )
+        return cur.rowcount
+
+    def enqueue(self, payload, priority: int = LANE_LIVE):
+        """ジョブを積んで id を返す。同じ (epoch, seq) が既にあれば None"""
+        now = time.time()
+        cur = self.db.execute(
+            "INSERT OR IGNORE INTO jobs (state, payload, priority, source_epoch, source_seq, created_at, updated_at)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (JOB_QUEUED, json.dumps(payload, ensure_ascii=False), priority,
+             payload.get("epoch"), payload.get("seq"), now, now),
+        )
+        if cur.rowcount == 0:
+            return None
+        self._wakeup.set()
+        return cur.lastrowid
+
+    def active_jobs_for_session(self, session_id: str, exclude: int):
+        rows = self.db.execute(
+            "SELECT id FROM jobs WHERE json_extract(payload, '$.session_id') = ? AND id != ? AND state IN (?, ?, ?)",
+            (session_id, exclude, JOB_QUEUED, JOB_GENERATING_IMAGE, JOB_GENERATING_VIDEO),
+        ).fetchall()
+        return [row["id"] for row in rows]
+
+    def active_job_ids(self):
+        rows = self.db.execute(
+            "SELECT id FROM jobs WHERE state IN (?, ?, ?)", (JOB_QUEUED, JOB_GENERATING_IMAGE, JOB_GENERATING_VIDEO)
+        ).fetchall()
+        return {row["id"] for row in rows}
+
+    def active_sources(self):
+        """まだ終わっていない送信の (epoch, seq)。グループ参加時にサーバーへ伝える"""
+        rows = self.db.execute(
+            "SELECT source_epoch, source_seq FROM jobs WHERE source_seq IS NOT NULL AND state IN (?, ?, ?)",
+            (JOB_QUEUED, JOB_GENERATING_IMAGE, JOB_GENERATING_VIDEO),
+        ).fetchall()
+        return [[row["source_epoch"], row["source_seq"]] for row in rows]
+
+    def revoke(self, epoch: str, seq: int):
+        """サーバーが他のブリッジへ割り当て直した送信を取り消す。取り消したジョブの id を返す"""
+        row = self.db.execute(
+            "SELECT id FROM jobs WHERE source_epoch = ? AND source_seq = ? AND state IN (?, ?, ?)",
+            (epoch, seq, JOB_QUEUED, JOB_GENERATING_IMAGE, JOB_GENERATING_VIDEO),
+        ).fetchone()
+        if row is None:
+            return None
+        self.set_state(row["id"], JOB_FAILED, error="reassigned")
+        return row["id"]
+
+    def restore(self, payload, priority: int = LANE_LIVE):
+        """取り消した送信がまたこちらに割り当てられたら、待ち行列に戻して id を返す。それ以外は None"""
+        row = self.db.execute(
+            "SELECT id FROM jobs WHERE source_epoch = ? AND source_seq = ? AND state = ? AND error = ?",
+            (payload.get("epoch"), payload.get("seq"), JOB_FAILED, "reassigned"),
+        ).fetchone()
+        if row is None:
+            return None
+        self.db.execute(
+            "UPDATE jobs SET state = ?, error = NULL, priority = ?, finished_at = NULL, updated_at = ? WHERE id = ?",
+            (JOB_QUEUED, priority, time.time(), row["id"]),
+        )
+        self._wakeup.set()
+        return row["id"]
+
+    def state_of(self, job_id: int):
+        row = self.db.execute("SELECT state FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return row["state"] if row else None
+
+    def last_ack(self):
+        # 最後に受け付けた送信の (epoch, seq)。再接続時にサーバーへ伝える
+        row = self.db.execute(
+            "SELECT source_epoch FROM jobs WHERE source_seq IS NOT NULL ORDER BY id DESC LIMIT 1"
+        ).fetchone()
+        if row is None:
+            return None, 0
+        epoch = row["source_epoch"]
+        seq = self.db.execute(
+            "SELECT MAX(source_seq) FROM jobs WHERE source_epoch = ?", (epoch,)
+        ).fetchone()[0]
+        return epoch, seq or 0
+
+    def claim(self):
+        # レーン順、同じレーンの中では古い順
+        row = self.db.execute(
+            "SELECT * FROM jobs WHERE state = ? ORDER BY priority, id LIMIT 1", (JOB_QUEUED,)
+        ).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        self.db.execute(
+            "UPDATE jobs SET state = ?, attempts = attempts + 1, started_at = ?, updated_at = ? WHERE id = ?",
+            (JOB_GENERATING_IMAGE, now, now, row["id"]),
+        )
+        job = Job(row)
+        job.attempts += 1
+        return job
+
+    async def next_job(self) -> Job:
+        while True:
+            job = self.claim()
+            if job is not None:
+                return job
+            self._wakeup.clear()
+            await self._wakeup.wait()
+
+    def set_state(self, job_id: int, state: str, error: str = None):
+        now = time.time()
+        finished = now if state in (JOB_DELIVERED, JOB_FAILED) else None
+        self.db.execute(
+            "UPDATE jobs SET state = ?, error = COALESCE(?, error), updated_at = ?, finished_at = COALESCE(?, finished_at) WHERE id = ?",
+            (state, error, now, finished, job_id),
+        )
+
+    def error_of(self, job_id: int):
+        row = self.db.execute("SELECT error FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return row["error"] if row else None
+
+    def save_analysis(self, job_id: int, variants):
+        self.db.execute(
+            "UPDATE jobs SET analysis = ?, updated_at = ? WHERE id = ?",
+            (json.dumps(variants, ensure_ascii=False), time.time(), job_id),
+        )
+
+    def save_outputs(self, job_id: int, outputs):
+        self.db.execute(
+            "UPDATE jobs SET outputs = ?, updated_at = ? WHERE id = ?",
+            (json.dumps(outputs, ensure_ascii=False), time.time(), job_id),
+        )
+
+    def popular_payloads(self, limit: int = 500):
+        """直近 limit 件の送信をバケット別に数え、(件数, そのバケットの最新の送信) を多い順に返す"""
+        rows = self.db.execute(
+            """
+            SELECT COUNT(*) AS n, MAX(id) AS last_id FROM (SELECT * FROM jobs ORDER BY id DESC LIMIT ?)
+            GROUP BY json_extract(payload, '$.adolescence.approach'),
+                     json_extract(payload, '$.adolescence.environment_place'),
+                     json_extract(payload, '$.afterlife.heading'),
+                     json_extract(payload, '$.afterlife.returning')
+            ORDER BY n DESC
+            """,
+            (limit,),
+        ).fetchall()
+        result = []
+        for row in rows:
+            payload = self.db.execute("SELECT payload FROM jobs WHERE id = ?", (row["last_id"],)).fetchone()[0]
+            result.append((row["n"], json.loads(payload)))
+        return result
+
+    def stats(self) -> dict:
+        counts = {state: n for state, n in self.db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state")}
+        oldest = self.db.execute(
+            "SELECT MIN(created_at) FROM jobs WHERE state = ?", (JOB_QUEUED,)
+        ).fetchone()[0]
+        lanes = self.db.execute(
+            "SELECT priority, COUNT(*) FROM jobs WHERE state = ? GROUP BY priority", (JOB_QUEUED,)
+        ).fetchall()
+        return {
+            "depth": counts.get(JOB_QUEUED, 0),
+            "depth_by_lane": {LANE_NAMES.get(p, str(p)): n for p, n in lanes},
+            "in_progress": counts.get(JOB_GENERATING_IMAGE, 0) + counts.get(JOB_GENERATING_VIDEO, 0),
+            "delivered": counts.get(JOB_DELIVERED, 0),
+            "failed": counts.get(JOB_FAILED, 0),
+            "oldest_wait_sec": round(time.time() - oldest, 1) if oldest else 0.0,
+        }
+
+job_queue = JobQueue(JOB_DB_PATH)
+
+# ==========================================
+# GPT解析結果キャッシュ (SQLite)
+# 同じ回答（+同じ画像）ならGPT-4oを呼ばずに前回の解析結果を使う。
+#   KARMA_CACHE_MODE=exact ... 解析結果も、出来ている動画もそのまま再利用（待ち時間ゼロ）
+#   KARMA_CACHE_MODE=seed  ... 解析結果だけ再利用し、画像/動画は新しく生成する
+#   KARMA_CACHE_MODE=off   ... 使わない
+# ==========================================
+CACHE_DB_PATH = os.getenv("KARMA_CACHE_DB", os.path.join(base_path, "karma_cache.sqlite3"))
+CACHE_MODE = os.getenv("KARMA_CACHE_MODE", "seed")
+CACHE_TTL = float(os.getenv("KARMA_CACHE_TTL", str(7 * 24 * 3600)))
+CACHE_MAX_ENTRIES = int(os.getenv("KARMA_CACHE_MAX", "500"))
+
+# キーに含める回答（ニックネームはスタイル/ロケーションの規則に関係しないので含めない）
+CACHE_KEY_FIELDS = {
+    "identity": ("age", "color"),
+    "conditions": ("time", "weather", "season"),
+    "adolescence": ("approach", "environment_place", "environment_sound", "environment_sense", "scent"),
+    "adulthood": ("destination", "wish_direction", "drive"),
+    "philosophy": ("causality", "compassion", "impermanence", "life_death"),
+    "afterlife": ("heading", "returning"),
+    "legacy": ("keep", "likes", "avoids"),
+}
+
+def _normalize_answer(value):
+    if isinstance(value, str):
+        return " ".join(unicodedata.normalize("NFKC", value).lower().split())
+    return value
+
+class AnalysisCache:
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS analysis_cache (
+                key TEXT PRIMARY KEY,
+                variants TEXT NOT NULL,
+                outputs TEXT,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL
+            )
+        """)
+        self.hits = 0
+        self.misses = 0
+        # 同じキーの解析が進行中なら、その結果を待つ（ボタン連打対策）
+        self._inflight = {}
+
+    @staticmethod
+    def key_for(data, image_bytes: bytes = b"") -> str:
+        answers = {
+            section: {k: _normalize_answer((data.get(section) or {}).get(k)) for k in keys}
+            for section, keys in CACHE_KEY_FIELDS.items()
+        }
+        if image_bytes:
+            answers["image_sha256"] = hashlib.sha256(image_bytes).hexdigest()
+        canonical = json.dumps(answers, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        row = self.db.execute(
+            "SELECT * FROM analysis_cache WHERE key = ? AND created_at >= ?", (key, time.time() - CACHE_TTL)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.db.execute("UPDATE analysis_cache SET last_used = ? WHERE key = ?", (time.time(), key))
+        return {
+            "variants": json.loads(row["variants"]),
+            "outputs": json.loads(row["outputs"]) if row["outputs"] else [],
+        }
+
+    def put(self, key: str, variants):
+        now = time.time()
+        self.db.execute(
+            "INSERT OR REPLACE INTO analysis_cache (key, variants, outputs, created_at, last_used) VALUES (?, ?, NULL, ?, ?)",
+            (key, json.dumps(variants, ensure_ascii=False), now, now),
+        )
+        self._prune()
+
+    def save_outputs(self, key: str, outputs):
+        self.db.execute(
+            "UPDATE analysis_cache SET outputs = ? WHERE key = ?", (json.dumps(outputs, ensure_ascii=False), key)
+        )
+
+    def _prune(self):
+        self.db.execute("DELETE FROM analysis_cache WHERE created_at < ?", (time.time() - CACHE_TTL,))
+        self.db.execute(
+            "DELETE FROM analysis_cache WHERE key NOT IN (SELECT key FROM analysis_cache ORDER BY last_used DESC LIMIT ?)",
+            (CACHE_MAX_ENTRIES,),
+        )
+
+    async def analyze(self, key: str, messages):
+        """キャッシュ → 進行中の同一解析 → GPT の順に探して (variants, outputs) を返す"""
+        cached = self.get(key)
+        if cached is not None:
+            print(f"⚡ 解析キャッシュ命中（命中率 {self.hit_rate():.0%}）")
+            return cached["variants"], cached["outputs"]
+        if key in self._inflight:
+            print("⚡ 同じ回答の解析結果を待ちます")
+            variants = await asyncio.shield(self._inflight[key])
+            if variants is not None:
+                # 進行中の解析に相乗りできた → 命中扱い
+                self.misses -= 1
+                self.hits += 1
+                return json.loads(json.dumps(variants)), []
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            variants, from_gpt = await analyze_answers(messages)
+            if from_gpt:
+                self.put(key, variants)
+            future.set_result(json.loads(json.dumps(variants)) if from_gpt else None)
+            return variants, []
+        finally:
+            # 失敗・キャンセル時は、待っている側が自分で解析し直す
+            if not future.done():
+                future.set_result(None)
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": round(self.hit_rate(), 3)}
+
+analysis_cache = AnalysisCache(CACHE_DB_PATH)
+
+# ==========================================
+# ウォームプール（事前生成した画像/動画のストック）
+# 待ちが無い時間に、よく出る回答バケットの作品を先に作っておく。
+# 来場者のバケットが一致したらすぐTDへ送り、本人用の生成が終わったら差し替える
+#   KARMA_WARM_POOL_SIZE     ... ストック数（0で無効）
+#   KARMA_WARM_REFILL_INTERVAL ... 補充の間隔（秒）
+#   KARMA_WARM_DISK_MB       ... ストックが使ってよいディスク容量
+# ==========================================
+WARM_POOL_SIZE = int(os.getenv("KARMA_WARM_POOL_SIZE", "0"))
+WARM_REFILL_INTERVAL = float(os.getenv("KARMA_WARM_REFILL_INTERVAL", "300"))
+WARM_DISK_BYTES = int(float(os.getenv("KARMA_WARM_DISK_MB", "2048")) * 1024 * 1024)
+WARM_DIR = os.path.join(base_path, "Karma_WarmPool")
+
+# スタイル(approach)とロケーション(environment_place / heading / returning)を決める回答
+WARM_BUCKET_FIELDS = (
+    ("adolescence", "approach"),
+    ("adolescence", "environment_place"),
+    ("afterlife", "heading"),
+    ("afterlife", "returning"),
+)
+
+def warm_bucket(data) -> str:
+    return "_".join(str((data.get(section) or {}).get(key, "")) for section, key in WARM_BUCKET_FIELDS)
+
+def _asset_paths(outputs):
+    for out in outputs:
+        for key in ("video_path", "image_path"):
+            path = out.get(key)
+            if path and path != "none":
+                yield key, path
+
+class WarmPool:
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS warm_pool (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                bucket TEXT NOT NULL,
+                outputs TEXT NOT NULL,
+                bytes INTEGER NOT NULL,
+                created_at REAL NOT NULL
+            )
+        """)
+        self.db.execute("CREATE INDEX IF NOT EXISTS warm_pool_bucket ON warm_pool (bucket, id)")
+        if WARM_POOL_SIZE > 0:
+            os.makedirs(WARM_DIR, exist_ok=True)
+
+    def size(self) -> int:
+        return self.db.execute("SELECT COUNT(*) FROM warm_pool").fetchone()[0]
+
+    def disk_bytes(self) -> int:
+        return self.db.execute("SELECT COALESCE(SUM(bytes), 0) FROM warm_pool").fetchone()[0]
+
+    def counts(self) -> dict:
+        return {b: n for b, n in self.db.execute("SELECT bucket, COUNT(*) FROM warm_pool GROUP BY bucket")}
+
+    def add(self, bucket: str, outputs) -> int:
+        # 生成物をストック用フォルダへ移す
+        total = 0
+        for out in outputs:
+            for key, path in list(_asset_paths([out])):
+                dest = os.path.join(WARM_DIR, os.path.basename(path))
+                shutil.move(path, dest)
+                out[key] = os.path.abspath(dest)
+                total += os.path.getsize(dest)
+        cur = self.db.execute(
+            "INSERT INTO warm_pool (bucket, outputs, bytes, created_at) VALUES (?, ?, ?, ?)",
+            (bucket, json.dumps(outputs, ensure_ascii=False), total, time.time()),
+        )
+        self._enforce_budget()
+        return cur.lastrowid
+
+    def take(self, bucket: str, dest_dir: str):
+        """バケットが一致するストックを1つ取り出す（dest_dir へ移して返す）"""
+        row = self.db.execute(
+            "SELECT * FROM warm_pool WHERE bucket = ? ORDER BY id LIMIT 1", (bucket,)
+        ).fetchone()
+        if row is None:
+            return None
+        self.db.execute("DELETE FROM warm_pool WHERE id = ?", (row["id"],))
+        outputs = json.loads(row["outputs"])
+        if not all(os.path.exists(path) for _, path in _asset_paths(outputs)):
+            return None
+        for out in outputs:
+            for key, path in list(_asset_paths([out])):
+                dest = os.path.join(dest_dir, os.path.basename(path))
+                shutil.move(path, dest)
+                out[key] = os.path.abspath(dest)
+            out["pooled"] = True
+        return outputs
+
+    def _enforce_budget(self):
+        # 容量オーバーなら古いストックから捨てる
+        while self.disk_bytes() > WARM_DISK_BYTES:
+            row = self.db.execute("SELECT * FROM warm_pool ORDER BY id LIMIT 1").fetchone()
+            if row is None:
+                break
+            self.db.execute("DELETE FROM warm_pool WHERE id = ?", (row["id"],))
+            for _, path in _asset_paths(json.loads(row["outputs"])):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def stats(self) -> dict:
+        return {"size": self.size(), "disk_mb": round(self.disk_bytes() / 1024 / 1024, 1)}
+
+warm_pool = WarmPool(CACHE_DB_PATH)
+
+# ==========================================
+# 生成物の保存（日付/ジョブごとに分けて、容量を管理する）
+#   Karma_Assets/YYYYMMDD/job_000123/ に、そのジョブのスマホ画像・生成画像・動画・入力ログと
+#   どのファイルがどのVariantかを書いた manifest.json をまとめて置く。
+#   容量が KARMA_STORAGE_QUOTA_GB を超えたら、TDへ最後に送ったのが古いジョブから消す
+#   （KARMA_STORAGE_MAX_AGE_DAYS を決めれば、それより古いものも消す）。
+#   TDが表示中かもしれない直近 KARMA_STORAGE_PIN_RECENT 件と、処理中のジョブは消さない
+# ==========================================
+STORAGE_QUOTA_BYTES = int(float(os.getenv("KARMA_STORAGE_QUOTA_GB", "50")) * 1024 ** 3)
+STORAGE_MAX_AGE = float(os.getenv("KARMA_STORAGE_MAX_AGE_DAYS", "0")) * 24 * 3600
+STORAGE_PIN_RECENT = int(os.getenv("KARMA_STORAGE_PIN_RECENT", "20"))
+
+def atomic_write(path: str, data):
+    """一時ファイルに書いてからリネームする（TDが書きかけを読まない）"""
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    tmp_path = path + ".part"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def _dir_bytes(path: str) -> int:
+    total = 0
+    for entry in os.scandir(path):
+        if entry.is_file():
+            total += entry.stat().st_size
+    return total
+
+class AssetStore:
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS assets (
+                dir TEXT PRIMARY KEY,
+                job_id INTEGER,
+                bytes INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                last_sent REAL
+            )
+        """)
+
+    def job_dir(self, job=None) -> str:
+        if job is None:
+            # ウォームプール補充など、ジョブに属さない生成物（後でストックへ移される）
+            path = os.path.join(ASSET_DIR, datetime.now().strftime("%Y%m%d"), "nojob")
+        else:
+            day = datetime.fromtimestamp(job.created_at).strftime("%Y%m%d")
+            path = os.path.join(ASSET_DIR, day, f"job_{job.id:06d}")
+            self.db.execute(
+                "INSERT OR IGNORE INTO assets (dir, job_id, created_at) VALUES (?, ?, ?)", (path, job.id, time.time())
+            )
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def manifest(self, job) -> dict:
+        path = os.path.join(self.job_dir(job), "manifest.json")
+        try:
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {
+                "job_id": job.id,
+                "session_id": job.payload.get("session_id"),
+                "nickname": (job.payload.get("identity") or {}).get("nickname"),
+                "created_at": job.created_at,
+                "files": [],
+            }
+
+    def _save_manifest(self, job, manifest):
+        job_dir = self.job_dir(job)
+        atomic_write(os.path.join(job_dir, "manifest.json"), json.dumps(manifest, ensure_ascii=False, indent=2))
+        self.db.execute("UPDATE assets SET bytes = ? WHERE dir = ?", (_dir_bytes(job_dir), job_dir))
+
+    def record(self, job, role: str, path: str, variant=None):
+        """ジョブのフォルダに置いたファイルを manifest.json に書き足す"""
+        if job is None or path in (None, "none") or not os.path.exists(path):
+            return
+        job_dir = self.job_dir(job)
+        manifest = self.manifest(job)
+        name = os.path.relpath(path, job_dir) if os.path.dirname(path) == job_dir else path
+        # 同じファイルを書き直した時（OSC の JSON を再送した時など）は1件のまま
+        manifest["files"] = [f for f in manifest["files"] if (f["role"], f["variant"], f["name"]) != (role, variant, name)]
+        manifest["files"].append({"role": role, "variant": variant, "name": name, "bytes": os.path.getsize(path)})
+        self._save_manifest(job, manifest)
+
+    def finish(self, job, state: str):
+        manifest = self.manifest(job)
+        manifest["state"] = state
+        manifest["finished_at"] = time.time()
+        self._save_manifest(job, manifest)
+
+    def touch(self, outputs):
+        """TDへ送った生成物のジョブを「最近使った」にする"""
+        now = time.time()
+        dirs = {os.path.dirname(path) for _, path in _asset_paths(outputs)}
+        self.db.executemany("UPDATE assets SET last_sent = ? WHERE dir = ?", [(now, d) for d in dirs])
+
+    def total_bytes(self) -> int:
+        return self.db.execute("SELECT COALESCE(SUM(bytes), 0) FROM assets").fetchone()[0]
+
+    def evict(self, keep_job_ids=()) -> int:
+        """容量オーバー/期限切れのジョブフォルダを、TDで使われたのが古い順に消す"""
+        rows = self.db.execute(
+            "SELECT * FROM assets ORDER BY COALESCE(last_sent, created_at) DESC"
+        ).fetchall()
+        total = sum(row["bytes"] for row in rows)
+        now = time.time()
+        removed = 0
+        # 直近 STORAGE_PIN_RECENT 件はTDが表示中かもしれないので残す
+        for row in reversed(rows[STORAGE_PIN_RECENT:]):
+            expired = STORAGE_MAX_AGE > 0 and now - row["created_at"] > STORAGE_MAX_AGE
+            if total <= STORAGE_QUOTA_BYTES and not expired:
+                continue
+            if row["job_id"] in keep_job_ids:
+                continue
+            shutil.rmtree(row["dir"], ignore_errors=True)
+            self.db.execute("DELETE FROM assets WHERE dir = ?", (row["dir"],))
+            total -= row["bytes"]
+            removed += 1
+            # 空になった日付フォルダも片付ける
+            try:
+                os.rmdir(os.path.dirname(row["dir"]))
+            except OSError:
+                pass
+        return removed
+
+    def stats(self) -> dict:
+        count = self.db.execute("SELECT COUNT(*) FROM assets").fetchone()[0]
+        return {"jobs": count, "disk_mb": round(self.total_bytes() / 1024 / 1024, 1)}
+
+assets = AssetStore(JOB_DB_PATH)
+
+# ==========================================
+# 投稿ログ (JSONL, 追記のみ)
+# 1ジョブ1行で、回答・できたVariant・所要時間・保存先を Karma_Logs/submissions_YYYYMMDD.jsonl に書く。
+# 書き込みはバッファしておき、KARMA_LOG_FSYNC_INTERVAL 秒ごとにまとめて fsync する。
+#   「土曜の作品を全部」   submission_log.query(date(2026, 10, 17))
+#   「スタイル別の平均生成時間」 submission_log.mean_generation_time("style_mode")
+# ==========================================
+LOG_DIR = os.path.join(base_path, "Karma_Logs")
+LOG_FSYNC_INTERVAL = float(os.getenv("KARMA_LOG_FSYNC_INTERVAL", "2"))
+
+# ログに残さない送信項目（画像本体や配信用の番号）
+LOG_OMIT_FIELDS = ("image_data", "epoch", "seq", "type")
+
+class SubmissionLog:
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self._files = {}
+        self._dirty = False
+
+    def _file_for(self, day: str):
+        if day not in self._files:
+            # 日をまたいだジョブもあるので、開いておくのは直近2日分まで
+            for old in sorted(self._files)[:-1]:
+                f = self._files.pop(old)
+                f.flush()
+                os.fsync(f.fileno())
+                f.close()
+            self._files[day] = open(os.path.join(self.path, f"submissions_{day}.jsonl"), "a", encoding="utf-8")
+        return self._files[day]
+
+    def append(self, record: dict):
+        day = datetime.fromtimestamp(record["received_at"]).strftime("%Y%m%d")
+        f = self._file_for(day)
+        f.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+        self._dirty = True
+
+    def flush(self):
+        if not self._dirty:
+            return
+        for f in self._files.values():
+            f.flush()
+            os.fsync(f.fileno())
+        self._dirty = False
+
+    async def flush_loop(self):
+        while True:
+            await asyncio.sleep(LOG_FSYNC_INTERVAL)
+            try:
+                self.flush()
+            except OSError as e:
+                print(f"⚠️ 投稿ログ書き込みエラー: {e}")
+
+    def close(self):
+        self.flush()
+        for f in self._files.values():
+            f.close()
+        self._files.clear()
+
+    def query(self, start=None, end=None, **match):
+        """受付日時が [start, end) の記録を順に返す（start だけなら、その日1日分）。
+        match はトップレベルの項目で絞り込む（state="delivered" など）"""
+        self.flush()
+        if isinstance(start, date) and not isinstance(start, datetime):
+            start = datetime.combine(start, datetime.min.time())
+            end = end or start + timedelta(days=1)
+        if isinstance(end, date) and not isinstance(end, datetime):
+            end = datetime.combine(end, datetime.min.time())
+        for name in sorted(os.listdir(self.path)):
+            if not (name.startswith("submissions_") and name.endswith(".jsonl")):
+                continue
+            # 対象外の日のファイルは開かない
+            day = datetime.strptime(name[len("submissions_"):-len(".jsonl")], "%Y%m%d")
+            if (start and day + timedelta(days=1) <= start) or (end and day >= end):
+                continue
+            with open(os.path.join(self.path, name), encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # 書きかけの最終行
+                    received = datetime.fromtimestamp(record["received_at"])
+                    if (start and received < start) or (end and received >= end):
+                        continue
+                    if all(record.get(k) == v for k, v in match.items()):
+                        yield record
+
+    def mean_generation_time(self, by: str = "style_mode", start=None, end=None) -> dict:
+        """Variantの項目（style_mode など）ごとの平均生成時間（秒）"""
+        totals = {}
+        for record in self.query(start, end):
+            for v in record.get("variants", []):
+                if v.get("render_sec") is None:
+                    continue
+                n, total = totals.get(v.get(by), (0, 0.0))
+                totals[v.get(by)] = (n + 1, total + v["render_sec"])
+        return {key: round(total / n, 2) for key, (n, total) in totals.items()}
+
+def submission_record(job, state: str, error: str = None) -> dict:
+    return {
+        "job_id": job.id,
+        "session_id": job.payload.get("session_id"),
+        "state": state,
+        "error": error,
+        "received_at": job.created_at,
+        "finished_at": time.time(),
+        **job.timings,
+        "answers": {k: v for k, v in job.payload.items() if k not in LOG_OMIT_FIELDS},
+        "variants": [
+            {
+                key: out.get(key)
+                for key in ("variant_id", "style_mode", "location", "poetic_message", "karma_color",
+                            "motion_score", "render_sec", "image_path", "video_path", "pooled")
+            }
+            for out in (job.outputs or job.analysis or [])
+        ],
+        "asset_dir": assets.job_dir(job),
+    }
+
+submission_log = SubmissionLog(LOG_DIR)
+
+Gauge("karma_job_queue_depth", "待っているジョブ数", fn=lambda: job_queue.stats()["depth"])
+Gauge("karma_jobs_in_progress", "生成中のジョブ数", fn=lambda: job_queue.stats()["in_progress"])
+Gauge("karma_image_slot_waiters", "DALL-E の同時実行枠を待っているタスク数", fn=lambda: image_semaphore.waiting())
+Gauge("karma_video_slot_waiters", "SVD の同時実行枠を待っているタスク数", fn=lambda: video_semaphore.waiting())
+Counter("karma_analysis_cache_hits_total", "解析キャッシュの命中数", fn=lambda: analysis_cache.hits)
+Counter("karma_analysis_cache_misses_total", "解析キャッシュの外れ数", fn=lambda: analysis_cache.misses)
+Counter("karma_fal_upload_cache_hits_total", "fal へのアップロードを省略できた数", fn=lambda: fal_uploads.hits)
+Gauge("karma_warm_pool_size", "ウォームプールのストック数", fn=lambda: warm_pool.size())
+Gauge("karma_asset_bytes", "生成物フォルダの使用量（バイト）", fn=lambda: assets.total_bytes())
+
+# ==========================================
+# 共通ダウンローダー
+# 1つのセッションで接続を使い回し（keep-alive）、タイムアウトと再試行を付けて
+# 一時ファイルへチャンク単位で書き出し、最後にリネームする（TDが書きかけを読まない）
+# ==========================================
+DOWNLOAD_CONNECT_TIMEOUT = float(os.getenv("KARMA_DOWNLOAD_CONNECT_TIMEOUT", "10"))
+DOWNLOAD_READ_TIMEOUT = float(os.getenv("KARMA_DOWNLOAD_READ_TIMEOUT", "60"))
+DOWNLOAD_RETRIES = int(os.getenv("KARMA_DOWNLOAD_RETRIES", "3"))
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+
+http_client = httpx.AsyncClient(
+    timeout=httpx.Timeout(DOWNLOAD_READ_TIMEOUT, connect=DOWNLOAD_CONNECT_TIMEOUT),
+    limits=httpx.Limits(max_connections=16, max_keepalive_connections=8),
+    follow_redirects=True,
+)
+
+def _retryable(e: Exception) -> bool:
+    if isinstance(e, httpx.HTTPStatusError):
+        status = e.response.status_code
+        return status == 429 or status >= 500
+    return isinstance(e, httpx.TransportError)
+
+async def download_to(url: str, save_path: str) -> str:
+    tmp_path = save_path + ".part"
+    for attempt in range(DOWNLOAD_RETRIES + 1):
+        started = time.perf_counter()
+        ttfb = None
+        size = 0
+        try:
+            async with http_client.stream("GET", url) as res:
+                res.raise_for_status()
+                with open(tmp_path, "wb") as f:
+                    async for chunk in res.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                        if ttfb is None:
+                            ttfb = time.perf_counter() - started
+                        f.write(chunk)
+                        size += len(chunk)
+            os.replace(tmp_path, save_path)
+        except BaseException as e:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            if not isinstance(e, Exception) or attempt >= DOWNLOAD_RETRIES or not _retryable(e):
+                raise
+            wait = 0.5 * (2 ** attempt)
+            print(f"   ⚠️ ダウンロード失敗（{wait:.1f}秒後に再試行 {attempt + 1}/{DOWNLOAD_RETRIES}）: {e}")
+            await asyncio.sleep(wait)
+            continue
+        elapsed = max(time.perf_counter() - started, 1e-6)
+        print(f"   ⬇️ {os.path.basename(save_path)}: {size / 1024:.0f}KB, "
+              f"TTFB {(ttfb or elapsed) * 1000:.0f}ms, {size / elapsed / 1024 / 1024:.2f}MB/s")
+        return save_path
+
+# ==========================================
+# 0. スマホ画像の取得（サーバーのブロブストアから）
+# ==========================================
+async def fetch_blob(image_id: str) -> bytes:
+    res = await http_client.get(f"{HTTP_BASE_URL}/blob/{image_id}")
+    res.raise_for_status()
+    return res.content
+
+# ==========================================
+# Fal.ai アップロードキャッシュ（内容ハッシュ → URL）
+# 静止画リトライやスマホ画像のフォールバックで同じフレームを何度も送らない。
+# fal のURLが有効な間（KARMA_FAL_URL_TTL 秒）は再起動後も使い回す
+# ==========================================
+FAL_URL_TTL = float(os.getenv("KARMA_FAL_URL_TTL", str(24 * 3600)))
+
+class UploadCache:
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS fal_uploads (
+                sha256 TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                bytes INTEGER NOT NULL,
+                created_at REAL NOT NULL
+            )
+        """)
+        self.hits = 0
+        self.misses = 0
+        # 同じ内容のアップロードが進行中なら、そのURLを待つ
+        self._inflight = {}
+
+    def get(self, key: str):
+        row = self.db.execute(
+            "SELECT url FROM fal_uploads WHERE sha256 = ? AND created_at >= ?", (key, time.time() - FAL_URL_TTL)
+        ).fetchone()
+        return row["url"] if row else None
+
+    def forget(self, key: str):
+        self.db.execute("DELETE FROM fal_uploads WHERE sha256 = ?", (key,))
+
+    async def upload(self, data: bytes, content_type: str):
+        """(URL, 内容ハッシュ) を返す。キャッシュに無ければ fal へアップロードする"""
+        key = hashlib.sha256(data).hexdigest()
+        url = self.get(key)
+        if url is None and key in self._inflight:
+            url = await asyncio.shield(self._inflight[key])
+        if url is not None:
+            self.hits += 1
+            print("   - アップロード済みの画像を再利用")
+            return url, key
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            url = await fal.upload(data, content_type)
+            self.db.execute(
+                "INSERT OR REPLACE INTO fal_uploads (sha256, url, bytes, created_at) VALUES (?, ?, ?, ?)",
+                (key, url, len(data), time.time()),
+            )
+            self.db.execute("DELETE FROM fal_uploads WHERE created_at < ?", (time.time() - FAL_URL_TTL,))
+            future.set_result(url)
+            return url, key
+        finally:
+            # 失敗・キャンセル時は、待っている側が自分でアップロードし直す
+            if not future.done():
+                future.set_result(None)
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses}
+
+fal_uploads = UploadCache(CACHE_DB_PATH)
 
 # ==========================================
 # 1. DALL-E 3 画像生成
 # ==========================================
-def generate_base_image(prompt):
+async def generate_base_image(prompt, out_dir: str):
     print(f"🎨 [1/2] ベース画像を生成中 (DALL-E 3)...")
     # プロンプトに追加の安全策を結合
     safety_suffix = ", vertical composition, cinematic lighting, strong depth layers (foreground very close to lens, midground subject, distant background), wide-angle perspective (24mm), strong parallax, dynamic camera movement (slow dolly-in/out, tracking shot, subtle handheld drift), camera movement is the main motion (avoid relying only on subject motion), Leica-like filmic color science (subtle film grain, gentle highlight roll-off, rich blacks, micro-contrast, natural cinematic tones, avoid oversaturation), no text, no letters, no typography, no logo, no watermark, no subtitles, no people (or anonymous crowd silhouettes with no faces and no identifiable features only if absolutely necessary)"
     
     try:
-        response = client.images.generate(
-            model="dall-e-3",
-            prompt=prompt + safety_suffix,
-            size="1024x1792", 
-            quality="standard",
-            n=1,
-        )
+        with STAGE_SECONDS.time(stage="dalle"):
+            response = await asyncio.wait_for(
+                client.images.generate(
+                    model="dall-e-3",
+                    prompt=prompt + safety_suffix,
+                    size="1024x1792", 
+                    quality="standard",
+                    n=1,
+                ),
+                timeout=IMAGE_TIMEOUT,
+            )
         image_url = response.data[0].url
         
-        img_data = requests.get(image_url).content
         filename = f"gen_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}.jpg"
-        save_path = os.path.join(IMAGE_DIR, filename)
-        with open(save_path, 'wb') as f:
-            f.write(img_data)
+        save_path = os.path.join(out_dir, filename)
+        with STAGE_SECONDS.time(stage="image_download"):
+            await download_to(image_url, save_path)
             
         print(f"✅ 画像保存完了: {filename}")
         return os.path.abspath(save_path)
@@ -187,110 +1171,206 @@ def generate_base_image(prompt):
 # ==========================================
 # SVD用: 入力画像を 576x1024 に正規化（必要に応じて）
 # SVDは 576x1024 前提で学習されているため、ここで揃えるとクロップ/伸びが減りやすい
+# ffmpeg を起動したり一時ファイルを書いたりせず、Pillow でメモリ上だけで処理して
+# JPEG のバイト列を返す（そのまま fal へアップロードできる）
 # ==========================================
-def prepare_svd_frame(image_path: str) -> str:
-    try:
-        # 入力が既に 576x1024 ならそのまま
-        try:
-            from PIL import Image  # type: ignore
-            with Image.open(image_path) as im:
-                w, h = im.size
-                if (w, h) == (576, 1024):
-                    return image_path
-        except Exception:
-            # Pillow が無い/読めない場合は ffmpeg で試す
-            pass
+SVD_SIZE = (576, 1024)
 
-        out_path = os.path.join(IMAGE_DIR, f"svd_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}.jpg")
+try:
+    from PIL import Image  # type: ignore
+except ImportError:
+    Image = None
 
-        # ffmpeg が使えるならそれでスケール（一番安定）
-        if shutil.which("ffmpeg"):
-            # 9:16維持で 576x1024 へ（不足分はセンターで軽くトリムされる）
-            cmd = [
-                "ffmpeg", "-y", "-i", image_path,
-                "-vf", "scale=576:1024:force_original_aspect_ratio=increase,crop=576:1024",
-                "-q:v", "2",
-                out_path,
-            ]
-            subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
-            return os.path.abspath(out_path)
+def _read_bytes(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+def prepare_svd_frame(image_path: str) -> bytes:
+    if Image is None:
+        # Pillow が無い場合は元画像をそのまま使う
+        return _read_bytes(image_path)
 
-        # Pillow が使えるならそれでリサイズ
-        try:
-            from PIL import Image  # type: ignore
-            with Image.open(image_path) as im:
-                im = im.convert("RGB")
-                # まず高さを1024に合わせ、余った幅を中央トリム
-                scale = 1024 / im.size[1]
-                new_w = int(round(im.size[0] * scale))
-                im2 = im.resize((new_w, 1024))
-                if new_w > 576:
-                    left = (new_w - 576) // 2
-                    im2 = im2.crop((left, 0, left + 576, 1024))
-                elif new_w < 576:
-                    # 足りない分は左右に黒パッド（稀）
-                    pad = (576 - new_w) // 2
-                    canvas = Image.new("RGB", (576, 1024), (0, 0, 0))
-                    canvas.paste(im2, (pad, 0))
-                    im2 = canvas
-                im2.save(out_path, quality=95)
-                return os.path.abspath(out_path)
-        except Exception:
-            return image_path
-
-    except Exception:
-        return image_path
-
-# ==========================================
-# 静止画っぽい動画の簡易検出（ffmpeg がある場合のみ）
-# fps=2でフレームのmd5を取り、ユニーク数が少なければ「ほぼ静止」とみなす
-# ==========================================
-def looks_static_video(video_path: str) -> bool:
     try:
-        if not shutil.which("ffmpeg"):
-            return False
-
-        cmd = [
-            "ffmpeg", "-v", "error",
-            "-i", video_path,
-            "-vf", "fps=2",
-            "-f", "framemd5",
-            "-"
-        ]
-        p = subprocess.run(cmd, capture_output=True, text=True, check=True)
-        hashes = []
-        for line in p.stdout.splitlines():
-            if not line or line.startswith("#"):
+        with Image.open(image_path) as im:
+            # 入力が既に 576x1024 のJPEGならそのまま
+            if im.size == SVD_SIZE and im.format == "JPEG":
+                return _read_bytes(image_path)
+
+            # 縦横とも 576x1024 を覆う倍率（不足分はセンターで軽くトリム）
+            w, h = im.size
+            scale = max(SVD_SIZE[0] / w, SVD_SIZE[1] / h)
+            # JPEGは縮小デコード（1/2, 1/4, 1/8）で必要な大きさだけ読む
+            im.draft("RGB", (int(w * scale) + 1, int(h * scale) + 1))
+            im = im.convert("RGB")
+            w, h = im.size
+            scale = max(SVD_SIZE[0] / w, SVD_SIZE[1] / h)
+            crop_w, crop_h = SVD_SIZE[0] / scale, SVD_SIZE[1] / scale
+            left, top = (w - crop_w) / 2, (h - crop_h) / 2
+            # 縮小時の BILINEAR は倍率に合わせた三角フィルタなので折り返しは出ない。
+            # bench/svd_frame.py（1024x1792 JPEG, 1 CPU, 平均）: BILINEAR 33〜35ms、LANCZOS 46ms、旧 ffmpeg 経路 30〜31ms
+            frame = im.resize(
+                SVD_SIZE,
+                Image.Resampling.BILINEAR,
+                box=(left, top, left + crop_w, top + crop_h),
+                reducing_gap=3.0,
+            )
+
+        buf = io.BytesIO()
+        frame.save(buf, "JPEG", quality=95)
+        return buf.getvalue()
+    except Exception as e:
+        # 読めない画像（pillow_heif の無い環境の HEIC など）は元のまま渡し、整形は fal 側に任せる
+        print(f"⚠️ SVD用フレームの整形に失敗したため元画像を使います: {e}")
+        return _read_bytes(image_path)
+
+# ==========================================
+# 動画の動き量スコア（静止画っぽい動画の検出用）
+# 全フレームをデコードせず、数か所だけシークして小さなグレースケール画像を取り出し、
+# 隣り合うサンプル間の差 (0.0〜1.0) を NumPy でまとめて計算する。差の大きい上位 MOTION_TOP_FRACTION の
+# 画素だけを平均するので、一部だけ動く動画（手や髪だけなど）は高く、画面全体に散る粒状ノイズや
+# 明るさのゆらぎは低くなる（縮小でノイズ自体も平均化される）。
+# PyAV (pip install av。任意) か OpenCV があればプロセス内で取り出す。
+# どちらも無ければ ffmpeg を1回だけ起動し、縮小済みの全フレームから間引く（SVD の動画は数秒なので軽い）
+# ==========================================
+MOTION_SAMPLES = int(os.getenv("KARMA_MOTION_SAMPLES", "5"))
+MOTION_FRAME_WIDTH = 64
+MOTION_TOP_FRACTION = 0.05
+# これ未満なら「ほぼ静止」とみなして再生成する。bench/motion_threshold.py の合成クリップ
+# （576x1024, 25フレーム, H.264, seed 1〜3）で決めた値: 静止画 + 粒状ノイズ (σ≦12)・明るさのゆらぎは
+# 0.009 以下、合計2%のズーム・0.5px/フレームのパン・画面の1.4%だけの動きは 0.018 以上。
+# その間（幾何平均 ≈ 0.0127）より少し静止側に置き、誤判定（＝有料の再生成）を避ける
+STATIC_THRESHOLD = float(os.getenv("KARMA_STATIC_THRESHOLD", "0.012"))
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import av  # type: ignore  # 動き量スコア用（任意。pip install av。無ければ OpenCV → ffmpeg）
+except ImportError:
+    av = None
+
+try:
+    import cv2  # type: ignore
+except ImportError:
+    cv2 = None
+
+def _sample_frames_av(video_path: str, samples: int):
+    # SVD の動画はキーフレームが先頭の1枚だけなので、シークするたびに先頭からデコードし直しになる。
+    # 先頭から1回だけデコードし、目的の時刻に来たフレームだけ縮小して取り出す
+    with av.open(video_path) as container:
+        stream = container.streams.video[0]
+        stream.thread_type = "AUTO"
+        if not stream.duration or stream.time_base is None:
+            return []
+        duration = float(stream.duration * stream.time_base)
+        # 最終フレーム付近は欠けやすいので少し手前まで
+        targets = list(np.linspace(0, duration * 0.95, samples))
+        frames = []
+        for frame in container.decode(stream):
+            if frame.time is None or frame.time + 1e-3 < targets[0]:
                 continue
-            parts = line.strip().split(",")
-            if len(parts) >= 6:
-                md5 = parts[-1].strip()
-                if md5:
-                    hashes.append(md5)
-        if len(hashes) < 4:
-            return False
-        uniq = len(set(hashes))
-        # ほぼ全部同じなら静止画の可能性が高い
-        return uniq <= 2
-    except Exception:
-        return False
+            h = max(1, round(frame.height * MOTION_FRAME_WIDTH / frame.width))
+            frames.append(frame.to_ndarray(width=MOTION_FRAME_WIDTH, height=h, format="gray"))
+            while targets and frame.time + 1e-3 >= targets[0]:
+                targets.pop(0)
+            if not targets:
+                break
+        return frames
+
+def _sample_frames_cv2(video_path: str, samples: int):
+    cap = cv2.VideoCapture(video_path)
+    try:
+        count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        if count < 2:
+            return []
+        frames = []
+        for idx in np.linspace(0, count - 1, samples).astype(int):
+            cap.set(cv2.CAP_PROP_POS_FRAMES, int(idx))
+            ok, frame = cap.read()
+            if not ok:
+                continue
+            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            h = max(1, round(gray.shape[0] * MOTION_FRAME_WIDTH / gray.shape[1]))
+            frames.append(cv2.resize(gray, (MOTION_FRAME_WIDTH, h), interpolation=cv2.INTER_AREA))
+        return frames
+    finally:
+        cap.release()
+
+def _sample_frames_ffmpeg(video_path: str, samples: int):
+    if not shutil.which("ffmpeg"):
+        return []
+    # 1プロセスで全フレームを正方形のグレースケールに縮小して受け取り、均等に間引く
+    # （縦横比は崩れるが、隣り合うフレームの差を見るだけなので構わない）
+    size = MOTION_FRAME_WIDTH * MOTION_FRAME_WIDTH
+    p = subprocess.run(
+        ["ffmpeg", "-v", "error", "-i", video_path, "-an", "-sn",
+         "-vf", f"scale={MOTION_FRAME_WIDTH}:{MOTION_FRAME_WIDTH},format=gray", "-f", "rawvideo", "-"],
+        capture_output=True, check=True,
+    )
+    count = len(p.stdout) // size
+    if count < 2:
+        return []
+    stack = np.frombuffer(p.stdout, dtype=np.uint8)[:count * size].reshape(count, MOTION_FRAME_WIDTH, MOTION_FRAME_WIDTH)
+    return list(stack[np.unique(np.linspace(0, count - 1, samples).astype(int))])
+
+def motion_score(video_path: str):
+    """動き量スコア (0.0〜1.0)。判定できない時は None"""
+    if np is None:
+        return None
+    try:
+        if av is not None:
+            sampler = _sample_frames_av
+        elif cv2 is not None:
+            sampler = _sample_frames_cv2
+        else:
+            sampler = _sample_frames_ffmpeg
+        frames = sampler(video_path, MOTION_SAMPLES)
+        if len(frames) < 2 or any(f.shape != frames[0].shape for f in frames):
+            return None
+        stack = np.stack(frames).astype(np.float32)
+        diffs = np.abs(np.diff(stack, axis=0)).reshape(len(frames) - 1, -1) / 255.0
+        k = max(1, int(diffs.shape[1] * MOTION_TOP_FRACTION))
+        return float(np.partition(diffs, -k, axis=1)[:, -k:].mean())
+    except Exception as e:
+        print(f"⚠️ 動き量の計測に失敗: {e}")
+        return None
 
 # ==========================================
 # 2. Fal.ai 動画生成 (SVD)
 # ==========================================
-def generate_video(image_path, motion_bucket_id: int = 170, cond_aug: float = 0.05):
+async def fal_result(handler):
+    """結果を待つ。待ち行列にいた時間と、実際に生成していた時間を分けて記録する"""
+    submitted = time.perf_counter()
+    running = None
+    async for status in handler.iter_events(interval=0.5):
+        if running is None and not isinstance(status, fal_client.Queued):
+            running = time.perf_counter()
+            STAGE_SECONDS.observe(running - submitted, stage="fal_queue")
+    STAGE_SECONDS.observe(time.perf_counter() - (running or submitted), stage="fal_generate")
+    return await handler.get()
+
+async def generate_video(image_path, out_dir: str, motion_bucket_id: int = 170, cond_aug: float = 0.05, allow_retry: bool = True):
+    """(動画パス, 動き量スコア) を返す。失敗時は ("none", None)"""
     print(f"🎬 [2/2] 動画生成を開始します (Fal.ai)...")
-    
+    upload_key = None
+
     try:
         # SVDが得意な解像度(576x1024)に揃えると、上下/左右クロップのブレが減りやすい
-        image_path = prepare_svd_frame(image_path)
+        with STAGE_SECONDS.time(stage="svd_frame"):
+            frame = await asyncio.to_thread(prepare_svd_frame, image_path)
         # 画像アップロード
         print("   - 画像をアップロード中...")
-        url = fal_client.upload_file(image_path)
+        # 整形できずに元画像を渡す時は、元のファイルの種類で送る
+        content_type = "image/jpeg" if frame[:2] == b"\xff\xd8" else (
+            mimetypes.guess_type(image_path)[0] or "application/octet-stream")
+        with STAGE_SECONDS.time(stage="fal_upload"):
+            url, upload_key = await fal_uploads.upload(frame, content_type)
         
         # 生成リクエスト
         print("   - 生成リクエスト送信...")
-        handler = fal_client.submit(
+        handler = await fal.submit(
             "fal-ai/fast-svd",
             arguments={
                 "image_url": url,
@@ -299,185 +1379,72 @@ def generate_video(image_path, motion_bucket_id: int = 170, cond_aug: float = 0.
             }
         )
 
-        result = handler.get()
+        try:
+            result = await asyncio.wait_for(fal_result(handler), timeout=VIDEO_TIMEOUT)
+        except BaseException:
+            # タイムアウト/キャンセル時は fal 側のジョブも止める（無駄な課金を避ける）
+            try:
+                await handler.cancel()
+            except Exception:
+                pass
+            raise
         print(f"   - SVD params: motion_bucket_id={motion_bucket_id}, cond_aug={cond_aug}")
         
         if "video" in result and "url" in result["video"]:
             video_url = result["video"]["url"]
             print("✨ 生成完了！ ダウンロードします...")
             
-            vid_data = requests.get(video_url).content
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
-            save_path = os.path.join(VIDEO_DIR, f"video_{timestamp}.mp4")
-            
-            with open(save_path, 'wb') as f:
-                f.write(vid_data)
+            save_path = os.path.join(out_dir, f"video_{timestamp}.mp4")
+            with STAGE_SECONDS.time(stage="video_download"):
+                await download_to(video_url, save_path)
                 
             print(f"✅ 保存完了: {os.path.basename(save_path)}")
             saved = os.path.abspath(save_path)
 
+            with STAGE_SECONDS.time(stage="motion_score"):
+                score = await asyncio.to_thread(motion_score, saved)
+            if score is not None:
+                print(f"   - 動き量スコア: {score:.4f}（しきい値 {STATIC_THRESHOLD}）")
+
             # たまに静止画っぽい動画が出るので、カメラ移動を強めて1回だけ自動リトライ
-            if looks_static_video(saved):
+            if allow_retry and score is not None and score < STATIC_THRESHOLD:
+                STATIC_RETRIES.inc()
                 print("⚠️ 静止画っぽい動画を検出。カメラ移動を強めて再生成します...")
-                try:
-                    # 少し強めの設定（被写体運動ではなく画角移動を狙う）
-                    return generate_video(image_path, motion_bucket_id=220, cond_aug=min(cond_aug + 0.02, 0.08))
-                except Exception:
-                    return saved
-
-            return saved
+                # 少し強めの設定（被写体運動ではなく画角移動を狙う）
+                retried, retried_score = await generate_video(
+                    image_path, out_dir, motion_bucket_id=220, cond_aug=min(cond_aug + 0.02, 0.08), allow_retry=False
+                )
+                if retried != "none":
+                    return retried, retried_score
+
+            return saved, score
         else:
             print(f"❌ エラー: 結果異常 {result}")
-            return "none"
+            return "none", None
 
     except Exception as e:
         print(f"❌ 動画生成例外: {e}")
-        return "none"
+        # URLが失効していた可能性もあるので、次回は上げ直す
+        if upload_key:
+            fal_uploads.forget(upload_key)
+        return "none", None
 
 # ==========================================
-# メイン処理フロー
+# GPT-4o 解析（失敗時はフォールバックのVariantを返す）
+# 戻り値: (variants, GPTの結果かどうか)
 # ==========================================
-async def process_data(data):
-    # 新しいデータ構造に合わせて展開
-    identity = data.get('identity', {})
-    conditions = data.get('conditions', {})
-    adolescence = data.get('adolescence', {})
-    adulthood = data.get('adulthood', {})
-    philosophy = data.get('philosophy', {})
-    afterlife = data.get('afterlife', {})
-    legacy = data.get('legacy', {})
-
-    print("\n===================================")
-    print(f"👤 受信: {identity.get('nickname')} さんのデータ")
-
-    # --- 入力パラメータをテキストとして保存 ---
+async def analyze_answers(messages):
     try:
-        nickname = identity.get('nickname') or "anonymous"
-        # ファイル名に使えるよう簡易サニタイズ
-        nickname_safe = "".join(c for c in str(nickname) if c.isalnum() or c in "-_" )
-        if not nickname_safe:
-            nickname_safe = "anonymous"
-
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
-        text_filename = f"input_{timestamp}_{nickname_safe}.txt"
-        text_save_path = os.path.join(TEXT_DIR, text_filename)
-
-        # 画像データが巨大なのでログではサイズ情報に置換
-        data_for_log = dict(data)
-        if "image_data" in data_for_log and data_for_log["image_data"]:
-            data_for_log["image_data"] = f"<base64 image_data: {len(str(data_for_log['image_data']))} chars>"
-
-        summary_text = f"""Karma Portrait / Input Log
-Timestamp: {timestamp}
-Nickname: {nickname}
-
-[Identity]
-- nickname: {identity.get('nickname')}
-- age: {identity.get('age')}
-- color: {identity.get('color')}
-
-[Conditions]
-- time: {conditions.get('time')}
-- weather: {conditions.get('weather')}
-- season: {conditions.get('season')}
-
-[Adolescence]
-- approach: {adolescence.get('approach')}
-- place: {adolescence.get('environment_place')}
-- sound: {adolescence.get('environment_sound')}
-- sense: {adolescence.get('environment_sense')}
-- scent: {adolescence.get('scent')}
-
-[Adulthood]
-- destination: {adulthood.get('destination')}
-- wish: {adulthood.get('wish_direction')}
-- drive: {adulthood.get('drive')}
-
-[Philosophy]
-- causality: {philosophy.get('causality')}
-- compassion: {philosophy.get('compassion')}
-- impermanence: {philosophy.get('impermanence')}
-- life_death: {philosophy.get('life_death')}
-
-[Afterlife]
-- heading: {afterlife.get('heading')}
-- returning: {afterlife.get('returning')}
-
-[Legacy]
-- keep: {legacy.get('keep')}
-- likes: {legacy.get('likes')}
-- avoids: {legacy.get('avoids')}
-
-[Raw JSON (image_data omitted / summarized)]
-{json.dumps(data_for_log, ensure_ascii=False, indent=2)}
-"""
-
-        with open(text_save_path, "w", encoding="utf-8") as f:
-            f.write(summary_text)
-
-        print(f"📝 入力テキストを保存しました: {os.path.basename(text_save_path)}")
-    except Exception as e:
-        print(f"⚠️ 入力テキスト保存エラー: {e}")
-    # --- 保存ここまで ---
-
-    saved_image_path = "none"
-    has_user_image = False
-    user_image_path = "none"
-    
-    # スマホ画像処理（保存はするが、動画生成には直接使わずGPTのヒントにする）
-    if data.get("has_image") and data.get("image_data"):
-        try:
-            b64_str = data["image_data"]
-            if "base64," in b64_str: b64_str = b64_str.split("base64,")[1]
-            image_data = base64.b64decode(b64_str)
-            filename = f"user_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}.jpg"
-            saved_image_path = os.path.join(IMAGE_DIR, filename)
-            with open(saved_image_path, "wb") as f:
-                f.write(image_data)
-            saved_image_path = os.path.abspath(saved_image_path)
-            user_image_path = saved_image_path
-            has_user_image = True
-            print(f"📷 スマホ画像を保存しました (解析用)")
-        except Exception as e:
-            print(f"画像保存エラー: {e}")
-
-    print("🧠 GPT-4o 解析中...")
-    
-    # 新しいデータ構造でプロンプト作成
-    user_input_text = f"""
-    [Identity] Name:{identity.get('nickname')}, Age:{identity.get('age')}, Color:{identity.get('color')}
-    [Conditions] Time(0-3):{conditions.get('time')}, Weather(0-4):{conditions.get('weather')}, Season(0-3):{conditions.get('season')}
-    [Adolescence] Approach(0-4):{adolescence.get('approach')}, Place(0-4):{adolescence.get('environment_place')}, Sound(0-4):{adolescence.get('environment_sound')}, Sense(0-4):{adolescence.get('environment_sense')}, Scent(0-4):{adolescence.get('scent')}
-    [Adulthood] Dest:{adulthood.get('destination')}, Wish(0-2):{adulthood.get('wish_direction')}, Drive(0-4):{adulthood.get('drive')}
-    [Philosophy] Causal(0-4):{philosophy.get('causality')}, Compassion(0-4):{philosophy.get('compassion')}, Impermanence(0-4):{philosophy.get('impermanence')}, LifeDeath(0-1):{philosophy.get('life_death')}
-    [Afterlife] Heading(0-4):{afterlife.get('heading')}, Returning(0-2):{afterlife.get('returning')}
-    [Legacy] Keep:{legacy.get('keep')}, Likes:{legacy.get('likes')}, Avoids:{legacy.get('avoids')}
-    """
-    
-    messages = [{"role": "system", "content": SYSTEM_PROMPT}, {"role": "user", "content": user_input_text}]
-    
-    # 画像がある場合、GPTに視覚情報として渡す
-    if has_user_image:
-        image_b64 = data.get("image_data", "")
-        if "base64," in image_b64: image_b64 = image_b64.split("base64,", 1)[1]
-        
-        # Base64が極端に長くないか確認（エラー回避）
-        if len(image_b64) < 2000000:
-            messages[1]["content"] = [
-                {"type": "text", "text": user_input_text},
-                {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_b64}"}}
-            ]
-        else:
-            print("⚠️ 画像サイズ過大のため、テキストのみで解析します")
-
-    try:
-        response = await asyncio.to_thread(
-            lambda: client.chat.completions.create(
-                model="gpt-4o",
-                messages=messages,
-                response_format={"type": "json_object"}
+        with STAGE_SECONDS.time(stage="gpt"):
+            response = await asyncio.wait_for(
+                client.chat.completions.create(
+                    model="gpt-4o",
+                    messages=messages,
+                    response_format={"type": "json_object"}
+                ),
+                timeout=CHAT_TIMEOUT,
             )
-        )
 
         msg = response.choices[0].message
         content = getattr(msg, "content", None)
@@ -502,6 +1469,7 @@ Nickname: {nickname}
             vid = v.get("variant_id") or str(i)
             print(f"💬 ({vid}) メッセージ: {v.get('poetic_message')}")
             print(f"📍 ({vid}) ロケーション: {v.get('location')}")
+        from_gpt = True
 
     except Exception as e:
         print(f"⚠️ GPT解析エラー(フォールバックを使用): {e}")
@@ -531,45 +1499,479 @@ Nickname: {nickname}
             ]
         }
         variants = result_json["variants"]
+        from_gpt = False
 
-    # === 画像/動画生成フェーズ（2本） ===
-    outputs = []
-    for i, v in enumerate(variants):
-        vid = v.get("variant_id") or str(i)
-        prompt = v.get("visual_impression", "Vertical abstract spiritual landscape")
-        print(f"🎨 ({vid}) プロンプトからAI画像を生成します...")
-
-        video_input_path = await asyncio.to_thread(generate_base_image, prompt)
-
-        # 万が一AI画像生成に失敗し、スマホ画像がある場合のみバックアップとして使用
-        if video_input_path == "none" and has_user_image:
-            print(f"⚠️ ({vid}) AI生成失敗。バックアップとしてスマホ画像を使用します。")
-            video_input_path = user_image_path
-
-        if video_input_path != "none":
-            video_path = await asyncio.to_thread(generate_video, video_input_path)
-            v["video_path"] = video_path
-            v["variant_index"] = i
-            outputs.append(v)
+    return variants, from_gpt
+
+# ==========================================
+# Variant 1本ぶんの画像→動画生成
+# ==========================================
+async def render_variant(i, v, user_image_path="none", job=None):
+    vid = v.get("variant_id") or str(i)
+    started = time.perf_counter()
+    prompt = v.get("visual_impression", "Vertical abstract spiritual landscape")
+    print(f"🎨 ({vid}) プロンプトからAI画像を生成します...")
+
+    out_dir = assets.job_dir(job)
+    async with image_semaphore:
+        video_input_path = await generate_base_image(prompt, out_dir)
+    assets.record(job, "base_image", video_input_path, vid)
+
+    # 万が一AI画像生成に失敗し、スマホ画像がある場合のみバックアップとして使用
+    if video_input_path == "none" and user_image_path != "none":
+        print(f"⚠️ ({vid}) AI生成失敗。バックアップとしてスマホ画像を使用します。")
+        video_input_path = user_image_path
+
+    if video_input_path == "none":
+        print(f"❌ ({vid}) 画像生成に失敗したため、このVariantの処理をスキップします")
+        return None
+
+    if job is not None:
+        job_queue.set_state(job.id, JOB_GENERATING_VIDEO)
+    async with video_semaphore:
+        video_path, score = await generate_video(video_input_path, out_dir)
+    assets.record(job, "video", video_path, vid)
+    v["video_path"] = video_path
+    v["motion_score"] = round(score, 4) if score is not None else None
+    v["image_path"] = video_input_path
+    v["variant_index"] = i
+    v["render_sec"] = round(time.perf_counter() - started, 2)
+    STAGE_SECONDS.observe(time.perf_counter() - started, stage="render_variant")
+    return v
+
+# ==========================================
+# TouchDesignerへの送信（OSC）
+# ==========================================
+# Variant 1本ごとに OSC バンドルを1つ送る。中身は型付きの短いメッセージだけにして、
+# 長い日本語を含む Variant 全体の JSON はジョブフォルダに書き、そのパスを渡す（UDP の断片化・欠落を避ける）
+#   /karma/seq                 i seq  s boot_id  s kind ("variant" | "set")
+#   /karma/variant/{i}/id      s variant_id
+#   /karma/variant/{i}/emotion f valence  f arousal
+#   /karma/variant/{i}/color   f r  f g  f b  s "#RRGGBB"
+#   /karma/variant/{i}/video   s 動画のパス
+#   /karma/variant/{i}/image   s 画像のパス
+#   /karma/variant/{i}/motion  f motion_score（無ければ -1）
+#   /karma/variant/{i}/message s poetic_message（OSC_INLINE_TEXT バイト以下の時だけ）
+#   /karma/variant/{i}/json    s Variant 全体の JSON ファイルのパス
+#   /karma/variant/{i}/pooled  i 1 ならウォームプールからの先行分
+# 全Variantが揃ったら /karma/seq (kind="set") と /karma/set/count i, /karma/set/json s, /karma/set/pooled i。
+# TD 側は (boot_id, seq) が同じバンドルを2回目以降は捨てる（KARMA_OSC_REPEAT で同じものを複数回送るため）
+OSC_PACKETS = Counter("karma_osc_packets_total", "TouchDesignerへ送ったOSCパケット数", ("kind",))
+OSC_ERRORS = Counter("karma_osc_errors_total", "TouchDesignerへ送れなかったOSCパケット数")
+
+def _osc_message(address: str, *args):
+    builder = OscMessageBuilder(address)
+    for arg in args:
+        builder.add_arg(arg)
+    return builder.build()
+
+def _hex_rgb(value):
+    text = str(value or "").strip().lstrip("#")
+    if len(text) == 3:
+        text = "".join(c * 2 for c in text)
+    try:
+        return tuple(int(text[i:i + 2], 16) / 255 for i in (0, 2, 4))
+    except ValueError:
+        return (1.0, 1.0, 1.0)
+
+def _float(value, default: float = 0.0) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+class OscSender:
+    def __init__(self, host: str, port: int, transport: str = "udp"):
+        self.host = host
+        self.port = port
+        self.transport = transport if transport in ("udp", "tcp") else "udp"
+        # 再起動で seq が1に戻っても、TD側で前回の分と区別できるように
+        self.boot_id = os.urandom(4).hex()
+        self.seq = 0
+        self._udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) if self.transport == "udp" else None
+        self._writer = None
+        self._lock = asyncio.Lock()
+
+    def next_seq(self) -> int:
+        self.seq += 1
+        return self.seq
+
+    async def send(self, packet: bytes, kind: str = "variant"):
+        if self.transport == "udp":
+            try:
+                for _ in range(OSC_REPEAT):
+                    self._udp.sendto(packet, (self.host, self.port))
+            except OSError as e:
+                OSC_ERRORS.inc()
+                print(f"⚠️ OSC送信エラー: {e}")
+                return
         else:
-            print(f"❌ ({vid}) 画像生成に失敗したため、このVariantの処理をスキップします")
+            async with self._lock:
+                # 切れていたら1回だけつなぎ直す（TD が後から起動した時など）
+                for attempt in (0, 1):
+                    try:
+                        if self._writer is None:
+                            _, self._writer = await asyncio.wait_for(
+                                asyncio.open_connection(self.host, self.port), timeout=OSC_TCP_TIMEOUT
+                            )
+                        self._writer.write(slip.encode(packet))
+                        await asyncio.wait_for(self._writer.drain(), timeout=OSC_TCP_TIMEOUT)
+                        break
+                    except (OSError, asyncio.TimeoutError) as e:
+                        if self._writer is not None:
+                            self._writer.close()
+                        self._writer = None
+                        if attempt:
+                            OSC_ERRORS.inc()
+                            print(f"⚠️ OSC送信エラー (tcp {self.host}:{self.port}): {e}")
+                            return
+        OSC_PACKETS.inc(kind=kind)
+
+    async def send_bundle(self, messages, kind: str):
+        builder = OscBundleBuilder(IMMEDIATELY)
+        builder.add_content(_osc_message("/karma/seq", self.next_seq(), self.boot_id, kind))
+        for message in messages:
+            builder.add_content(message)
+        await self.send(builder.build().dgram, kind)
+
+    async def send_legacy(self, address: str, value):
+        await self.send(_osc_message(address, json.dumps(value, ensure_ascii=False)).dgram, "legacy")
+
+osc_out = OscSender(OSC_IP, OSC_PORT, OSC_TRANSPORT)
+
+def write_osc_json(job, name: str, value) -> str:
+    path = os.path.abspath(os.path.join(assets.job_dir(job), name))
+    atomic_write(path, json.dumps(value, ensure_ascii=False, indent=2).encode("utf-8"))
+    return path
+
+async def send_variant_osc(out, job=None, pooled: bool = False, legacy: bool = False):
+    idx = out.get("variant_index", 0)
+    json_path = write_osc_json(job, f"{'pooled_' if pooled else ''}variant_{idx}.json", out)
+    assets.record(job, "osc_json", json_path, out.get("variant_id"))
+    prefix = f"/karma/variant/{idx}"
+    r, g, b = _hex_rgb(out.get("karma_color"))
+    messages = [
+        _osc_message(f"{prefix}/id", str(out.get("variant_id") or "")),
+        _osc_message(f"{prefix}/emotion", _float(out.get("emotion_valance")), _float(out.get("emotion_arousal"))),
+        _osc_message(f"{prefix}/color", r, g, b, str(out.get("karma_color") or "")),
+        _osc_message(f"{prefix}/video", str(out.get("video_path") or "none")),
+        _osc_message(f"{prefix}/image", str(out.get("image_path") or "none")),
+        _osc_message(f"{prefix}/motion", _float(out.get("motion_score"), -1.0)),
+    ]
+    message = str(out.get("poetic_message") or "")
+    if len(message.encode("utf-8")) <= OSC_INLINE_TEXT:
+        messages.append(_osc_message(f"{prefix}/message", message))
+    messages.append(_osc_message(f"{prefix}/json", json_path))
+    messages.append(_osc_message(f"{prefix}/pooled", 1 if pooled else 0))
+    await osc_out.send_bundle(messages, "variant")
+    if OSC_LEGACY:
+        # 旧互換: 最初の1本は /karmic_data にも送る
+        if legacy:
+            await osc_out.send_legacy("/karmic_data", out)
+        await osc_out.send_legacy(f"/karmic_data/{idx}", out)
+
+async def send_set_osc(outputs, job=None, pooled: bool = False):
+    json_path = write_osc_json(job, f"{'pooled_' if pooled else ''}variants.json",
+                               {"variants": outputs, "pooled": pooled})
+    assets.record(job, "osc_json", json_path)
+    await osc_out.send_bundle([
+        _osc_message("/karma/set/count", len(outputs)),
+        _osc_message("/karma/set/json", json_path),
+        _osc_message("/karma/set/pooled", 1 if pooled else 0),
+    ], "set")
+    if OSC_LEGACY:
+        bundle = {"variants": outputs, "pooled": True} if pooled else {"variants": outputs}
+        await osc_out.send_legacy("/karmic_data_bundle", bundle)
 
-    # TouchDesignerへ送信（互換: 旧 /karmic_data はAを送る）
-    if outputs:
-        # 旧互換: 最初の1本を /karmic_data
-        osc_client.send_message("/karmic_data", json.dumps(outputs[0], ensure_ascii=False))
+# ==========================================
+# GPTへ渡す回答テキスト
+# ==========================================
+def build_user_input(data) -> str:
+    identity = data.get('identity', {})
+    conditions = data.get('conditions', {})
+    adolescence = data.get('adolescence', {})
+    adulthood = data.get('adulthood', {})
+    philosophy = data.get('philosophy', {})
+    afterlife = data.get('afterlife', {})
+    legacy = data.get('legacy', {})
+    return f"""
+    [Identity] Name:{identity.get('nickname')}, Age:{identity.get('age')}, Color:{identity.get('color')}
+    [Conditions] Time(0-3):{conditions.get('time')}, Weather(0-4):{conditions.get('weather')}, Season(0-3):{conditions.get('season')}
+    [Adolescence] Approach(0-4):{adolescence.get('approach')}, Place(0-4):{adolescence.get('environment_place')}, Sound(0-4):{adolescence.get('environment_sound')}, Sense(0-4):{adolescence.get('environment_sense')}, Scent(0-4):{adolescence.get('scent')}
+    [Adulthood] Dest:{adulthood.get('destination')}, Wish(0-2):{adulthood.get('wish_direction')}, Drive(0-4):{adulthood.get('drive')}
+    [Philosophy] Causal(0-4):{philosophy.get('causality')}, Compassion(0-4):{philosophy.get('compassion')}, Impermanence(0-4):{philosophy.get('impermanence')}, LifeDeath(0-1):{philosophy.get('life_death')}
+    [Afterlife] Heading(0-4):{afterlife.get('heading')}, Returning(0-2):{afterlife.get('returning')}
+    [Legacy] Keep:{legacy.get('keep')}, Likes:{legacy.get('likes')}, Avoids:{legacy.get('avoids')}
+    """
 
-        # 新: 2本を個別アドレスで送る
-        for out in outputs:
-            idx = out.get("variant_index", 0)
-            osc_client.send_message(f"/karmic_data/{idx}", json.dumps(out, ensure_ascii=False))
+# ==========================================
+# メイン処理フロー
+# ==========================================
+async def process_data(data, job=None):
+    identity = data.get('identity', {})
+
+    print("\n===================================")
+    print(f"👤 受信: {identity.get('nickname')} さんのデータ")
+
+    saved_image_path = "none"
+    has_user_image = False
+    user_image_path = "none"
+    
+    user_image_bytes = b""
+    
+    # スマホ画像処理（保存はするが、動画生成には直接使わずGPTのヒントにする）
+    if data.get("has_image") and (data.get("image_id") or data.get("image_data")):
+        try:
+            if data.get("image_id"):
+                with STAGE_SECONDS.time(stage="user_image_fetch"):
+                    image_data = await fetch_blob(data["image_id"])
+            else:
+                # 旧形式（base64埋め込み）
+                b64_str = data["image_data"]
+                if "base64," in b64_str: b64_str = b64_str.split("base64,")[1]
+                image_data = base64.b64decode(b64_str)
+            user_image_bytes = image_data
+            ext = ".webp" if data.get("image_content_type") == "image/webp" else ".jpg"
+            filename = f"user_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}{ext}"
+            saved_image_path = os.path.join(assets.job_dir(job), filename)
+            atomic_write(saved_image_path, image_data)
+            saved_image_path = os.path.abspath(saved_image_path)
+            assets.record(job, "user_image", saved_image_path)
+            user_image_path = saved_image_path
+            has_user_image = True
+            print(f"📷 スマホ画像を保存しました (解析用)")
+        except Exception as e:
+            print(f"画像保存エラー: {e}")
 
-        # 新: まとめて送る（必要ならTD側で利用）
-        osc_client.send_message("/karmic_data_bundle", json.dumps({"variants": outputs}, ensure_ascii=False))
+    # ウォームプールに同じバケットのストックがあれば、本人用が出来るまでの間それを先に流す
+    if WARM_POOL_SIZE > 0 and not (job is not None and job.outputs):
+        pooled = warm_pool.take(warm_bucket(data), assets.job_dir(job))
+        if pooled:
+            for out in pooled:
+                for key, path in _asset_paths([out]):
+                    assets.record(job, "pooled_" + key[:-len("_path")], path, out.get("variant_id"))
+            assets.touch(pooled)
+            for n, out in enumerate(pooled):
+                await send_variant_osc(out, job, pooled=True, legacy=(n == 0))
+            await send_set_osc(pooled, job, pooled=True)
+            print(f"🔥 ウォームプールから先行送信しました（bucket={warm_bucket(data)}）")
 
-        print("📡 TouchDesignerへデータを送信しました（/karmic_data, /karmic_data/0.., /karmic_data_bundle）")
+    print("🧠 GPT-4o 解析中...")
+    
+    # 新しいデータ構造でプロンプト作成
+    user_input_text = build_user_input(data)
+    
+    messages = [{"role": "system", "content": SYSTEM_PROMPT}, {"role": "user", "content": user_input_text}]
+    
+    # 画像がある場合、GPTに視覚情報として渡す
+    if has_user_image:
+        image_b64 = base64.b64encode(user_image_bytes).decode("utf-8")
+        image_mime = data.get("image_content_type") or "image/jpeg"
+        
+        # Base64が極端に長くないか確認（エラー回避）
+        if len(image_b64) < 2000000:
+            messages[1]["content"] = [
+                {"type": "text", "text": user_input_text},
+                {"type": "image_url", "image_url": {"url": f"data:{image_mime};base64,{image_b64}"}}
+            ]
+        else:
+            print("⚠️ 画像サイズ過大のため、テキストのみで解析します")
+
+    cache_key = AnalysisCache.key_for(data, user_image_bytes)
+    cached_outputs = []
+    analysis_started = time.perf_counter()
+    if job is not None and job.analysis:
+        # 再開時: 解析済みならGPTは呼ばない
+        variants = job.analysis
+        print(f"♻️ Job #{job.id} の解析結果を再利用します")
+    else:
+        if CACHE_MODE in ("exact", "seed"):
+            variants, cached_outputs = await analysis_cache.analyze(cache_key, messages)
+        else:
+            variants, _ = await analyze_answers(messages)
+        if job is not None:
+            job_queue.save_analysis(job.id, variants)
+        STAGE_SECONDS.observe(time.perf_counter() - analysis_started, stage="analysis")
+    if job is not None:
+        job.analysis = variants
+        job.timings["analysis_sec"] = round(time.perf_counter() - analysis_started, 2)
+
+    # === 画像/動画生成フェーズ（2本を並行して生成） ===
+    # 再開時は、動画まで出来ているVariantは作り直さない
+    outputs = []
+    if job is not None:
+        outputs = [o for o in job.outputs if o.get("video_path") not in (None, "none") and os.path.exists(o["video_path"])]
+    if CACHE_MODE == "exact" and not outputs:
+        # exact: 同じ回答で作った動画が残っていれば生成しない
+        outputs = [o for o in cached_outputs if o.get("video_path") not in (None, "none") and os.path.exists(o["video_path"])]
+    done_indexes = {o.get("variant_index") for o in outputs}
+    tasks = [
+        asyncio.create_task(render_variant(i, v, user_image_path, job))
+        for i, v in enumerate(variants) if i not in done_indexes
+    ]
+    try:
+        for fut in asyncio.as_completed(tasks):
+            try:
+                out = await fut
+            except Exception as e:
+                print(f"❌ Variant生成例外: {e}")
+                continue
+            if out is None:
+                continue
+            if OSC_STREAMING:
+                # 出来た順に送る（最初の1本は旧 /karmic_data にも）
+                await send_variant_osc(out, job, legacy=not outputs)
+                assets.touch([out])
+                print(f"📡 ({out.get('variant_id')}) TouchDesignerへ先行送信しました")
+            outputs.append(out)
+            if job is not None:
+                job_queue.save_outputs(job.id, outputs)
+    finally:
+        # ジョブが取り消された時は、生成途中のVariantも止める
+        for t in tasks:
+            t.cancel()
+    outputs.sort(key=lambda o: o.get("variant_index", 0))
+    if job is not None:
+        job.outputs = outputs
+
+    # TouchDesignerへ送信（Variantごとのバンドル → 揃った合図の /karma/set）
+    if outputs:
+        if not OSC_STREAMING:
+            for n, out in enumerate(outputs):
+                await send_variant_osc(out, job, legacy=(n == 0))
+
+        await send_set_osc(outputs, job)
+        assets.touch(outputs)
+        if CACHE_MODE == "exact":
+            analysis_cache.save_outputs(cache_key, outputs)
+
+        print(f"📡 TouchDesignerへデータを送信しました（/karma/variant/0.., /karma/set, seq={osc_out.seq}）")
+        return True
     else:
         print("❌ すべてのVariantで生成に失敗したため、送信をスキップします")
+        return False
+
+# ==========================================
+# ワーカー（ジョブキューから取り出して生成）
+# ==========================================
+# 実行中ジョブ: job_id -> Task（新しい送信で置き換えられた時にキャンセルする）
+running_jobs = {}
+
+def supersede(session_id: str, new_job_id: int):
+    """同じキオスクセッションから新しい送信が来たら、古いジョブは取り消す"""
+    if not session_id:
+        return
+    for job_id in job_queue.active_jobs_for_session(session_id, exclude=new_job_id):
+        job_queue.set_state(job_id, JOB_FAILED, error="superseded")
+        task = running_jobs.get(job_id)
+        if task is not None:
+            task.cancel()
+        print(f"✂️ Job #{job_id} は新しい送信 (Job #{new_job_id}) に置き換えられました")
+
+class ServerLink:
+    """ワーカーからサーバーへ done を返すための窓口（切断中はためておき、再接続時にまとめて送る）"""
+
+    def __init__(self):
+        self.websocket = None
+        self._pending = []
+
+    async def attach(self, websocket):
+        self.websocket = websocket
+        pending, self._pending = self._pending, []
+        for message in pending:
+            await self.send(message)
+        await self.report_load()
+
+    def detach(self):
+        self.websocket = None
+
+    async def send(self, message: dict):
+        if self.websocket is not None:
+            try:
+                await self.websocket.send(json.dumps(message))
+                return
+            except websockets.exceptions.ConnectionClosed:
+                pass
+        self._pending.append(message)
+
+    async def done(self, job):
+        if WORKER_GROUP and job.payload.get("seq") is not None:
+            await self.send({"type": "done", "epoch": job.payload.get("epoch"), "seq": job.payload.get("seq")})
+        await self.report_load()
+
+    async def report_load(self):
+        """待ち行列の長さをサーバーへ伝える（サーバーの受付制御が混雑を判断する）。切断中は送らない"""
+        if self.websocket is None:
+            return
+        stats = job_queue.stats()
+        try:
+            await self.websocket.send(json.dumps({
+                "type": "load", "worker_id": WORKER_ID, "queued": stats["depth"],
+                "running": stats["in_progress"], "capacity": WORKER_COUNT,
+            }))
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+server_link = ServerLink()
+
+async def worker(n: int):
+    while True:
+        job = await job_queue.next_job()
+        wait = time.time() - job.created_at
+        lane = LANE_NAMES.get(job.priority, str(job.priority))
+        print(f"⏱️ [worker{n}] Job #{job.id} 開始（{lane} / 待ち時間 {wait:.1f}秒 / 残り {job_queue.stats()['depth']}件）")
+        if job.attempts > JOB_MAX_ATTEMPTS:
+            print(f"❌ Job #{job.id} は{JOB_MAX_ATTEMPTS}回失敗したため打ち切ります")
+            job_queue.set_state(job.id, JOB_FAILED, error="too many attempts")
+            await server_link.done(job)
+            continue
+        started = time.time()
+        # process_data とそこから作るタスクは、このジョブのレーンで生成枠を待つ
+        current_lane.set(job.priority)
+        task = asyncio.create_task(process_data(job.payload, job))
+        running_jobs[job.id] = task
+        try:
+            # ワーカー自身のキャンセルは伝播させ、ジョブだけのキャンセル（置き換え）は握りつぶす
+            await asyncio.wait({task})
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        finally:
+            running_jobs.pop(job.id, None)
+        error = None
+        if task.cancelled() and job_queue.state_of(job.id) == JOB_QUEUED:
+            # 取り消し中にまたこちらへ割り当てられ、待ち行列に戻された（restore）。結果は次の実行で出す
+            print(f"🔁 Job #{job.id} は割り当て直しで戻ってきたため、もう一度処理します")
+            continue
+        if task.cancelled():
+            # 置き換え (supersede) か、他のブリッジへの割り当て直し (revoke)
+            state, error = JOB_FAILED, job_queue.error_of(job.id) or "superseded"
+            print(f"✂️ Job #{job.id} をキャンセルしました")
+        elif task.exception() is not None:
+            e = task.exception()
+            print(f"❌ Job #{job.id} 例外: {e}")
+            traceback.print_exception(e)
+            state, error = JOB_FAILED, repr(e)
+        else:
+            state = JOB_DELIVERED if task.result() else JOB_FAILED
+        job_queue.set_state(job.id, state, error=error)
+        job.timings["wait_sec"] = round(started - job.created_at, 2)
+        job.timings["total_sec"] = round(time.time() - started, 2)
+        JOB_WAIT_SECONDS.observe(started - job.created_at, lane=lane)
+        JOB_SECONDS.observe(time.time() - started, state=state)
+        JOBS_TOTAL.inc(state=state)
+        submission_log.append(submission_record(job, state, error))
+        finish_storage(job, state)
+        await server_link.done(job)
+
+def finish_storage(job, state: str):
+    try:
+        assets.finish(job, state)
+        removed = assets.evict(job_queue.active_job_ids())
+        if removed:
+            print(f"🧹 古い生成物 {removed}ジョブ分を削除しました（{assets.stats()}）")
+    except Exception as e:
+        print(f"⚠️ 保存領域の整理エラー: {e}")
 
 # ==========================================
 # 待機ループ (修正版: 接続強化)
@@ -588,15 +1990,69 @@ async def listen():
                 close_timeout=100
             ) as websocket:
                 print("✅ 接続成功！待機中... (Ctrl+Cで停止)")
+                # フォーム送信だけを購読（キオスク向けの画像は受け取らない）
+                # 取りこぼしたくないので、サーバー側キューがあふれた時は待ってもらう
+                # 最後に受け付けた seq を伝え、切断中に届いた分を再送してもらう
+                epoch, last_ack = job_queue.last_ack()
+                subscribe = {
+                    "type": "subscribe",
+                    "topics": ["form_submission"],
+                    "overflow": "block",
+                    "epoch": epoch,
+                    "last_ack": last_ack,
+                }
+                if WORKER_GROUP:
+                    # グループ参加: 未完了の担当分はサーバー側の担当表から再送される
+                    subscribe.update({
+                        "group": WORKER_GROUP,
+                        "worker_id": WORKER_ID,
+                        "capacity": WORKER_COUNT,
+                        "active": job_queue.active_sources(),
+                    })
+                    print(f"👥 グループ {WORKER_GROUP} に {WORKER_ID} として参加します")
+                await websocket.send(json.dumps(subscribe))
+                await server_link.attach(websocket)
                 
                 while True:
                     try:
                         message = await websocket.recv()
                         data = json.loads(message)
                         if data.get("type") == "form_submission":
-                            await process_data(data)
+                            # ここでは積むだけ（生成はワーカーが行うので受信は止まらない）
+                            # 再接続・割り当て直しで届いた分 (replay) は、いま来た来場者の後ろに回す
+                            lane = LANE_REPLAY if data.get("replay") else LANE_LIVE
+                            job_id = job_queue.enqueue(data, lane)
+                            if job_id is None and job_queue.restore(data, lane) is not None:
+                                # 取り消した後で同じ送信がまたこちらに来た（切断が長引いて戻った時など）
+                                print(f"🔁 取り消し済みの送信が再び割り当てられました（seq={data.get('seq')}）。もう一度積みます")
+                                await server_link.report_load()
+                            elif job_id is None:
+                                print(f"♻️ 受付済みの送信です（seq={data.get('seq')}）。スキップします")
+                                if WORKER_GROUP and [data.get("epoch"), data.get("seq")] not in job_queue.active_sources():
+                                    # もう終わっている → サーバーの担当表からも外してもらう
+                                    await server_link.send({"type": "done", "epoch": data.get("epoch"), "seq": data.get("seq")})
+                            else:
+                                print(f"📥 Job #{job_id} を受け付けました（待ち {job_queue.stats()['depth']}件）")
+                                supersede(data.get("session_id"), job_id)
+                                await server_link.report_load()
+                            # DBに書けた時点で ack（以降はブリッジが落ちてもジョブは残る）
+                            if data.get("seq") is not None:
+                                await websocket.send(json.dumps({
+                                    "type": "ack",
+                                    "epoch": data.get("epoch"),
+                                    "seq": data.get("seq"),
+                                }))
+                        elif data.get("type") == "revoke":
+                            # 切断中に他のブリッジへ回された送信。こちらでは作らない
+                            job_id = job_queue.revoke(data.get("epoch"), data.get("seq"))
+                            if job_id is not None:
+                                task = running_jobs.get(job_id)
+                                if task is not None:
+                                    task.cancel()
+                                print(f"🔀 Job #{job_id} は他のブリッジへ割り当て直されたため取り消します")
                     except websockets.exceptions.ConnectionClosed:
                         print("⚠️ 切断されました。再接続します...")
+                        server_link.detach()
                         break
                     except Exception as e:
                         print(f"⚠️ 受信エラー: {e}")
@@ -605,13 +2061,90 @@ async def listen():
             print(f"❌ 接続失敗（5秒後に再試行）: {e}")
             await asyncio.sleep(5)
 
+# ==========================================
+# ウォームプールの補充（待ちが無い時だけ）
+# ==========================================
+def _warm_template(payload):
+    # 実際の送信をひな形にするが、個人的な記述は使わない
+    data = json.loads(json.dumps(payload))
+    data["identity"] = {"nickname": "", "age": "", "color": ""}
+    data["legacy"] = {"keep": "", "likes": "", "avoids": ""}
+    data["adulthood"] = dict(data.get("adulthood") or {}, destination="")
+    data["has_image"] = False
+    for key in ("image_id", "image_data", "epoch", "seq"):
+        data.pop(key, None)
+    return data
+
+def pick_warm_bucket():
+    counts = warm_pool.counts()
+    best, best_score = None, 0.0
+    for n, payload in job_queue.popular_payloads():
+        bucket = warm_bucket(payload)
+        # 人気のわりにストックが少ないバケットを優先
+        score = n / (counts.get(bucket, 0) + 1)
+        if score > best_score:
+            best, best_score = payload, score
+    return best
+
+async def refill_warm_pool():
+    # 補充は一番後ろのレーン。来場者のジョブが来たら DALL-E / SVD の空き枠はそちらが先に使う
+    current_lane.set(LANE_WARM)
+    while True:
+        await asyncio.sleep(WARM_REFILL_INTERVAL)
+        try:
+            stats = job_queue.stats()
+            if stats["depth"] or stats["in_progress"]:
+                continue
+            if warm_pool.size() >= WARM_POOL_SIZE or warm_pool.disk_bytes() >= WARM_DISK_BYTES:
+                continue
+            payload = pick_warm_bucket()
+            if payload is None:
+                continue
+            data = _warm_template(payload)
+            bucket = warm_bucket(data)
+            print(f"🔥 ウォームプールを補充します（bucket={bucket}）")
+            messages = [{"role": "system", "content": SYSTEM_PROMPT}, {"role": "user", "content": build_user_input(data)}]
+            variants, from_gpt = await analyze_answers(messages)
+            if not from_gpt:
+                continue
+            results = await asyncio.gather(*(render_variant(i, v) for i, v in enumerate(variants)))
+            outputs = [o for o in results if o is not None and o.get("video_path") != "none"]
+            if outputs:
+                warm_pool.add(bucket, outputs)
+                print(f"🔥 ウォームプール: {warm_pool.stats()}")
+        except Exception as e:
+            print(f"⚠️ ウォームプール補充エラー: {e}")
+
+async def main():
+    recovered = job_queue.recover()
+    if recovered:
+        print(f"♻️ 前回途中だったジョブ {recovered}件 を再開します")
+    print(f"📊 キュー状況: {job_queue.stats()}")
+    assets.evict(job_queue.active_job_ids())
+    print(f"💾 保存領域: {assets.stats()}")
+    workers = [asyncio.create_task(worker(n)) for n in range(WORKER_COUNT)]
+    if WARM_POOL_SIZE > 0:
+        print(f"🔥 ウォームプール有効: {warm_pool.stats()}")
+        workers.append(asyncio.create_task(refill_warm_pool()))
+    workers.append(asyncio.create_task(submission_log.flush_loop()))
+    if METRICS_PORT:
+        print(f"📈 メトリクス: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+        workers.append(asyncio.create_task(metrics.serve(METRICS_HOST, METRICS_PORT)))
+    try:
+        await listen()
+    finally:
+        for w in workers:
+            w.cancel()
+        submission_log.close()
+        await http_client.aclose()
+
 # ==========================================
 # 実行エントリーポイント (エラー時待機機能付き)
 # ==========================================
 if __name__ == "__main__":
     try:
         # この行がないとループに入りません
-        asyncio.run(listen())
+        asyncio.run(main())
     except KeyboardInterrupt:
         print("\n🛑 システムを停止しました")
     except Exception as e:
@@ -2,12 +2,47 @@ import os
 import json
 import base64
 import asyncio
-from typing import List, Optional
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Form, UploadFile, File
-from fastapi.responses import HTMLResponse, FileResponse
+import hashlib
+import hmac
+import io
+import ipaddress
+import re
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import BinaryIO, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple, Union
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Form, UploadFile, File, HTTPException, Request
+from fastapi.responses import HTMLResponse, FileResponse, JSONResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 
+import gzip
+import mimetypes
+
+import metrics
+from backplane import create_backplane
+from metrics import Counter, Gauge, Histogram
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow が無い環境では正規化せず原本をそのまま使う
+    Image = None
+
+try:
+    import brotli  # 静的ファイルの事前圧縮（任意。無ければ gzip のみ）
+except ImportError:
+    brotli = None
+
+try:
+    # iPhone の HEIC を読めるようにする（任意）
+    from pillow_heif import register_heif_opener
+    register_heif_opener()
+except ImportError:
+    pass
+
 app = FastAPI()
 
 # CORS設定
@@ -19,56 +54,1324 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# === アップロードサイズ制限 ===
+# Content-Length が上限を超えていれば本文を読まずに 413 を返す。
+# Content-Length が無い（chunked）場合も、受信したバイト数を数えて上限を超えた時点で打ち切る
+UPLOAD_MAX_BYTES = int(os.environ.get("UPLOAD_MAX_BYTES", str(20 * 1024 * 1024)))
+UPLOAD_CHUNK_SIZE = 256 * 1024
+
+class UploadSizeLimitMiddleware:
+    def __init__(self, app, max_bytes: int, paths: Iterable[str]):
+        self.app = app
+        self.max_bytes = max_bytes
+        self.paths = set(paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+
+        content_length = dict(scope["headers"]).get(b"content-length", b"")
+        if content_length.isdigit() and int(content_length) > self.max_bytes:
+            response = JSONResponse({"detail": "Payload too large"}, status_code=413)
+            await response(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    # FastAPIは本文パース中のHTTPExceptionをそのまま返す
+                    raise HTTPException(status_code=413, detail="Payload too large")
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+app.add_middleware(UploadSizeLimitMiddleware, max_bytes=UPLOAD_MAX_BYTES, paths=["/upload-satellite"])
+
+# === メトリクス（GET /metrics で Prometheus 形式） ===
+# リクエスト全体の時間と、その中のステージ（ブロブ保存・画像正規化・配信）の時間を分けて記録する
+REQUEST_SECONDS = Histogram("karma_http_request_seconds", "HTTPリクエストの処理時間（秒）", ("route", "status"))
+STAGE_SECONDS = Histogram("karma_server_stage_seconds", "サーバー内の処理ステージごとの所要時間（秒）", ("stage",))
+FANOUT_SECONDS = Histogram("karma_ws_fanout_seconds", "WebSocket配信の遅延（キュー投入から送信完了まで、秒）")
+
+class RequestTimingMiddleware:
+    def __init__(self, app, paths: Iterable[str]):
+        self.app = app
+        self.paths = set(paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+
+        async def timed_send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, timed_send)
+        finally:
+            REQUEST_SECONDS.observe(time.perf_counter() - started, route=scope["path"], status=status)
+
+# サイズ制限で弾いたリクエストも数えるよう、外側に置く
+app.add_middleware(RequestTimingMiddleware, paths=["/submit", "/upload-satellite"])
+
+# /stats と /metrics は運用向け（接続数・キュー・グループの中身が見える）なので公開しない。
+# bridge の 127.0.0.1:9464 と同じく既定はループバックからだけ。Prometheus など外から取る時は
+# OPS_ALLOW（IP か CIDR をカンマ区切り）に加えるか、OPS_TOKEN を設定して
+# "Authorization: Bearer <OPS_TOKEN>" を付ける
+OPS_ALLOW = [ipaddress.ip_network(n.strip(), strict=False)
+             for n in os.environ.get("OPS_ALLOW", "").split(",") if n.strip()]
+OPS_TOKEN = os.environ.get("OPS_TOKEN", "")
+
+def require_ops_access(request: Request):
+    if OPS_TOKEN and hmac.compare_digest(request.headers.get("authorization", ""), f"Bearer {OPS_TOKEN}"):
+        return
+    try:
+        addr = ipaddress.ip_address(request.client.host if request.client else "")
+    except ValueError:
+        addr = None
+    if getattr(addr, "ipv4_mapped", None) is not None:
+        addr = addr.ipv4_mapped
+    if addr is not None and (addr.is_loopback or any(addr in net for net in OPS_ALLOW)):
+        return
+    raise HTTPException(status_code=403)
+
 # === WebSocket管理 ===
+# 購読トピック:
+#   "form_submission"      ... bridge.py がフォーム送信を受け取る
+#   "session:<session_id>" ... 各キオスクが自分宛てのスマホ画像を受け取る
+TOPIC_FORM_SUBMISSION = "form_submission"
+
+def session_topic(session_id: str) -> str:
+    return f"session:{session_id}"
+
+# uvicorn を複数ワーカーで動かす時は、ワーカー間で配信を共有するバックプレーンを指定する（backplane.py 参照）
+#   WS_BACKPLANE=redis://127.0.0.1:6379/0  または  unix:///run/redis/redis.sock
+# 空なら今まで通り1プロセス内で配る
+BACKPLANE_URL = os.environ.get("WS_BACKPLANE", "")
+BACKPLANE_PREFIX = os.environ.get("WS_BACKPLANE_PREFIX", "karma")
+# ワーカー間の連絡用トピック（WebSocketの購読者には流さない）
+CONTROL_TOPIC = "_backplane"
+
+# 1宛先あたりの送信タイムアウト（秒）。超えたソケットは切断扱いにする
+SEND_TIMEOUT = float(os.environ.get("WS_SEND_TIMEOUT", "5"))
+# 接続ごとの送信キュー長と、あふれた時の方針
+#   drop_oldest ... 古いメッセージを捨てて新しいものを入れる（キオスク向け）
+#   drop_newest ... 新しいメッセージを捨てる
+#   block       ... 捨てずに順番どおり溜めておく（bridge向け。送り手は待たない）。
+#                   溜まったまま送信が WS_BLOCK_TIMEOUT 秒進まなければ切断し、再接続時のリプレイで取り戻してもらう
+SEND_QUEUE_SIZE = int(os.environ.get("WS_QUEUE_SIZE", "16"))
+BLOCK_TIMEOUT = float(os.environ.get("WS_BLOCK_TIMEOUT", "2"))
+OVERFLOW_POLICIES = ("drop_oldest", "drop_newest", "block")
+DEFAULT_OVERFLOW_POLICY = os.environ.get("WS_OVERFLOW_POLICY", "drop_oldest")
+
+class BroadcastStats:
+    """送信数・ドロップ数・配信遅延（キュー投入から送信完了まで、直近 window 件）を集計する"""
+
+    def __init__(self, window: int = 1000):
+        self.sends = 0
+        self.drops = 0
+        self.evictions = 0
+        self.publishes = 0
+        self.latencies = deque(maxlen=window)
+
+    def record_send(self, seconds: float):
+        self.sends += 1
+        self.latencies.append(seconds)
+        FANOUT_SECONDS.observe(seconds)
+
+    def percentile(self, q: float) -> float:
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        idx = min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))
+        return ordered[idx]
+
+    def as_dict(self) -> dict:
+        return {
+            "sends": self.sends,
+            "drops": self.drops,
+            "evictions": self.evictions,
+            "publishes": self.publishes,
+            "fanout_p99_ms": round(self.percentile(0.99) * 1000, 2),
+        }
+
+class ClientChannel:
+    """1接続ぶんの送信キューと書き込みタスク。送り手はキューに積むだけで待たない"""
+
+    def __init__(self, websocket: WebSocket, manager: "ConnectionManager",
+                 maxsize: int = SEND_QUEUE_SIZE, policy: str = DEFAULT_OVERFLOW_POLICY):
+        self.websocket = websocket
+        self.manager = manager
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self.policy = policy if policy in OVERFLOW_POLICIES else "drop_oldest"
+        self.task: Optional[asyncio.Task] = None
+        # block の時、キューに入りきらなかった分（捨てずに順番を保つ）
+        self.overflow: deque = deque()
+        # 最後に送信が進んだ時刻（あふれ始めた時刻も含む）
+        self.progress_at = time.perf_counter()
+
+    def start(self):
+        self.task = asyncio.create_task(self._writer())
+
+    def stop(self):
+        if self.task is not None and self.task is not asyncio.current_task():
+            self.task.cancel()
+
+    async def offer(self, payload: str) -> bool:
+        item = (payload, time.perf_counter())
+        stats = self.manager.stats
+        if self.policy == "block":
+            if not self.overflow:
+                try:
+                    self.queue.put_nowait(item)
+                    return True
+                except asyncio.QueueFull:
+                    self.progress_at = time.perf_counter()
+            elif time.perf_counter() - self.progress_at > BLOCK_TIMEOUT:
+                # 黙って捨てると last_ack より前の抜けになり、二度と再送されない。切断して取り戻してもらう
+                print(f"⚠️ 送信が {BLOCK_TIMEOUT:g}秒進まないため切断します（未送信 {self.queue.qsize() + len(self.overflow)}件）")
+                stats.drops += 1
+                self.manager.drop(self.websocket)
+                return False
+            self.overflow.append(item)
+            return True
+        try:
+            self.queue.put_nowait(item)
+            return True
+        except asyncio.QueueFull:
+            stats.drops += 1
+            if self.policy == "drop_newest":
+                return False
+            try:
+                self.queue.get_nowait()
+            except asyncio.QueueEmpty:
+                pass
+            self.queue.put_nowait(item)
+            return True
+
+    async def _writer(self):
+        while True:
+            payload, enqueued_at = await self.queue.get()
+            try:
+                await asyncio.wait_for(self.websocket.send_text(payload), timeout=SEND_TIMEOUT)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Send error (evicting): {e!r}")
+                await self.manager.evict(self.websocket)
+                return
+            self.manager.stats.record_send(time.perf_counter() - enqueued_at)
+            self.progress_at = time.perf_counter()
+            while self.overflow and not self.queue.full():
+                self.queue.put_nowait(self.overflow.popleft())
+
+# === コンシューマーグループ ===
+# bridge.py を複数台つなぐ時、同じグループのメンバーには送信を1件ずつ振り分ける（全員には送らない）。
+#   {"type": "subscribe", "topics": ["form_submission"], "group": "bridges", "worker_id": "...", "capacity": 2,
+#    "active": [[epoch, seq], ...]}
+# 割り当てた送信は、担当の bridge が {"type": "done", "epoch", "seq"} を返すまでその担当のもの。
+# 担当が切断したまま GROUP_GRACE 秒たつと他のメンバーへ割り当て直し、
+# 戻ってきた元の担当には {"type": "revoke", "epoch", "seq"} を送って二重生成を止める
+GROUP_STRATEGIES = ("least_loaded", "round_robin")
+GROUP_ASSIGNMENT = os.environ.get("WS_GROUP_ASSIGNMENT", "least_loaded")
+GROUP_GRACE = float(os.environ.get("WS_GROUP_GRACE", "30"))
+# バックプレーン使用時、同じグループのメンバーが複数のワーカーにいれば、1件ごとに担当ワーカーを
+# claim（先着1名）で決める。担当中の件数が多いワーカーほど WS_GROUP_CLAIM_DELAY × 負荷 だけ名乗り出るのを遅らせる
+GROUP_CLAIM_DELAY = float(os.environ.get("WS_GROUP_CLAIM_DELAY", "0.05"))
+GROUP_CLAIM_TTL = 24 * 3600
+
+class Assignment(NamedTuple):
+    message: dict
+    worker_id: str
+    acked: bool = False
+    attempt: int = 0  # 割り当て直した回数（claim のキーに入れる）
+
+class ConsumerGroup:
+    def __init__(self, topic: str, group: str, manager: "ConnectionManager", strategy: str = GROUP_ASSIGNMENT):
+        self.topic = topic
+        self.group = group
+        self.name = f"{topic}/{group}"
+        self.manager = manager
+        self.strategy = strategy if strategy in GROUP_STRATEGIES else "least_loaded"
+        self.members: Dict[str, WebSocket] = {}
+        self.capacity: Dict[str, int] = {}
+        self.totals: Dict[str, int] = {}
+        # worker_id -> 参加時に bridge が申告した処理中の (epoch, seq)
+        self.active: Dict[str, Optional[Set[Tuple[str, int]]]] = {}
+        # (epoch, seq) -> 割り当て
+        self.inflight: Dict[Tuple[str, int], Assignment] = {}
+        # メンバーが誰もいない間に来た送信 (message, attempt, claim済みか)
+        self.pending: deque = deque()
+        # worker_id -> 他へ回したので取り消してもらう (epoch, seq)
+        self.revoked: Dict[str, Set[Tuple[str, int]]] = {}
+        self._grace: Dict[str, asyncio.Task] = {}
+        self._claims: Set[asyncio.Task] = set()
+        self._rr = 0
+        self.reassigned = 0
+
+    @staticmethod
+    def key(message: dict) -> Tuple[str, int]:
+        return message.get("epoch"), message.get("seq")
+
+    def load(self, worker_id: str) -> float:
+        n = sum(1 for a in self.inflight.values() if a.worker_id == worker_id)
+        return n / self.capacity.get(worker_id, 1)
+
+    def pick(self) -> Optional[str]:
+        if not self.members:
+            return None
+        workers = sorted(self.members)
+        if self.strategy == "round_robin":
+            self._rr += 1
+            return workers[(self._rr - 1) % len(workers)]
+        # 担当中の件数 / capacity が一番少ないメンバー（同じなら今までの担当数が少ない方）
+        return min(workers, key=lambda w: (self.load(w), self.totals.get(w, 0), w))
+
+    async def offer(self, message: dict, attempt: int = 0):
+        if not self.members:
+            self.pending.append((message, attempt, False))
+            return
+        if not backplane.shared:
+            await self.assign(message, attempt)
+            return
+        # 空いているワーカーほど早く名乗り出る（ワーカーをまたいだ least_loaded の近似）。
+        # 待つ間もバックプレーンの受信を止めないよう別タスクで行う
+        delay = GROUP_CLAIM_DELAY * min(4.0, min(self.load(w) for w in self.members))
+        task = asyncio.create_task(self._claim(message, attempt, delay))
+        self._claims.add(task)
+        task.add_done_callback(self._claims.discard)
+
+    async def _claim(self, message: dict, attempt: int, delay: float = 0.0):
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if not self.members:
+            self.pending.append((message, attempt, False))
+            return
+        epoch, seq = self.key(message)
+        # 他のワーカーが先に担当を決めていれば何もしない
+        if await backplane.claim(f"{self.name}:{epoch}:{seq}:{attempt}", GROUP_CLAIM_TTL):
+            await self.assign(message, attempt)
+
+    async def assign(self, message: dict, attempt: int = 0):
+        worker_id = self.pick()
+        if worker_id is None:
+            self.pending.append((message, attempt, True))
+            return
+        key = self.key(message)
+        websocket = self.members[worker_id]
+        # 取り消し待ちのワーカー自身に戻ってきた時は、取り消さずにそのまま続けてもらう
+        revoked = key in self.revoked.get(worker_id, ())
+        self.revoked.get(worker_id, set()).discard(key)
+        self.inflight[key] = Assignment(message, worker_id, attempt=attempt)
+        self.totals[worker_id] = self.totals.get(worker_id, 0) + 1
+        if await self.manager.send_to(websocket, message):
+            return
+        # 送れなかった（詰まって切断した）。この割り当ては無かったことにして、他のメンバーか保留に回す
+        if self.inflight.get(key) is not None and self.inflight[key].worker_id == worker_id:
+            del self.inflight[key]
+        self.totals[worker_id] -= 1
+        if revoked:
+            self.revoked.setdefault(worker_id, set()).add(key)
+        if self.members.get(worker_id) is websocket:
+            self.leave(websocket)
+        await self.assign(message, attempt)
+
+    async def join(self, websocket: WebSocket, worker_id: str, capacity: int, active=None):
+        self.members[worker_id] = websocket
+        self.capacity[worker_id] = max(1, capacity)
+        self.active[worker_id] = active
+        timer = self._grace.pop(worker_id, None)
+        if timer is not None:
+            timer.cancel()
+        # 担当中だった分を引き継ぐ。ack 済みで bridge 側でも終わっているものは完了扱い、未 ack は再送
+        for key, a in list(self.inflight.items()):
+            if a.worker_id != worker_id:
+                continue
+            if not a.acked:
+                await self.manager.send_to(websocket, dict(a.message, replay=True))
+            elif active is not None and key not in active:
+                del self.inflight[key]
+        while self.pending:
+            message, attempt, claimed = self.pending.popleft()
+            if claimed or not backplane.shared:
+                await self.assign(message, attempt)
+            else:
+                await self._claim(message, attempt)
+        # 取り消しは保留分を配った後に送る（本人に戻った分は assign で取り消しから外れる）
+        for epoch, seq in sorted(self.revoked.pop(worker_id, ())):
+            await self.manager.send_to(websocket, {"type": "revoke", "epoch": epoch, "seq": seq})
+
+    def leave(self, websocket: WebSocket):
+        for worker_id, ws in list(self.members.items()):
+            if ws is not websocket:
+                continue
+            del self.members[worker_id]
+            if any(a.worker_id == worker_id for a in self.inflight.values()):
+                self._grace[worker_id] = asyncio.create_task(self._expire(worker_id))
+
+    async def _expire(self, worker_id: str):
+        await asyncio.sleep(GROUP_GRACE)
+        self._grace.pop(worker_id, None)
+        if worker_id in self.members:
+            return
+        for key, a in list(self.inflight.items()):
+            if a.worker_id != worker_id:
+                continue
+            del self.inflight[key]
+            self.reassigned += 1
+            print(f"🔀 [{self.name}] seq={key[1]} を {worker_id} から割り当て直します")
+            # 戻り先のメンバーが別のワーカーにいるかもしれないので、バックプレーン経由で全ワーカーに出し直す
+            await self.manager.reassign(self, a.message, a.attempt + 1, worker_id)
+
+    async def replay(self, messages: Iterable[dict]):
+        """グループができる前に届いた送信を流し直す（担当表・保留中に既にあるものは除く）"""
+        known = set(self.inflight) | {self.key(m) for m, _, _ in self.pending}
+        for message in messages:
+            if self.key(message) not in known:
+                await self.offer(dict(message, replay=True))
+
+    async def requeue(self, message: dict, attempt: int, revoke_from: str):
+        self.revoked.setdefault(revoke_from, set()).add(self.key(message))
+        await self.offer(dict(message, replay=True), attempt)
+
+    def release(self, worker_id: str) -> List[Assignment]:
+        """別のワーカーに参加し直したメンバーの担当を手放して返す"""
+        self.members.pop(worker_id, None)
+        self.active.pop(worker_id, None)
+        self.revoked.pop(worker_id, None)
+        timer = self._grace.pop(worker_id, None)
+        if timer is not None:
+            timer.cancel()
+        moved = []
+        for key, a in list(self.inflight.items()):
+            if a.worker_id == worker_id:
+                moved.append(self.inflight.pop(key))
+        return moved
+
+    async def adopt(self, worker_id: str, assignments: List[Assignment]):
+        """別のワーカーが手放した担当を引き継ぐ（join と同じく、未 ack は再送、bridge 側で終わった分は完了扱い）"""
+        websocket = self.members.get(worker_id)
+        active = self.active.get(worker_id)
+        for a in assignments:
+            key = self.key(a.message)
+            if websocket is not None and a.acked and active is not None and key not in active:
+                continue
+            self.inflight[key] = a
+            if websocket is not None and not a.acked:
+                await self.manager.send_to(websocket, dict(a.message, replay=True))
+        if websocket is None and assignments and worker_id not in self._grace:
+            self._grace[worker_id] = asyncio.create_task(self._expire(worker_id))
+
+    def ack(self, worker_id: str, key: Tuple[str, int]):
+        a = self.inflight.get(key)
+        if a is not None and a.worker_id == worker_id:
+            self.inflight[key] = a._replace(acked=True)
+
+    def done(self, worker_id: str, key: Tuple[str, int]):
+        # 割り当て直した後で元の担当から届いた done は無視する
+        a = self.inflight.get(key)
+        if a is not None and a.worker_id == worker_id:
+            del self.inflight[key]
+
+    def as_dict(self) -> dict:
+        return {
+            "strategy": self.strategy,
+            "members": {
+                w: {"inflight": sum(1 for a in self.inflight.values() if a.worker_id == w),
+                    "capacity": self.capacity.get(w, 1), "assigned": self.totals.get(w, 0)}
+                for w in sorted(self.members)
+            },
+            "disconnected": sorted(self._grace),
+            "inflight": len(self.inflight),
+            "pending": len(self.pending),
+            "reassigned": self.reassigned,
+        }
+
 class ConnectionManager:
     def __init__(self):
         self.active_connections: List[WebSocket] = []
+        self.channels: Dict[WebSocket, ClientChannel] = {}
+        # topic -> そのトピックを購読しているソケット
+        self.subscriptions: Dict[str, Set[WebSocket]] = {}
+        # topic -> {グループ名: グループ}。グループのメンバーは subscriptions には入れない
+        self.groups: Dict[str, Dict[str, ConsumerGroup]] = {}
+        self.memberships: Dict[WebSocket, List[Tuple[ConsumerGroup, str]]] = {}
+        self.stats = BroadcastStats()
 
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
+        channel = ClientChannel(websocket, self)
+        channel.start()
+        self.channels[websocket] = channel
         self.active_connections.append(websocket)
         print(f"🔌 Client connected. Total: {len(self.active_connections)}")
 
     def disconnect(self, websocket: WebSocket):
+        for topic in list(self.subscriptions):
+            self.unsubscribe(websocket, [topic])
+        for group, _ in self.memberships.pop(websocket, []):
+            group.leave(websocket)
+        channel = self.channels.pop(websocket, None)
+        if channel is not None:
+            channel.stop()
+        if websocket not in self.active_connections:
+            return
         self.active_connections.remove(websocket)
         print(f"🔌 Client disconnected. Total: {len(self.active_connections)}")
 
+    def set_overflow_policy(self, websocket: WebSocket, policy: str):
+        channel = self.channels.get(websocket)
+        if channel is not None and policy in OVERFLOW_POLICIES:
+            channel.policy = policy
+
+    def subscribe(self, websocket: WebSocket, topics: Iterable[str]):
+        for topic in topics:
+            self.subscriptions.setdefault(topic, set()).add(websocket)
+
+    def unsubscribe(self, websocket: WebSocket, topics: Iterable[str]):
+        for topic in topics:
+            subscribers = self.subscriptions.get(topic)
+            if subscribers is None:
+                continue
+            subscribers.discard(websocket)
+            if not subscribers:
+                del self.subscriptions[topic]
+
+    async def join_group(self, websocket: WebSocket, topic: str, name: str, worker_id: str,
+                         capacity: int = 1, active=None, backlog: Iterable[dict] = ()):
+        group = self.groups.setdefault(topic, {}).get(name)
+        if group is None:
+            group = self.groups[topic][name] = ConsumerGroup(topic, name, self)
+            # deliver() は既にあるグループにしか渡さないので、最初のメンバーが来るまでの送信
+            # （サーバー再起動・コールドスタート直後）はリプレイログから保留に積んでおく
+            await group.replay(backlog)
+        self.memberships.setdefault(websocket, []).append((group, worker_id))
+        await group.join(websocket, worker_id, capacity, active)
+        if backplane.shared:
+            # 前に別のワーカーにつながっていたなら、そちらの担当分をこのワーカーへ移してもらう
+            await backplane.publish(CONTROL_TOPIC, {"op": "joined", "topic": topic, "group": name, "worker_id": worker_id})
+
+    def find_group(self, topic: str, name: str) -> Optional[ConsumerGroup]:
+        return self.groups.get(topic, {}).get(name)
+
+    async def reassign(self, group: ConsumerGroup, message: dict, attempt: int, revoke_from: str):
+        await backplane.publish(CONTROL_TOPIC, {
+            "op": "reassign", "topic": group.topic, "group": group.group,
+            "message": message, "attempt": attempt, "revoke_from": revoke_from,
+        })
+
+    def group_ack(self, websocket: WebSocket, key: Tuple[str, int], finished: bool = False):
+        for group, worker_id in self.memberships.get(websocket, ()):
+            if finished:
+                group.done(worker_id, key)
+            else:
+                group.ack(worker_id, key)
+
+    def drop(self, websocket: WebSocket) -> Optional[asyncio.Task]:
+        """すぐに切断扱いにし（購読・グループから外す）、close は別タスクで行う"""
+        if websocket not in self.channels:
+            return None
+        self.stats.evictions += 1
+        self.disconnect(websocket)
+        return asyncio.create_task(self._close(websocket))
+
+    async def _close(self, websocket: WebSocket):
+        try:
+            await asyncio.wait_for(websocket.close(), timeout=SEND_TIMEOUT)
+        except Exception:
+            pass
+
+    async def evict(self, websocket: WebSocket):
+        task = self.drop(websocket)
+        if task is not None:
+            await task
+
+    async def _fan_out(self, recipients: List[WebSocket], payload: str):
+        # JSONは1回だけ作り、各接続のキューに積む（実際の送信は書き込みタスクが行う）
+        self.stats.publishes += 1
+        channels = [self.channels[ws] for ws in recipients if ws in self.channels]
+        if channels:
+            await asyncio.gather(*(ch.offer(payload) for ch in channels))
+
+    async def send_to(self, websocket: WebSocket, message: dict) -> bool:
+        channel = self.channels.get(websocket)
+        if channel is None:
+            return False
+        return await channel.offer(json.dumps(message))
+
+    async def publish(self, topic: str, message: dict):
+        # バックプレーン経由で全ワーカーの deliver() に届く（1プロセスならそのまま deliver() を呼ぶ）
+        await backplane.publish(topic, message)
+
+    async def deliver(self, topic: str, message: dict):
+        # このワーカーにつながっている購読者だけに送る（全接続へのブロードキャストはしない）
+        subscribers = list(self.subscriptions.get(topic, ()))
+        if subscribers:
+            await self._fan_out(subscribers, json.dumps(message))
+        # グループには1メンバーだけ
+        for group in self.groups.get(topic, {}).values():
+            await group.offer(message)
+
     async def broadcast(self, message: dict):
-        for connection in self.active_connections:
+        await self._fan_out(list(self.active_connections), json.dumps(message))
+
+manager = ConnectionManager()
+
+Gauge("karma_ws_connections", "WebSocket接続数", fn=lambda: len(manager.active_connections))
+Gauge("karma_ws_topics", "購読されているトピック数", fn=lambda: len(manager.subscriptions))
+Gauge("karma_ws_queued_messages", "全接続の送信キューに残っているメッセージ数",
+      fn=lambda: sum(ch.queue.qsize() + len(ch.overflow) for ch in manager.channels.values()))
+Counter("karma_ws_publishes_total", "配信回数", fn=lambda: manager.stats.publishes)
+Counter("karma_ws_sends_total", "送信できたメッセージ数", fn=lambda: manager.stats.sends)
+Counter("karma_ws_drops_total", "キューあふれで捨てたメッセージ数", fn=lambda: manager.stats.drops)
+Counter("karma_ws_evictions_total", "送信できずに切断した接続数", fn=lambda: manager.stats.evictions)
+Gauge("karma_group_members", "コンシューマーグループのメンバー数",
+      fn=lambda: sum(len(g.members) for gs in manager.groups.values() for g in gs.values()))
+Gauge("karma_group_inflight", "グループに割り当て済みで done を待っている送信数",
+      fn=lambda: sum(len(g.inflight) for gs in manager.groups.values() for g in gs.values()))
+Gauge("karma_group_pending", "担当できるメンバーがいないため保留中の送信数",
+      fn=lambda: sum(len(g.pending) for gs in manager.groups.values() for g in gs.values()))
+
+# === フォーム送信のリプレイログ ===
+# form_submission に連番(seq)を振り、直近 REPLAY_LOG_SIZE 件を保持する。
+# bridge.py は処理済みの seq を ack し、再接続時に最後の ack を伝えると取りこぼし分が再送される。
+# epoch はサーバー起動ごとに変わる（再起動で seq が1に戻るため）。
+# epoch / seq はバックプレーンの next_seq() が振り（Redis 使用時はワーカー共通）、各ワーカーが届いた送信を自分のログに残す
+REPLAY_LOG_SIZE = int(os.environ.get("REPLAY_LOG_SIZE", "200"))
+
+class ReplayLog:
+    def __init__(self, maxlen: int):
+        self.epoch = uuid.uuid4().hex
+        self.seq = 0
+        self.acked = 0
+        self.entries = deque(maxlen=maxlen)
+
+    async def stamp(self, message: dict) -> dict:
+        # 連番はバックプレーンが振る（1プロセスならプロセス内、Redis ならワーカー共通）
+        message["epoch"], message["seq"] = await backplane.next_seq()
+        return message
+
+    def record(self, message: dict):
+        if message["epoch"] != self.epoch:
+            # epoch が変わった（起動後最初の送信か、Redis が空になった）
+            self.epoch = message["epoch"]
+            self.seq = self.acked = 0
+        self.seq = max(self.seq, message["seq"])
+        self.entries.append(message)
+
+    def ack(self, epoch: str, seq: int):
+        if epoch == self.epoch and seq > self.acked:
+            self.acked = seq
+
+    def backlog(self, epoch: Optional[str], last_ack: int) -> List[dict]:
+        # 同じ epoch なら last_ack より後ろ。epoch が違えば（サーバー再起動後）、まだ誰も ack していない分
+        since = last_ack if epoch == self.epoch else self.acked
+        return [m for m in self.entries if m["epoch"] == self.epoch and m["seq"] > since]
+
+    def as_dict(self) -> dict:
+        return {
+            "epoch": self.epoch,
+            "seq": self.seq,
+            "acked": self.acked,
+            "retained": len(self.entries),
+        }
+
+replay_log = ReplayLog(REPLAY_LOG_SIZE)
+
+Gauge("karma_replay_unacked", "ブリッジがまだ ack していない送信の数", fn=lambda: replay_log.seq - replay_log.acked)
+
+# === 受付制御（/submit） ===
+# 高くつく生成（GPT-4o / DALL-E / SVD）の前に、サーバーで送信を絞る。
+# - 同じ内容の送信（ボタンの連打など）は SUBMIT_DEDUP_WINDOW 秒のあいだ1回だけ流し、2回目以降も成功として返す
+# - 1セッション（無ければ接続元IP）あたり SUBMIT_RATE_WINDOW 秒に SUBMIT_RATE_LIMIT 回まで。超えたら 429
+# - bridge が報告する待ち行列 + まだ ack されていない送信が SUBMIT_MAX_QUEUE 以上なら 503
+# 断る時は {"status": "busy", "reason": ..., "retry_after": 秒} を返し、キオスクが「混雑中」を表示する。
+# 回数と重複の記録はバックプレーンに置くので、複数ワーカーでも共通
+SUBMIT_DEDUP_WINDOW = float(os.environ.get("SUBMIT_DEDUP_WINDOW", "120"))
+SUBMIT_RATE_LIMIT = int(os.environ.get("SUBMIT_RATE_LIMIT", "3"))
+SUBMIT_RATE_WINDOW = float(os.environ.get("SUBMIT_RATE_WINDOW", "60"))
+SUBMIT_MAX_QUEUE = int(os.environ.get("SUBMIT_MAX_QUEUE", "30"))  # 0 で無制限
+SUBMIT_RETRY_AFTER = int(os.environ.get("SUBMIT_RETRY_AFTER", "30"))
+# これより古い bridge の負荷報告は数えない（落ちた bridge の分が残り続けないように）
+LOAD_REPORT_TTL = 300
+
+SUBMIT_REJECTED = Counter("karma_submit_rejected_total", "受付制御で断った /submit の数", ("reason",))
+
+class Admission:
+    def __init__(self):
+        # worker_id -> (待ち, 生成中, 同時実行数, 受信時刻)
+        self.loads: Dict[str, Tuple[int, int, int, float]] = {}
+        self.accepted = 0
+        self.duplicates = 0
+        self.rejected: Dict[str, int] = {}
+
+    def report(self, worker_id: str, queued: int, running: int, capacity: int):
+        self.loads[worker_id] = (queued, running, capacity, time.time())
+
+    def backlog(self) -> int:
+        now = time.time()
+        queued = sum(q for q, _, _, at in self.loads.values() if now - at < LOAD_REPORT_TTL)
+        # bridge に届いたが積まれる前の分、bridge が落ちていて届いていない分も数える
+        return queued + max(0, replay_log.seq - replay_log.acked)
+
+    async def check(self, client_key: str, fingerprint: str) -> Optional[dict]:
+        """受け付けるなら None、重複なら {"status": "duplicate"}、断るなら busy の本文"""
+        dedup_key = f"submit:{fingerprint}"
+        if SUBMIT_DEDUP_WINDOW > 0 and not await backplane.claim(dedup_key, SUBMIT_DEDUP_WINDOW):
+            self.duplicates += 1
+            return {"status": "duplicate"}
+        reason, retry_after = None, SUBMIT_RETRY_AFTER
+        if SUBMIT_MAX_QUEUE > 0 and self.backlog() >= SUBMIT_MAX_QUEUE:
+            reason = "queue_full"
+        elif SUBMIT_RATE_LIMIT > 0 and await backplane.hit(f"rate:{client_key}", SUBMIT_RATE_WINDOW) > SUBMIT_RATE_LIMIT:
+            reason, retry_after = "rate_limited", int(SUBMIT_RATE_WINDOW)
+        if reason is None:
+            self.accepted += 1
+            return None
+        # 断った送信は、後でやり直した時に重複扱いされないよう記録を消す
+        if SUBMIT_DEDUP_WINDOW > 0:
+            await backplane.forget(dedup_key)
+        self.rejected[reason] = self.rejected.get(reason, 0) + 1
+        SUBMIT_REJECTED.inc(reason=reason)
+        return {"status": "busy", "reason": reason, "retry_after": retry_after}
+
+    def as_dict(self) -> dict:
+        return {
+            "backlog": self.backlog(),
+            "max_queue": SUBMIT_MAX_QUEUE,
+            "accepted": self.accepted,
+            "duplicates": self.duplicates,
+            "rejected": dict(self.rejected),
+            "bridges": {w: {"queued": q, "running": r, "capacity": c, "age_sec": round(time.time() - at, 1)}
+                        for w, (q, r, c, at) in sorted(self.loads.items())},
+        }
+
+admission = Admission()
+
+Gauge("karma_submit_backlog", "受付制御が見ている待ち件数（bridge の待ち行列 + 未 ack）", fn=lambda: admission.backlog())
+
+# === 画像ブロブストア ===
+# アップロード画像は内容のハッシュ(sha256)をIDにして保存し、WebSocketにはIDとサイズだけを流す。
+# キオスクや bridge.py は GET /blob/{id} で一度だけ取得する（IDが同じなら中身も同じなのでキャッシュ可）。
+# BLOB_DIR=":memory:" でメモリ保持、それ以外はディスク保持。合計が BLOB_MAX_BYTES を超えたら古い順に捨てる
+# バックプレーン使用時は全ワーカーで同じ BLOB_DIR を使い、保存したワーカーが他のワーカーにも索引させる
+BLOB_DIR = os.environ.get("BLOB_DIR", os.path.join(tempfile.gettempdir(), "karma_blobs"))
+BLOB_MAX_BYTES = int(os.environ.get("BLOB_MAX_BYTES", str(512 * 1024 * 1024)))
+BLOB_ID_RE = re.compile(r"^[0-9a-f]{64}$")
+
+class BlobTooLarge(Exception):
+    pass
+
+class BlobInfo(NamedTuple):
+    id: str
+    size: int
+    content_type: str
+
+# 共有時、起動時の片付けで消すのはこれより古いファイルだけ（他のワーカーが配信中かもしれない）
+BLOB_SHARED_SWEEP_AGE = 3600
+
+class BlobStore:
+    def __init__(self, directory: Optional[str], max_bytes: int, shared: bool = False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.shared = shared
+        # LRU順（末尾が最近使ったもの）
+        self._index: "OrderedDict[str, BlobInfo]" = OrderedDict()
+        self._data: Dict[str, bytes] = {}
+        self.total_bytes = 0
+        # put / put_stream はワーカースレッド、get / discard / adopt はイベントループで呼ばれる。
+        # 索引と total_bytes はこのロックの中でだけ触る
+        self._lock = threading.Lock()
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            # 索引はメモリにしかないので、前回起動時の残りファイル（書きかけ含む）は片付ける
+            for name in os.listdir(self.directory):
+                if BLOB_ID_RE.match(name) or name.endswith(".part"):
+                    path = os.path.join(self.directory, name)
+                    try:
+                        if shared and time.time() - os.path.getmtime(path) < BLOB_SHARED_SWEEP_AGE:
+                            continue
+                        os.remove(path)
+                    except OSError:
+                        pass
+
+    def path(self, blob_id: str) -> str:
+        return os.path.join(self.directory, blob_id)
+
+    def put(self, data: bytes, content_type: str = "application/octet-stream") -> BlobInfo:
+        blob_id = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            info = self._index.get(blob_id)
+            if info is not None:
+                self._index.move_to_end(blob_id)
+                return info
+        if not self.directory:
+            with self._lock:
+                return self._add(BlobInfo(blob_id, len(data), content_type), data=data)
+        # 同じ内容が同時に来ても書きかけを取り合わないよう、一時ファイルは呼び出しごとに分ける
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return self._commit(tmp_path, BlobInfo(blob_id, len(data), content_type))
+
+    def put_stream(self, stream: BinaryIO, content_type: str = "application/octet-stream",
+                   max_bytes: Optional[int] = None) -> BlobInfo:
+        # チャンクごとにハッシュしながら書き出すので、ディスク保持ならメモリ使用量は一定
+        if not self.directory:
+            data = stream.read(max_bytes + 1) if max_bytes is not None else stream.read()
+            if max_bytes is not None and len(data) > max_bytes:
+                raise BlobTooLarge(f"blob exceeds {max_bytes} bytes")
+            return self.put(data, content_type)
+
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                while True:
+                    chunk = stream.read(UPLOAD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if max_bytes is not None and size > max_bytes:
+                        raise BlobTooLarge(f"blob exceeds {max_bytes} bytes")
+                    digest.update(chunk)
+                    f.write(chunk)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return self._commit(tmp_path, BlobInfo(digest.hexdigest(), size, content_type))
+
+    def _commit(self, tmp_path: str, info: BlobInfo) -> BlobInfo:
+        # 書き出しとハッシュはロックの外で済ませ、索引と置き換え（rename だけ）はロックの中で行う。
+        # 待っている間に同じ内容が先に入っていれば、そちらを返して二重に数えない
+        with self._lock:
+            existing = self._index.get(info.id)
+            if existing is None:
+                try:
+                    os.replace(tmp_path, self.path(info.id))
+                except BaseException:
+                    os.remove(tmp_path)
+                    raise
+                return self._add(info)
+            self._index.move_to_end(info.id)
+        os.remove(tmp_path)
+        return existing
+
+    def _add(self, info: BlobInfo, data: Optional[bytes] = None) -> BlobInfo:
+        # self._lock を持って呼ぶ
+        if info.id in self._index:
+            self._index.move_to_end(info.id)
+            return self._index[info.id]
+        if data is not None:
+            self._data[info.id] = data
+        self._index[info.id] = info
+        self.total_bytes += info.size
+        self._evict()
+        return info
+
+    def discard(self, blob_id: str):
+        with self._lock:
+            info = self._index.pop(blob_id, None)
+            if info is None:
+                return
+            self.total_bytes -= info.size
+            self._remove(blob_id)
+
+    def get(self, blob_id: str) -> Optional[BlobInfo]:
+        with self._lock:
+            info = self._index.get(blob_id)
+        if info is None:
+            return None
+        if self.shared and not os.path.exists(self.path(blob_id)):
+            # 他のワーカーが捨てた
+            self.discard(blob_id)
+            return None
+        with self._lock:
+            if blob_id in self._index:
+                self._index.move_to_end(blob_id)
+        return info
+
+    def adopt(self, info: BlobInfo):
+        """他のワーカーが共有ディレクトリに保存したブロブを索引に加える"""
+        if not os.path.exists(self.path(info.id)):
+            return
+        with self._lock:
+            if info.id not in self._index:
+                self._add(info)
+
+    def read(self, blob_id: str) -> bytes:
+        if self.directory:
+            with open(self.path(blob_id), "rb") as f:
+                return f.read()
+        return self._data[blob_id]
+
+    def _evict(self):
+        # self._lock を持って呼ぶ。直近に入れた1件は残す
+        while self.total_bytes > self.max_bytes and len(self._index) > 1:
+            blob_id, info = self._index.popitem(last=False)
+            self.total_bytes -= info.size
+            self._remove(blob_id)
+
+    def _remove(self, blob_id: str):
+        # ファイル削除はロックの中で行う（外だと、同じ内容を入れ直した直後のファイルを消しかねない）
+        if self.directory:
             try:
-                await connection.send_text(json.dumps(message))
+                os.remove(self.path(blob_id))
+            except OSError:
+                pass
+        else:
+            self._data.pop(blob_id, None)
+
+if BACKPLANE_URL and BLOB_DIR == ":memory:":
+    raise RuntimeError("WS_BACKPLANE を使う時は BLOB_DIR を全ワーカー共通のディレクトリにしてください")
+
+blob_store = BlobStore(None if BLOB_DIR == ":memory:" else BLOB_DIR, BLOB_MAX_BYTES, shared=bool(BACKPLANE_URL))
+
+Gauge("karma_blob_bytes", "ブロブストアの使用量（バイト）", fn=lambda: blob_store.total_bytes)
+
+# === 画像の正規化（プロセスプールで実行） ===
+# スマホ写真をデコード → EXIFの向き補正 → 長辺 IMAGE_LONG_EDGE に縮小 → JPEG/WebPで再エンコード。
+# キオスクのプレビュー用に長辺 THUMB_LONG_EDGE のサムネイルも作る。
+# デコードはCPUを食うので、イベントループを止めないよう別プロセスで行う
+IMAGE_LONG_EDGE = int(os.environ.get("IMAGE_LONG_EDGE", "1536"))
+IMAGE_FORMAT = os.environ.get("IMAGE_FORMAT", "JPEG").upper()  # JPEG | WEBP
+IMAGE_QUALITY = int(os.environ.get("IMAGE_QUALITY", "85"))
+THUMB_LONG_EDGE = int(os.environ.get("THUMB_LONG_EDGE", "320"))
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", "2"))
+
+IMAGE_CONTENT_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp"}
+
+def _encode_image(im, fmt: str, quality: int) -> bytes:
+    buf = io.BytesIO()
+    if fmt == "WEBP":
+        im.save(buf, "WEBP", quality=quality, method=4)
+    else:
+        im.save(buf, "JPEG", quality=quality, optimize=True, progressive=True)
+    return buf.getvalue()
+
+def normalize_image(src: Union[str, bytes], long_edge: int, fmt: str, quality: int,
+                    thumb_edge: int) -> Tuple[bytes, bytes]:
+    # プロセスプール内で実行される（引数・戻り値はpickleされる）
+    with Image.open(src if isinstance(src, str) else io.BytesIO(src)) as im:
+        # JPEGなら縮小デコードで読み込み自体を軽くする
+        im.draft("RGB", (long_edge, long_edge))
+        im = ImageOps.exif_transpose(im)
+        im = im.convert("RGB")
+        im.thumbnail((long_edge, long_edge), Image.Resampling.LANCZOS, reducing_gap=3.0)
+        main = _encode_image(im, fmt, quality)
+        im.thumbnail((thumb_edge, thumb_edge), Image.Resampling.LANCZOS, reducing_gap=3.0)
+        thumb = _encode_image(im, fmt, min(quality, 80))
+    return main, thumb
+
+_ingest_pool: Optional[ProcessPoolExecutor] = None
+
+def get_ingest_pool() -> ProcessPoolExecutor:
+    global _ingest_pool
+    if _ingest_pool is None:
+        _ingest_pool = ProcessPoolExecutor(max_workers=INGEST_WORKERS)
+    return _ingest_pool
+
+async def ingest_image(original: BlobInfo) -> Tuple[BlobInfo, Optional[BlobInfo]]:
+    """原本ブロブを正規化し (本体, サムネイル) を返す。失敗した時は (原本, None)"""
+    if Image is None:
+        return original, None
+    src = blob_store.path(original.id) if blob_store.directory else blob_store.read(original.id)
+    fmt = IMAGE_FORMAT if IMAGE_FORMAT in IMAGE_CONTENT_TYPES else "JPEG"
+    loop = asyncio.get_running_loop()
+    try:
+        with STAGE_SECONDS.time(stage="image_ingest"):
+            main, thumb = await loop.run_in_executor(
+                get_ingest_pool(), normalize_image, src, IMAGE_LONG_EDGE, fmt, IMAGE_QUALITY, THUMB_LONG_EDGE
+            )
+    except Exception as e:
+        print(f"⚠️ 画像の正規化に失敗（原本を使用）: {e!r}")
+        return original, None
+    content_type = IMAGE_CONTENT_TYPES[fmt]
+    image = await asyncio.to_thread(blob_store.put, main, content_type)
+    thumbnail = await asyncio.to_thread(blob_store.put, thumb, content_type)
+    if image.id != original.id:
+        blob_store.discard(original.id)
+    print(f"🖼️ 画像を正規化: {original.size // 1024}KB -> {image.size // 1024}KB (thumb {thumbnail.size // 1024}KB)")
+    return image, thumbnail
+
+@app.on_event("shutdown")
+def shutdown_ingest_pool():
+    if _ingest_pool is not None:
+        _ingest_pool.shutdown(wait=False, cancel_futures=True)
+
+# === ワーカー間の配信（バックプレーン） ===
+# publish() したメッセージは全ワーカーの on_backplane() に届き、各ワーカーが自分の接続へ配る。
+# CONTROL_TOPIC ではワーカー同士が次のことを伝え合う:
+#   ack      ... bridge の ack（リプレイログの既読位置をそろえる）
+#   load     ... bridge の負荷報告（受付制御の待ち件数をそろえる）
+#   blob     ... 共有ディレクトリに保存したブロブ（他のワーカーでも GET /blob できるように）
+#   reassign ... 切断の猶予が切れたグループの割り当てを出し直す
+#   joined / handover ... グループのメンバーが別のワーカーにつなぎ直したので、担当分を移す
+async def on_backplane(origin: str, topic: str, message: dict):
+    if topic != CONTROL_TOPIC:
+        if topic == TOPIC_FORM_SUBMISSION and "seq" in message:
+            replay_log.record(message)
+        await manager.deliver(topic, message)
+        return
+
+    op = message.get("op")
+    remote = origin != backplane.origin
+    group = manager.find_group(str(message.get("topic")), str(message.get("group")))
+    if op == "ack" and remote:
+        replay_log.ack(str(message.get("epoch")), int(message.get("seq") or 0))
+    elif op == "load" and remote:
+        admission.report(str(message["worker_id"]), int(message["queued"]), int(message["running"]),
+                         int(message["capacity"]))
+    elif op == "blob" and remote:
+        blob_store.adopt(BlobInfo(message["id"], int(message["size"]), message["content_type"]))
+    elif op == "reassign" and group is not None:
+        await group.requeue(message["message"], int(message["attempt"]), message["revoke_from"])
+    elif op == "joined" and remote and group is not None:
+        moved = group.release(message["worker_id"])
+        if moved:
+            await backplane.publish(CONTROL_TOPIC, {
+                "op": "handover", "to": origin, "topic": group.topic, "group": group.group,
+                "worker_id": message["worker_id"], "assignments": [list(a) for a in moved],
+            })
+    elif op == "handover" and message.get("to") == backplane.origin and group is not None:
+        await group.adopt(message["worker_id"], [Assignment(*a) for a in message["assignments"]])
+
+async def share_blobs(*infos: Optional[BlobInfo]):
+    # 他のワーカーにも索引させる（本体は共有の BLOB_DIR にある）。配信より先に流すこと
+    if not backplane.shared:
+        return
+    for info in infos:
+        if info is not None:
+            await backplane.publish(CONTROL_TOPIC, {"op": "blob", **info._asdict()})
+
+backplane = create_backplane(BACKPLANE_URL, on_backplane, BACKPLANE_PREFIX)
+
+@app.on_event("startup")
+async def start_backplane():
+    await backplane.start()
+
+@app.on_event("shutdown")
+async def stop_backplane():
+    await backplane.stop()
+
+Counter("karma_backplane_published_total", "バックプレーンへ送ったメッセージ数", fn=lambda: backplane.published)
+Counter("karma_backplane_received_total", "バックプレーンから受け取ったメッセージ数", fn=lambda: backplane.received)
+
+# === 静的ファイル（事前圧縮・ETag・フィンガープリント） ===
+# キオスクは120秒ごとに location.reload() するので、毎回の再取得を小さくする。
+# - テキスト系は起動時に gzip / brotli で圧縮しておき、Accept-Encoding に合わせて返す
+# - 全ファイルに強い ETag を付け、If-None-Match が一致すれば 304
+# - HTML 内の /static/... 参照には ?v=<内容のハッシュ> を付ける。?v= が一致するリクエストは
+#   immutable で1年キャッシュ（HTML 自体と ?v= の無いリクエストは毎回 ETag で確認）
+# - STATIC_RESIZE の画像は表示サイズに縮小したものを同じURLで返す（"ファイル名:長辺px" をカンマ区切り）
+STATIC_DIR = "static"
+STATIC_RESIZE = os.environ.get("STATIC_RESIZE", "logo.PNG:400")
+# これより大きいファイルはメモリに載せず、ETag もサイズと更新時刻から作る（動画など）
+STATIC_INLINE_MAX = int(os.environ.get("STATIC_INLINE_MAX", str(2 * 1024 * 1024)))
+STATIC_COMPRESS_MIN = 512
+STATIC_IMMUTABLE = "public, max-age=31536000, immutable"
+STATIC_REF_RE = re.compile(r"""(?<=["'(])/static/([^"'()?#\s`$]+)(?=["')])""")
+
+def _compressible(content_type: str) -> bool:
+    return content_type.startswith("text/") or content_type in (
+        "application/javascript", "application/json", "image/svg+xml",
+    )
+
+def _resize_png(data: bytes, long_edge: int) -> bytes:
+    # ロゴのような線画は256色に減らしても見た目が変わらず、大きく縮む
+    with Image.open(io.BytesIO(data)) as im:
+        im = im.convert("RGBA")
+        im.thumbnail((long_edge, long_edge), Image.Resampling.LANCZOS)
+        im = im.quantize(256, method=Image.Quantize.FASTOCTREE)
+        buf = io.BytesIO()
+        im.save(buf, "PNG", optimize=True)
+    return buf.getvalue()
+
+class StaticAsset(NamedTuple):
+    source: str
+    content_type: str
+    etag: str
+    fingerprint: str
+    stat: Tuple[int, int]
+    body: Optional[bytes] = None  # None ならファイルから返す
+    encodings: Dict[str, bytes] = {}
+
+class StaticAssets:
+    def __init__(self, directory: str, resize: str = ""):
+        self.directory = os.path.abspath(directory)
+        self.resize: Dict[str, int] = {}
+        for item in resize.split(","):
+            name, _, edge = item.strip().rpartition(":")
+            if name and edge.isdigit():
+                self.resize[name] = int(edge)
+        self.assets: Dict[str, StaticAsset] = {}
+
+    def _names(self) -> List[str]:
+        names = []
+        for root, _, files in os.walk(self.directory):
+            for f in files:
+                names.append(os.path.relpath(os.path.join(root, f), self.directory).replace(os.sep, "/"))
+        return names
+
+    def _stat(self, name: str) -> Optional[Tuple[int, int]]:
+        try:
+            st = os.stat(os.path.join(self.directory, name))
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def _load(self, name: str, stat: Tuple[int, int]) -> StaticAsset:
+        source = os.path.join(self.directory, name)
+        content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        if stat[1] > STATIC_INLINE_MAX:
+            tag = hashlib.sha256(f"{name}:{stat[0]}:{stat[1]}".encode()).hexdigest()
+            return StaticAsset(source, content_type, f'"{tag[:32]}"', tag[:12], stat)
+
+        with open(source, "rb") as f:
+            body = f.read()
+        edge = self.resize.get(name)
+        if edge and Image is not None and content_type == "image/png":
+            try:
+                body = _resize_png(body, edge)
             except Exception as e:
-                print(f"Broadcast error: {e}")
+                print(f"⚠️ {name} の縮小に失敗（原本を使用）: {e!r}")
+        if content_type == "text/html":
+            body = STATIC_REF_RE.sub(self._fingerprinted, body.decode("utf-8")).encode("utf-8")
+        tag = hashlib.sha256(body).hexdigest()
+        encodings = {}
+        if _compressible(content_type) and len(body) >= STATIC_COMPRESS_MIN:
+            encodings["gzip"] = gzip.compress(body, 9, mtime=0)
+            if brotli is not None:
+                encodings["br"] = brotli.compress(body, quality=11)
+            encodings = {k: v for k, v in encodings.items() if len(v) < len(body)}
+        return StaticAsset(source, content_type, f'"{tag[:32]}"', tag[:12], stat, body, encodings)
 
-manager = ConnectionManager()
+    def _fingerprinted(self, match) -> str:
+        asset = self.assets.get(match.group(1))
+        if asset is None or asset.content_type == "text/html":
+            return match.group(0)
+        return f"/static/{match.group(1)}?v={asset.fingerprint}"
+
+    def build(self):
+        # HTML は参照先のハッシュを埋め込むので最後に作る
+        self.assets = {}
+        for name in sorted(self._names(), key=lambda n: (mimetypes.guess_type(n)[0] == "text/html", n)):
+            stat = self._stat(name)
+            if stat is not None:
+                self.assets[name] = self._load(name, stat)
+        saved = sum(len(a.body) - min(len(v) for v in a.encodings.values())
+                    for a in self.assets.values() if a.encodings)
+        print(f"📦 静的ファイル {len(self.assets)} 件を準備（圧縮で {saved // 1024}KB 削減, brotli={'on' if brotli else 'off'}）")
+
+    def get(self, name: str) -> Optional[StaticAsset]:
+        asset = self.assets.get(name)
+        if asset is None and name not in self._names():
+            return None
+        stat = self._stat(name)
+        if stat is None:
+            return None
+        if asset is None or asset.stat != stat:
+            # 開発中にファイルが増えた・変わった。参照している HTML のハッシュも変わるので全体を作り直す
+            self.build()
+            asset = self.assets.get(name)
+        return asset
+
+def _accepts(request: Request, encoding: str) -> bool:
+    for part in request.headers.get("accept-encoding", "").split(","):
+        token, _, params = part.partition(";")
+        if token.strip().lower() == encoding:
+            q = params.replace(" ", "").partition("q=")[2]
+            try:
+                return not q or float(q) > 0
+            except ValueError:
+                return True
+    return False
+
+def static_response(asset: StaticAsset, request: Request) -> Response:
+    headers = {
+        "ETag": asset.etag,
+        "Cache-Control": STATIC_IMMUTABLE if request.query_params.get("v") == asset.fingerprint else "no-cache",
+    }
+    encoding = next((e for e in ("br", "gzip") if e in asset.encodings and _accepts(request, e)), None)
+    if asset.encodings:
+        headers["Vary"] = "Accept-Encoding"
+    if encoding:
+        # 表現ごとにバイト列が違うので、強い ETag も分ける
+        headers["ETag"] = f'{asset.etag[:-1]}-{encoding}"'
+    if_none_match = request.headers.get("if-none-match", "")
+    if if_none_match.strip() == "*" or headers["ETag"] in [t.strip() for t in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    if asset.body is None:
+        return FileResponse(asset.source, media_type=asset.content_type, headers=headers)
+    if encoding:
+        headers["Content-Encoding"] = encoding
+        return Response(content=asset.encodings[encoding], media_type=asset.content_type, headers=headers)
+    return Response(content=asset.body, media_type=asset.content_type, headers=headers)
+
+static_assets = StaticAssets(STATIC_DIR, STATIC_RESIZE) if os.path.isdir(STATIC_DIR) else None
+
+@app.on_event("startup")
+async def build_static_assets():
+    if static_assets is not None:
+        await asyncio.to_thread(static_assets.build)
 
 # === ルーティング ===
 
 @app.get("/")
-async def get_index():
-    if os.path.exists("static/index.html"):
-        return FileResponse("static/index.html")
+async def get_index(request: Request):
+    if static_assets is not None:
+        asset = static_assets.get("index.html")
+        if asset is not None:
+            return static_response(asset, request)
     return FileResponse("index.html")
 
-# 静的ファイルマウント
-if os.path.exists("static"):
-    app.mount("/static", StaticFiles(directory="static"), name="static")
+# 静的ファイル
+if static_assets is not None:
+    @app.api_route("/static/{name:path}", methods=["GET", "HEAD"])
+    async def get_static(name: str, request: Request):
+        # static/ の中に実在するファイル名だけを返すので、ディレクトリの外へは出られない
+        asset = static_assets.get(name)
+        if asset is None:
+            raise HTTPException(status_code=404)
+        return static_response(asset, request)
 else:
     app.mount("/static", StaticFiles(directory="."), name="static")
     app.mount("/", StaticFiles(directory="."), name="root")
 
+@app.get("/stats")
+async def get_stats(request: Request):
+    require_ops_access(request)
+    return {
+        "connections": len(manager.active_connections),
+        "topics": len(manager.subscriptions),
+        "broadcast": manager.stats.as_dict(),
+        "replay": replay_log.as_dict(),
+        "backplane": backplane.as_dict(),
+        "admission": admission.as_dict(),
+        "groups": {g.name: g.as_dict() for groups in manager.groups.values() for g in groups.values()},
+    }
+
+@app.get("/metrics")
+async def get_metrics(request: Request):
+    require_ops_access(request)
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+@app.get("/blob/{blob_id}")
+async def get_blob(blob_id: str, request: Request):
+    if not BLOB_ID_RE.match(blob_id):
+        raise HTTPException(status_code=404)
+    info = blob_store.get(blob_id)
+    if info is None:
+        raise HTTPException(status_code=404)
+    # 内容アドレスなので中身は変わらない。長期キャッシュ + ETag で再取得を省く
+    headers = {
+        "Cache-Control": "public, max-age=31536000, immutable",
+        "ETag": f'"{blob_id}"',
+    }
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+    if blob_store.directory:
+        return FileResponse(blob_store.path(blob_id), media_type=info.content_type, headers=headers)
+    return Response(content=blob_store.read(blob_id), media_type=info.content_type, headers=headers)
+
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     await manager.connect(websocket)
     try:
         while True:
-            await websocket.receive_text()
+            text = await websocket.receive_text()
+            # {"type": "subscribe" | "unsubscribe", "topics": [...], "overflow": "block" など}
+            # {"type": "subscribe", "topics": ["form_submission"], "epoch": ..., "last_ack": N} で取りこぼし分を再送
+            # {"type": "ack", "epoch": ..., "seq": N}
+            # {"type": "subscribe", "topics": [...], "group": "bridges", "worker_id": ...} でコンシューマーグループに参加
+            # {"type": "done", "epoch": ..., "seq": N} でグループの割り当てを完了にする
+            # {"type": "load", "worker_id": ..., "queued": N, "running": N, "capacity": N} は bridge の負荷報告
+            try:
+                msg = json.loads(text)
+            except ValueError:
+                continue
+            if not isinstance(msg, dict):
+                continue
+            # 型の合わない値（"seq": "abc" など）はそのメッセージだけ無視する
+            try:
+                topics = msg.get("topics") or []
+                if isinstance(topics, str):
+                    topics = [topics]
+                topics = [str(t) for t in topics if t]
+                if msg.get("type") == "subscribe" and msg.get("group"):
+                    # コンシューマーグループ: 取りこぼし分はグループの担当表から再送される。
+                    # グループがまだ無かった時だけ、それまでの送信を epoch / last_ack でリプレイログから補う
+                    if msg.get("overflow"):
+                        manager.set_overflow_policy(websocket, str(msg["overflow"]))
+                    active = {(str(e), int(s)) for e, s in msg.get("active") or []} if "active" in msg else None
+                    backlog = replay_log.backlog(msg.get("epoch"), int(msg.get("last_ack") or 0))
+                    for topic in topics:
+                        await manager.join_group(
+                            websocket, topic, str(msg["group"]), str(msg.get("worker_id") or id(websocket)),
+                            int(msg.get("capacity") or 1), active,
+                            backlog if topic == TOPIC_FORM_SUBMISSION else (),
+                        )
+                elif msg.get("type") == "subscribe":
+                    backlog = []
+                    if TOPIC_FORM_SUBMISSION in topics and "last_ack" in msg:
+                        backlog = replay_log.backlog(msg.get("epoch"), int(msg.get("last_ack") or 0))
+                    manager.subscribe(websocket, topics)
+                    if msg.get("overflow"):
+                        manager.set_overflow_policy(websocket, str(msg["overflow"]))
+                    if backlog:
+                        print(f"🔁 Replaying {len(backlog)} submission(s)")
+                    for message in backlog:
+                        await manager.send_to(websocket, dict(message, replay=True))
+                elif msg.get("type") == "ack":
+                    key = (str(msg.get("epoch")), int(msg.get("seq") or 0))
+                    replay_log.ack(*key)
+                    manager.group_ack(websocket, key)
+                    if backplane.shared:
+                        await backplane.publish(CONTROL_TOPIC, {"op": "ack", "epoch": key[0], "seq": key[1]})
+                elif msg.get("type") == "done":
+                    manager.group_ack(websocket, (str(msg.get("epoch")), int(msg.get("seq") or 0)), finished=True)
+                elif msg.get("type") == "load":
+                    load = {
+                        "worker_id": str(msg.get("worker_id") or id(websocket)),
+                        "queued": int(msg.get("queued") or 0),
+                        "running": int(msg.get("running") or 0),
+                        "capacity": int(msg.get("capacity") or 1),
+                    }
+                    admission.report(load["worker_id"], load["queued"], load["running"], load["capacity"])
+                    if backplane.shared:
+                        await backplane.publish(CONTROL_TOPIC, dict(load, op="load"))
+                elif msg.get("type") == "unsubscribe":
+                    manager.unsubscribe(websocket, topics)
+            except (TypeError, ValueError) as e:
+                print(f"⚠️ 不正なメッセージを無視しました: {e!r}")
+                continue
     except WebSocketDisconnect:
+        pass
+    finally:
+        # 想定外の例外で抜けても、購読・グループ・書き込みタスクを残さない
         manager.disconnect(websocket)
 
 # === ★ここを修正しました (Q1-Q20に対応) ===
 @app.post("/submit")
 async def handle_form(
+    request: Request,
     q1: str = Form(""),  # Nickname
     q2: str = Form(""),  # Age (文字として受け取る)
     q3: str = Form(""),  # Color
@@ -92,13 +1395,42 @@ async def handle_form(
     q17: str = Form(""), # 残すもの
     q18: str = Form(""), # 好きなもの
     q19: str = Form(""), # 嫌いなもの
-    image_b64: str = Form("") # 画像データ
+    session_id: str = Form(""), # キオスクのセッションID
+    image_id: str = Form(""), # /upload-satellite で保存した画像のID
+    image_b64: str = Form("") # 画像データ（旧キオスク互換）
 ):
     print(f"📩 受信: {q1} ({q2})")
+
+    answers = [q1, q2, q3, q4_1, q4_2, q4_3, q5, q6_1, q6_2, q6_3, q7, q8, q9, q10, q11, q12,
+               q13, q14, q15, q16, q17, q18, q19, session_id, image_id, hashlib.sha256(image_b64.encode()).hexdigest()]
+    fingerprint = hashlib.sha256(json.dumps(answers, ensure_ascii=False).encode("utf-8")).hexdigest()
+    client_key = session_id or (request.client.host if request.client else "")
+    verdict = await admission.check(client_key, fingerprint)
+    if verdict is not None and verdict["status"] == "duplicate":
+        print(f"♻️ 同じ内容の送信です（{q1}）。スキップします")
+        return {"message": "Success", "duplicate": True}
+    if verdict is not None:
+        print(f"🚦 受付を断りました: {verdict['reason']} ({q1})")
+        return JSONResponse(verdict, status_code=429 if verdict["reason"] == "rate_limited" else 503,
+                            headers={"Retry-After": str(verdict["retry_after"])})
+
+    image = blob_store.get(image_id) if BLOB_ID_RE.match(image_id) else None
+    if image is None and image_b64:
+        # 旧形式: base64で直接送られてきた場合もブロブに置き換える
+        b64_str = image_b64.split("base64,", 1)[1] if "base64," in image_b64 else image_b64
+        try:
+            with STAGE_SECONDS.time(stage="blob_store"):
+                image = await asyncio.to_thread(blob_store.put, base64.b64decode(b64_str), "image/jpeg")
+        except ValueError as e:
+            print(f"⚠️ image_b64 decode error: {e}")
+        if image is not None:
+            image, _ = await ingest_image(image)
+            await share_blobs(image)
     
     # TouchDesignerなどが扱いやすいJSON形式にまとめる
     data = {
         "type": "form_submission",
+        "session_id": session_id,
         "identity": {
             "nickname": q1,
             "age": q2,
@@ -136,28 +1468,49 @@ async def handle_form(
             "likes": q18,
             "avoids": q19
         },
-        "has_image": bool(image_b64),
-        "image_data": image_b64
+        "has_image": image is not None,
+        "image_id": image.id if image else "",
+        "image_size": image.size if image else 0,
+        "image_content_type": image.content_type if image else ""
     }
     
-    await manager.broadcast(data)
+    await replay_log.stamp(data)
+    with STAGE_SECONDS.time(stage="publish"):
+        await manager.publish(TOPIC_FORM_SUBMISSION, data)
     return {"message": "Success"}
 
 # スマホ画像アップロード用
 @app.post("/upload-satellite")
 async def upload_satellite(session_id: str = Form(...), image: UploadFile = File(...)):
-    content = await image.read()
-    b64_img = base64.b64encode(content).decode("utf-8")
+    # image.read() で全体をメモリに載せず、スプールファイルからチャンク単位でブロブへ移す
+    try:
+        with STAGE_SECONDS.time(stage="blob_store"):
+            info = await asyncio.to_thread(
+                blob_store.put_stream, image.file, image.content_type or "image/jpeg", UPLOAD_MAX_BYTES
+            )
+    except BlobTooLarge:
+        raise HTTPException(status_code=413, detail="Payload too large")
+    finally:
+        await image.close()
+    info, thumb = await ingest_image(info)
+    await share_blobs(info, thumb)
     message = {
         "type": "satellite_image",
         "session_id": session_id,
-        "image_data": b64_img
+        "image_id": info.id,
+        "image_size": info.size,
+        "thumb_id": thumb.id if thumb else info.id
     }
-    await manager.broadcast(message)
+    with STAGE_SECONDS.time(stage="publish"):
+        await manager.publish(session_topic(session_id), message)
     return {"status": "success"}
 
 if __name__ == "__main__":
     import uvicorn
     # Renderでは環境変数PORTが使われるため、それに対応
     port = int(os.environ.get("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
\ No newline at end of file
+    # 複数ワーカー (WORKERS=N) はワーカーをまたいで配信するため WS_BACKPLANE が必要
+    workers = int(os.environ.get("WORKERS", "1"))
+    if workers > 1 and not BACKPLANE_URL:
+        raise SystemExit("WORKERS を2以上にする時は WS_BACKPLANE を設定してください")
+    uvicorn.run("server:app" if workers > 1 else app, host="0.0.0.0", port=port, workers=workers)
\ No newline at end of file
@@ -0,0 +1,129 @@
+"""コンシューマーグループの取りこぼし・取り消しの回帰テスト（python -m pytest -q）"""
+import asyncio
+import json
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("BLOB_DIR", ":memory:")
+os.environ.setdefault("SUBMIT_RATE_LIMIT", "0")
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+import server  # noqa: E402
+
+
+def join(ws, worker_id, **extra):
+    ws.send_text(json.dumps(dict({
+        "type": "subscribe", "topics": ["form_submission"], "group": "bridges",
+        "worker_id": worker_id, "capacity": 1,
+    }, **extra)))
+
+
+def test_submissions_before_first_bridge_are_replayed(monkeypatch):
+    # サーバー起動直後、bridge がつながる前の送信もグループに届く
+    monkeypatch.chdir(ROOT)
+    monkeypatch.setattr(server.manager, "groups", {})
+    with TestClient(server.app) as client:
+        for name in ("early1", "early2"):
+            assert client.post("/submit", data={"q1": name}).status_code == 200
+        with client.websocket_connect("/ws") as ws:
+            join(ws, "w1", epoch=None, last_ack=0)
+            got = [ws.receive_json() for _ in range(2)]
+            assert [m["identity"]["nickname"] for m in got] == ["early1", "early2"]
+            assert all(m["replay"] for m in got)
+            assert client.post("/submit", data={"q1": "late"}).status_code == 200
+            assert ws.receive_json()["identity"]["nickname"] == "late"
+
+
+class Recorder:
+    def __init__(self):
+        self.sent = []
+
+    async def send_to(self, websocket, message):
+        self.sent.append(message)
+        return True
+
+    async def reassign(self, group, message, attempt, revoke_from):
+        await group.requeue(message, attempt, revoke_from)
+
+
+def test_reassignment_back_to_same_worker_is_not_revoked():
+    # 唯一の bridge が猶予より長く離れて戻った時、同じ送信を取り消してから渡し直さない
+    async def scenario():
+        manager = Recorder()
+        group = server.ConsumerGroup("form_submission", "bridges", manager)
+        message = {"type": "form_submission", "epoch": "e", "seq": 1}
+        await group.join("ws1", "w1", 1)
+        await group.offer(message)
+        group.leave("ws1")
+        for task in list(group._grace.values()):
+            task.cancel()
+        group._grace.clear()
+        # _expire と同じ手順で割り当て直す
+        a = group.inflight.pop(("e", 1))
+        await manager.reassign(group, a.message, a.attempt + 1, "w1")
+        assert group.revoked["w1"] == {("e", 1)}
+        manager.sent.clear()
+        await group.join("ws1b", "w1", 1)
+        return manager.sent, group
+
+    sent, group = asyncio.run(scenario())
+    assert [m.get("type") for m in sent] == ["form_submission"]
+    assert sent[0]["replay"] is True
+    assert group.inflight[("e", 1)].worker_id == "w1"
+    assert "w1" not in group.revoked
+
+
+class RecordingSocket:
+    def __init__(self):
+        self.received = []
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, text):
+        self.received.append(json.loads(text))
+
+    async def close(self):
+        pass
+
+
+class StalledSocket(RecordingSocket):
+    """送信が返ってこない接続（詰まった bridge）"""
+
+    async def send_text(self, text):
+        await asyncio.sleep(3600)
+
+
+def test_submission_is_not_lost_when_assigned_worker_queue_is_full(monkeypatch):
+    # 割り当て先の送信キューが詰まって送れなかった送信は、担当表に残さず他のメンバーに渡す
+    monkeypatch.setattr(server, "BLOCK_TIMEOUT", 0.05)
+
+    async def scenario():
+        manager = server.ConnectionManager()
+        idle, stuck = RecordingSocket(), StalledSocket()
+        for ws in (idle, stuck):
+            await manager.connect(ws)
+            manager.set_overflow_policy(ws, "block")
+        await manager.join_group(idle, "form_submission", "bridges", "w1", capacity=1)
+        await manager.join_group(stuck, "form_submission", "bridges", "w2", capacity=1000)
+        group = manager.groups["form_submission"]["bridges"]
+        # w1 は 1件で手一杯にし、以降は w2 に割り当てさせてキューをあふれさせる
+        for seq in range(server.SEND_QUEUE_SIZE + 6):
+            await group.offer({"type": "form_submission", "epoch": "e", "seq": seq})
+        await asyncio.sleep(0)
+        filled = stuck in manager.channels
+        await asyncio.sleep(0.1)
+        last = {"type": "form_submission", "epoch": "e", "seq": 99}
+        await group.offer(last)
+        await asyncio.sleep(0.01)
+        return filled, manager, group, idle, stuck
+
+    filled, manager, group, idle, stuck = asyncio.run(scenario())
+    assert filled
+    assert stuck not in manager.channels and "w2" not in group.members
+    assert [m["seq"] for m in idle.received] == [0, 99]
+    assert group.inflight[("e", 99)].worker_id == "w1"
+    assert group.totals["w2"] == server.SEND_QUEUE_SIZE + 5
@@ -0,0 +1,91 @@
+"""/ws の受信処理の回帰テスト（python -m pytest -q）"""
+import asyncio
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("BLOB_DIR", ":memory:")
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+import server  # noqa: E402
+
+
+def test_malformed_messages_are_ignored_and_connection_is_cleaned_up(monkeypatch):
+    monkeypatch.chdir(ROOT)
+    with TestClient(server.app, client=("127.0.0.1", 50000)) as client:
+        with client.websocket_connect("/ws") as ws:
+            for bad in ({"type": "ack", "seq": "abc"}, {"type": "done", "seq": [1]},
+                        {"type": "subscribe", "topics": ["form_submission"], "last_ack": "x"},
+                        {"type": "subscribe", "topics": ["form_submission"], "group": "g", "active": [1]},
+                        {"type": "load", "queued": "many"}):
+                ws.send_text(json.dumps(bad))
+            # 接続は生きていて、その後の購読も効く
+            ws.send_text(json.dumps({"type": "subscribe", "topics": ["kiosk"]}))
+            ws.send_text(json.dumps({"type": "ack", "seq": 0}))
+            assert client.get("/stats").status_code == 200
+            assert len(server.manager.active_connections) == 1
+        assert server.manager.active_connections == []
+        assert server.manager.channels == {}
+        assert not any(server.manager.subscriptions.values())
+
+
+def test_stats_and_metrics_are_only_served_to_operators(monkeypatch):
+    # 既定はループバックからだけ。外からは OPS_ALLOW に入っているか OPS_TOKEN が要る
+    monkeypatch.chdir(ROOT)
+    monkeypatch.setattr(server, "OPS_TOKEN", "secret")
+    monkeypatch.setattr(server, "OPS_ALLOW", [server.ipaddress.ip_network("10.1.0.0/16")])
+    clients = {host: TestClient(server.app, client=(host, 50000))
+               for host in ("203.0.113.5", "127.0.0.1", "::ffff:127.0.0.1", "10.1.2.3")}
+    for path in ("/stats", "/metrics"):
+        assert clients["203.0.113.5"].get(path).status_code == 403
+        assert clients["203.0.113.5"].get(path, headers={"Authorization": "Bearer wrong"}).status_code == 403
+        assert clients["203.0.113.5"].get(path, headers={"Authorization": "Bearer secret"}).status_code == 200
+        for host in ("127.0.0.1", "::ffff:127.0.0.1", "10.1.2.3"):
+            assert clients[host].get(path).status_code == 200
+
+
+class StalledSocket:
+    """送信が返ってこない接続（詰まった bridge）"""
+
+    def __init__(self):
+        self.closed = False
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, text):
+        await asyncio.sleep(3600)
+
+    async def close(self):
+        self.closed = True
+
+
+def test_block_subscriber_never_stalls_publisher_and_is_dropped_when_stuck(monkeypatch):
+    # 詰まった bridge があっても配信側は待たず、黙って捨てずに切断して再接続・リプレイに回す
+    monkeypatch.setattr(server, "BLOCK_TIMEOUT", 0.05)
+
+    async def scenario():
+        manager = server.ConnectionManager()
+        ws = StalledSocket()
+        await manager.connect(ws)
+        manager.set_overflow_policy(ws, "block")
+        manager.subscribe(ws, ["form_submission"])
+        started = time.perf_counter()
+        for seq in range(server.SEND_QUEUE_SIZE + 5):
+            await manager.deliver("form_submission", {"type": "form_submission", "seq": seq})
+        waited = time.perf_counter() - started
+        still_connected = ws in manager.channels
+        await asyncio.sleep(0.1)
+        await manager.deliver("form_submission", {"type": "form_submission", "seq": 99})
+        await asyncio.sleep(0)
+        return waited, still_connected, manager, ws
+
+    waited, still_connected, manager, ws = asyncio.run(scenario())
+    assert waited < 0.05
+    assert still_connected
+    assert ws not in manager.channels and manager.stats.evictions == 1
+    assert ws.closed